@@ -14,7 +14,18 @@ available_configs = {
     "local":
         {
             "default_server_addr": "http://localhost:8765",
-            "generate_api_route": "/api/pnb"
+            "generate_api_route": "/api/pnb",
+            # Candidates sampled (in one batch) per sentence, so that one without banned substrings can be picked.
+            # Each candidate costs a full decode; defaults to 2.
+            "generation_candidates": 2,
+            # Whole story generation, streamed from the PNB addon's stream server (`stream_port` in its config).
+            # Remove these to generate sentence by sentence.
+            "story_server_addr": "http://localhost:8766",
+            "story_api_route": "/api/pnb_story",
+            # Sentences streamed while they are generated, from the same server. Remove these to wait for
+            # whole sentences.
+            "stream_server_addr": "http://localhost:8766",
+            "stream_api_route": "/api/pnb_stream",
         }
 }
 
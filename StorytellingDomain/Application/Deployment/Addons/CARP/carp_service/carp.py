@@ -6,23 +6,39 @@ Main driver files.
 Part of the code derived from the CARP project by Castricato et al.
 """
 
+import hashlib
+import json
+import time
+
 import torch
 from torch import nn
 import torch.nn.functional as F
 import numpy as np
 import math
 import transformers
+from concurrent.futures import ThreadPoolExecutor
 
 import torch
 from transformers import PegasusForConditionalGeneration, PegasusTokenizer
 
-from transformers import AutoModel, AutoTokenizer
+from transformers import AutoModel, AutoTokenizer, AutoConfig
+from transformers.modeling_utils import no_init_weights
+
+from StorytellingDomain.Application.Deployment.Addons.mmap_weights import load_weights, attach_weights
+from StorytellingDomain.Application.Deployment.Addons.quantization import quantize_int8
+from StorytellingDomain.Application.Deployment.Addons.response_cache import ResponseCache
+from StorytellingDomain.Application.Deployment.Addons.startup import peak_rss_mb
+from StorytellingDomain.Application.Deployment.Addons.streamed_weights import empty_weights, load_streamed
+from StorytellingDomain.Application.Deployment.Addons.CARP.carp_service.critic_index import CriticIndex
+from StorytellingDomain.Application.Deployment.Addons.CARP.carp_service.critic_store import CriticStore
+from StorytellingDomain.Application.Deployment.Addons.CARP.carp_service.embedding_cache import EmbeddingCache
 
 CARP_MODEL_LOCATION = "/mnt/hdd/datasets/carp/CARP_L.pt"
 
 LATENT_DIM = 2048
-USE_CUDA = True
-USE_HALF = True
+# Precisions CARP can be served in (`precision` in the config) and the dtypes of their weights.
+# int8 is dynamic quantization of linear layers (float32 activations), CPU only.
+PRECISIONS = {"fp16": torch.float16, "bf16": torch.bfloat16, "fp32": torch.float32, "int8": torch.float32}
 config = transformers.RobertaConfig()
 
 extract_fns = {'EleutherAI/gpt-neo-1.3B':
@@ -44,12 +60,25 @@ d_models = {'EleutherAI/gpt-neo-1.3B': 2048,
 
 MODEL_PATH = "roberta-large"
 
+PEGASUS_MODEL_NAME = 'tuner007/pegasus_paraphrase'
+
+# Maximum number of texts paraphrased in one `generate` call.
+PARAPHRASE_BATCH_SIZE = 32
+
 
 class TextEncoder(nn.Module):
-    def __init__(self):
+    def __init__(self, load_pretrained=True):
+        """
+        :param load_pretrained: if False, only the architecture is created (weights uninitialized);
+        used when all weights come from a CARP checkpoint anyway.
+        """
         super().__init__()
 
-        self.model = AutoModel.from_pretrained(MODEL_PATH)
+        if load_pretrained:
+            self.model = AutoModel.from_pretrained(MODEL_PATH)
+        else:
+            with no_init_weights():
+                self.model = AutoModel.from_config(AutoConfig.from_pretrained(MODEL_PATH))
 
         self.tokenizer = AutoTokenizer.from_pretrained(MODEL_PATH)
         self.d_model = d_models[MODEL_PATH]
@@ -61,7 +90,7 @@ class TextEncoder(nn.Module):
     def tok(self, string_batch):
         return self.tokenizer(string_batch,
                               return_tensors='pt',
-                              padding=True).to('cuda')
+                              padding=True).to(self.model.device)
 
     def forward(self, x, mask=None, tokenize=False, mask_sum=True):
         if tokenize:
@@ -127,7 +156,7 @@ class ContrastiveModel(nn.Module):
         y = F.normalize(y)
 
         logits = x @ y.T * self.logit_scale.exp()
-        labels = torch.arange(n, device='cuda')
+        labels = torch.arange(n, device=logits.device)
 
         loss_i = F.cross_entropy(logits, labels)
         loss_t = F.cross_entropy(logits.T, labels)
@@ -153,37 +182,244 @@ class ContrastiveModel(nn.Module):
 N_CTX = 512
 
 
+def length_buckets(lengths, max_tokens):
+    """
+    Split inputs into batches of similar lengths.
+    :param lengths: list of token counts of the inputs.
+    :param max_tokens: maximum of batch size x longest input in each batch; an input longer than this gets a batch
+    of its own.
+    :return: list of lists of input indices, shortest inputs first.
+    """
+    buckets = []
+    bucket = []
+    for i in sorted(range(len(lengths)), key=lambda i: lengths[i]):
+        # Inputs are sorted, so input i would be the longest of the bucket.
+        if len(bucket) > 0 and (len(bucket) + 1) * lengths[i] > max_tokens:
+            buckets.append(bucket)
+            bucket = []
+        bucket.append(i)
+    if len(bucket) > 0:
+        buckets.append(bucket)
+    return buckets
+
+
+def paraphrase_cache_key(input_text, num_return_sequences, num_beams):
+    """
+    Hash of everything that decides the paraphrases of a text.
+    :param input_text: text to paraphrase.
+    :param num_return_sequences: see CARPWorkflow.get_response().
+    :param num_beams: see CARPWorkflow.get_response().
+    :return: hex digest.
+    """
+    canonical = {
+        "text": input_text,
+        "num_return_sequences": int(num_return_sequences),
+        "num_beams": int(num_beams),
+        "model": PEGASUS_MODEL_NAME,
+    }
+    return hashlib.sha256(json.dumps(canonical, sort_keys=True).encode("utf-8")).hexdigest()
+
+
 class CARPWorkflow():
-    def __init__(self, config=None):
+    def __init__(self, config=None, loader=None):
+        """
+        Create the workflow and load its models.
+        :param config: dict of configurations.
+        :param loader: (optional) ModelLoader (see Addons/startup.py) that loads the models and times them;
+        if None, models are loaded right away.
+        """
+        if config is None:
+            config = {}
         self.config = config
 
-        self.model = ContrastiveModel(TextEncoder(), TextEncoder())
-
         try:
             self.carp_path = config["carp_model_path"]
         except:
             print("Can't find carp_model_path in config, using default path.")
             self.carp_path = CARP_MODEL_LOCATION
+
+        # If set, CARP weights are memory-mapped from this directory (see mmap_weights.py), so that workers on
+        # the same machine share them.
+        self.carp_weights = config.get("carp_weights")
+
+        # Device (`device`, default cuda if available) and precision (`precision`, see PRECISIONS; default fp16 on
+        # GPU and fp32 on CPU) of both models.
+        self.torch_device = torch.device(config.get("device", "cuda" if torch.cuda.is_available() else "cpu"))
+        self.precision = config.get("precision", "fp16" if self.torch_device.type == "cuda" else "fp32")
+        if self.precision not in PRECISIONS:
+            raise AttributeError("Unknown precision %s, expected one of %s." % (self.precision, list(PRECISIONS)))
+        if self.precision == "int8" and self.torch_device.type != "cpu":
+            print("WARNING! int8 is only supported on CPU. Using fp16 on %s." % self.torch_device)
+            self.precision = "fp16"
+        self.model = None
+        # Batched scoring groups texts of similar token lengths, with at most `max_batch_tokens` tokens (padding
+        # included) per encoder batch.
+        self.max_batch_tokens = config.get("max_batch_tokens", 16384)
+
+        # Paraphrases (beam search, so deterministic) are cached in memory, and on disk if `paraphrase_cache_path`
+        # is set, so that each review is only paraphrased once.
+        self.paraphrase_cache = None
+        if config.get("paraphrase_cache_size", 4096) > 0:
+            self.paraphrase_cache = ResponseCache(max_entries=config.get("paraphrase_cache_size", 4096),
+                                                  disk_path=config.get("paraphrase_cache_path"))
+
+        # Story line embeddings are cached by text (up to `embedding_cache_mb` megabytes), so that re-scoring an
+        # edited story only encodes the changed lines.
+        self.embedding_cache = None
+        if config.get("embedding_cache_mb", 64) > 0:
+            self.embedding_cache = EmbeddingCache(max_bytes=int(config.get("embedding_cache_mb", 64) * 2 ** 20))
+
+        # Precomputed embeddings of known critics (see critic_store.py); requests using them skip Pegasus and the
+        # review encoder.
+        self.critic_store = None
+        if config.get("critic_store") is not None:
+            try:
+                self.critic_store = CriticStore(config["critic_store"], carp_model_path=self.carp_path)
+            except ValueError as e:
+                print("Warning! %s Ignoring it." % str(e))
+        # Index of the store's critics for the v3 api (exact up to `critic_index_exact_limit` critics).
+        self.critic_index = None
+        self.tokenizer_pegasus = None
+        self.model_pegasus = None
+
+        if loader is None:
+            self.load_carp()
+            self.load_pegasus()
+            if self.critic_store is not None:
+                self.load_critic_index()
+        else:
+            # CARP and Pegasus are independent, so a background loader loads them in parallel.
+            loader.submit("carp", self.load_carp)
+            loader.submit("pegasus", self.load_pegasus)
+            if self.critic_store is not None:
+                loader.submit("critic index", self.load_critic_index)
+
+    def load_carp(self):
+        """
+        Load the contrastive model.
+        The model is created without weights, and the checkpoint is read tensor by tensor straight into the serving
+        dtype and device (see streamed_weights.py), so that peak memory stays close to the size of the served model.
+        :return: None.
+        """
+        if self.carp_weights is not None:
+            print("Mapping CARP weights at %s." % self.carp_weights)
+            model = ContrastiveModel(TextEncoder(load_pretrained=False), TextEncoder(load_pretrained=False))
+            attach_weights(model, load_weights(self.carp_weights))
+            # Weights exported in the serving dtype are kept as they are (still shared) on CPU.
+            self.model = self.to_serving_precision(model)
+            return
+
+        start = time.time()
         try:
-            self.model.load_state_dict(torch.load(self.carp_path))
+            with empty_weights():
+                model = ContrastiveModel(TextEncoder(load_pretrained=False), TextEncoder(load_pretrained=False))
+            # int8 quantization starts from float32 weights on CPU.
+            load_streamed(model, self.carp_path, dtype=PRECISIONS[self.precision],
+                          device=self.torch_device if self.precision != "int8" else torch.device("cpu"))
         except Exception as e:
             print(f"Exception: {str(e)}")
             print("You may need to download the CARP model at  https://the-eye.eu/public/AI/models/CARP/CARP_L.pt ")
-        if USE_HALF: self.model.half()
-        if USE_CUDA: self.model.cuda()
+            model = self.load_carp_from_pretrained()
+        self.model = self.to_serving_precision(model)
+        peak_rss = peak_rss_mb()
+        print("Loaded CARP in %.1fs (peak RSS so far: %s MB)." % (time.time() - start,
+                                                                 "%.0f" % peak_rss if peak_rss is not None else "?"))
+
+    def load_carp_from_pretrained(self):
+        """
+        Load the contrastive model the original way: both encoders load pretrained weights (in parallel), which the
+        checkpoint then overwrites in memory. Used if the checkpoint can not be streamed.
+        :return: ContrastiveModel.
+        """
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            encoders = [executor.submit(TextEncoder) for _ in range(2)]
+            model = ContrastiveModel(encoders[0].result(), encoders[1].result())
+
+        try:
+            model.load_state_dict(torch.load(self.carp_path, map_location="cpu"))
+        except Exception as e:
+            print(f"Exception: {str(e)}")
+        return model
 
+    def load_pegasus(self):
+        """
+        Load the paraphrasing model.
+        :return: None.
+        """
         # Paraphrases using peagasus. Used for softening.
-        model_name = 'tuner007/pegasus_paraphrase'
-        self.torch_device = 'cuda'
-        self.tokenizer_pegasus = PegasusTokenizer.from_pretrained(model_name)
-        self.model_pegasus = PegasusForConditionalGeneration.from_pretrained(model_name).half().to(self.torch_device)
+        self.tokenizer_pegasus = PegasusTokenizer.from_pretrained(PEGASUS_MODEL_NAME)
+        self.model_pegasus = self.to_serving_precision(PegasusForConditionalGeneration.from_pretrained(
+            PEGASUS_MODEL_NAME))
+
+    def load_critic_index(self):
+        """
+        Build the critic index of the v3 api from the critic store.
+        :return: None.
+        """
+        critics = list(self.critic_store.critic_positions.keys())
+        embeddings = self.critic_store.critics.to(device=self.torch_device, dtype=torch.float32) \
+            if len(critics) > 0 else torch.zeros(0, LATENT_DIM, device=self.torch_device)
+        self.critic_index = CriticIndex(critics, embeddings,
+                                        exact_limit=self.config.get("critic_index_exact_limit", 4096),
+                                        num_probes=self.config.get("critic_index_probes", 8))
+
+    def to_serving_precision(self, model):
+        """
+        Move a model to the configured device and precision, in eval mode.
+        :param model: torch.nn.Module.
+        :return: the model (quantized in place for int8).
+        """
+        if self.precision == "int8":
+            print("Quantizing %s to int8." % type(model).__name__)
+            return quantize_int8(model)
+        return model.to(device=self.torch_device, dtype=PRECISIONS[self.precision]).eval()
+
+    def tokenize(self, string_batch):
+        """
+        Tokenize texts without padding. Texts longer than N_CTX tokens keep their last tokens (and their start and
+        end tokens), as the end of a passage is what a review is most likely about.
+        :param string_batch: list of strings.
+        :return: list of lists of token ids.
+        """
+        tokenizer = self.model.encA.tokenizer
+        max_length = N_CTX - tokenizer.num_special_tokens_to_add()
+        all_ids = tokenizer(list(string_batch), add_special_tokens=False)['input_ids']
+        return [tokenizer.build_inputs_with_special_tokens(ids[-max_length:]) for ids in all_ids]
+
+    def pad(self, all_ids):
+        """
+        Pad tokenized texts to the longest of them.
+        :param all_ids: list of lists of token ids, see tokenize().
+        :return: dict of input_ids and attention_mask tensors, on the device of the model.
+        """
+        tokens = self.model.encA.tokenizer.pad({'input_ids': all_ids}, return_tensors='pt')
+        return tokens.to(self.model.encA.model.device)
 
     def tok(self, string_batch):
-        for i, _ in enumerate(string_batch):
-            if len(string_batch[i]) > N_CTX:
-                string_batch[i] = string_batch[i][-N_CTX:]
+        return self.pad(self.tokenize(string_batch))
 
-        return self.model.encA.tok(string_batch)
+    def encode_bucketed(self, texts, encode_function):
+        """
+        Encode texts in batches of similar token lengths, so that one long text does not pad a whole batch to its
+        length. Each batch holds at most `max_batch_tokens` tokens, padding included.
+        :param texts: list of strings.
+        :param encode_function: self.model.encodeX or self.model.encodeY.
+        :return: tensor [len(texts), LATENT_DIM] of normalized embeddings, in the order of texts.
+        """
+        all_ids = self.tokenize(texts)
+        buckets = length_buckets([len(ids) for ids in all_ids], self.max_batch_tokens)
+        embeddings = []
+        with torch.no_grad():
+            for bucket in buckets:
+                tokens = self.pad([all_ids[i] for i in bucket])
+                embeddings.append(F.normalize(encode_function(tokens['input_ids'], tokens['attention_mask'])))
+        embeddings = torch.cat(embeddings)
+
+        # Back to the order of texts.
+        order = torch.tensor([i for bucket in buckets for i in bucket], device=embeddings.device)
+        result = torch.empty_like(embeddings)
+        result[order] = embeddings
+        return result
 
     def get_batch_tokens(self, dataset, inds):
         batch = [dataset[ind] for ind in inds]
@@ -200,12 +436,63 @@ class CARPWorkflow():
         return pass_tokens, pass_masks, rev_tokens, rev_masks
 
     def get_response(self, input_text, num_return_sequences, num_beams):
-        batch = self.tokenizer_pegasus([input_text], truncation=True, padding='longest', max_length=60,
-                                       return_tensors="pt").to(self.torch_device)
-        translated = self.model_pegasus.generate(**batch, max_length=60, num_beams=num_beams,
-                                                 num_return_sequences=num_return_sequences, temperature=1.5)
-        tgt_text = self.tokenizer_pegasus.batch_decode(translated, skip_special_tokens=True)
-        return tgt_text
+        """
+        Paraphrase a text, using the paraphrase cache if enabled.
+        :param input_text: text to paraphrase.
+        :param num_return_sequences: number of paraphrases.
+        :param num_beams: beam size.
+        :return: list of paraphrases.
+        """
+        return self.get_responses([input_text], num_return_sequences, num_beams)[0]
+
+    def get_responses(self, input_texts, num_return_sequences, num_beams):
+        """
+        Paraphrase texts, using the paraphrase cache if enabled. Texts that are not cached are paraphrased together,
+        in batched `generate` calls.
+        :param input_texts: list of texts to paraphrase.
+        :param num_return_sequences: number of paraphrases per text.
+        :param num_beams: beam size.
+        :return: list with, for each text, the list of its paraphrases.
+        """
+        if self.paraphrase_cache is None:
+            missing = list(dict.fromkeys(input_texts))
+            generated = dict(zip(missing, self.generate_paraphrases(missing, num_return_sequences, num_beams)))
+            return [generated[input_text] for input_text in input_texts]
+
+        all_paraphrases = [self.paraphrase_cache.get(paraphrase_cache_key(input_text, num_return_sequences,
+                                                                          num_beams))
+                           for input_text in input_texts]
+        missing = list(dict.fromkeys(input_text for input_text, paraphrases in zip(input_texts, all_paraphrases)
+                                     if paraphrases is None))
+        if len(missing) > 0:
+            generated = dict(zip(missing, self.generate_paraphrases(missing, num_return_sequences, num_beams)))
+            for input_text in missing:
+                self.paraphrase_cache.put(paraphrase_cache_key(input_text, num_return_sequences, num_beams),
+                                          generated[input_text])
+            all_paraphrases = [generated[input_text] if paraphrases is None else paraphrases
+                               for input_text, paraphrases in zip(input_texts, all_paraphrases)]
+        return all_paraphrases
+
+    def generate_paraphrases(self, input_texts, num_return_sequences, num_beams):
+        """
+        Paraphrase texts with Pegasus, PARAPHRASE_BATCH_SIZE texts per padded `generate` call.
+        :param input_texts: list of texts.
+        :param num_return_sequences: number of paraphrases per text.
+        :param num_beams: beam size.
+        :return: list with, for each text, the list of its paraphrases.
+        """
+        all_paraphrases = []
+        for i in range(0, len(input_texts), PARAPHRASE_BATCH_SIZE):
+            batch = self.tokenizer_pegasus(input_texts[i:i + PARAPHRASE_BATCH_SIZE], truncation=True,
+                                           padding='longest', max_length=60, return_tensors="pt").to(
+                self.torch_device)
+            translated = self.model_pegasus.generate(**batch, max_length=60, num_beams=num_beams,
+                                                     num_return_sequences=num_return_sequences, temperature=1.5)
+            tgt_text = self.tokenizer_pegasus.batch_decode(translated, skip_special_tokens=True)
+            # Sequences of each input are consecutive.
+            all_paraphrases += [tgt_text[j:j + num_return_sequences]
+                                for j in range(0, len(tgt_text), num_return_sequences)]
+        return all_paraphrases
 
     # Compute the logits of the passage against the reviews
     def get_passrev_logits(self, passages, reviews):
@@ -247,10 +534,9 @@ class CARPWorkflow():
         # Softens the classifiers by using paraphrasing.
         if soften:
             if pairs:
-                review1_paraphrases = list(
-                    set(self.get_response(reviews[0], num_return_sequences=3, num_beams=3) + [reviews[0]]))
-                review2_paraphrases = list(
-                    set(self.get_response(reviews[1], num_return_sequences=3, num_beams=3) + [reviews[1]]))
+                responses = self.get_responses(reviews[:2], num_return_sequences=3, num_beams=3)
+                review1_paraphrases = list(set(responses[0] + [reviews[0]]))
+                review2_paraphrases = list(set(responses[1] + [reviews[1]]))
                 print(review1_paraphrases)
                 print(review2_paraphrases)
 
@@ -275,11 +561,134 @@ class CARPWorkflow():
 
                 if ret: return softened_logits
 
-    def __call__(self, stories, reviews, version=1):
+    def get_review_variants(self, reviews):
+        """
+        Soften reviews the same way compute_logit(pairs=False) does: each review is paraphrased, and every
+        paraphrase (and the review itself) is used with and without the `[quote]` token. Reviews are paraphrased
+        together, see get_responses().
+        :param reviews: list of reviews.
+        :return: list with, for each review, the list of its variants.
+        """
+        all_variants = []
+        for review, responses in zip(reviews, self.get_responses(reviews, num_return_sequences=3, num_beams=3)):
+            paraphrases = list(set(responses + [review]))
+            all_variants.append(list(map(lambda x: "[quote] " + x, paraphrases)) + paraphrases)
+        return all_variants
+
+    def encode_passages(self, passages):
+        """
+        Encode story lines, in one batch for the lines that are not in the embedding cache.
+        :param passages: list of strings.
+        :return: tensor [len(passages), LATENT_DIM] of normalized embeddings.
+        """
+        if self.embedding_cache is None and self.critic_store is None:
+            return self.encode_passages_uncached(passages)
+
+        embeddings = [None] * len(passages)
+        if self.critic_store is not None:
+            embeddings = [self.critic_store.get_line(passage) for passage in passages]
+            embeddings = [embedding if embedding is None else embedding.to(device=self.model.logit_scale.device,
+                                                                           dtype=self.model.logit_scale.dtype)
+                          for embedding in embeddings]
+        if self.embedding_cache is not None:
+            embeddings = [self.embedding_cache.get(passage) if embedding is None else embedding
+                          for passage, embedding in zip(passages, embeddings)]
+        missing = list(dict.fromkeys(passage for passage, embedding in zip(passages, embeddings) if embedding is None))
+        if len(missing) > 0:
+            encoded = {}
+            for passage, embedding in zip(missing, self.encode_passages_uncached(missing)):
+                # Clone, so that the cache does not keep the whole batch alive.
+                encoded[passage] = embedding.clone()
+                if self.embedding_cache is not None:
+                    self.embedding_cache.put(passage, encoded[passage])
+            embeddings = [encoded[passage] if embedding is None else embedding
+                          for passage, embedding in zip(passages, embeddings)]
+        return torch.stack(embeddings)
+
+    def encode_passages_uncached(self, passages):
+        """
+        Encode story lines, in length-bucketed batches.
+        :param passages: list of strings.
+        :return: tensor [len(passages), LATENT_DIM] of normalized embeddings.
+        """
+        return self.encode_bucketed(list(passages), self.model.encodeX)
+
+    def encode_reviews(self, reviews):
+        """
+        Encode reviews, in length-bucketed batches.
+        :param reviews: list of strings.
+        :return: tensor [len(reviews), LATENT_DIM] of normalized embeddings.
+        """
+        return self.encode_bucketed(list(reviews), self.model.encodeY)
+
+    def encode_softened_reviews(self, reviews, use_store=True):
+        """
+        Embed reviews as the mean of the embeddings of their softened variants (see get_review_variants()).
+        The score of a story line is linear in them, so scoring against this mean gives the mean of the variants'
+        scores, as compute_logit does.
+        :param reviews: list of reviews.
+        :param use_store: if True, reviews in the critic store are not softened or encoded again.
+        :return: float32 tensor [len(reviews), LATENT_DIM].
+        """
+        target_device = self.model.logit_scale.device
+        embeddings = [None] * len(reviews)
+        if use_store and self.critic_store is not None:
+            embeddings = [self.critic_store.get_critic(review) for review in reviews]
+            embeddings = [embedding if embedding is None else embedding.to(device=target_device, dtype=torch.float32)
+                          for embedding in embeddings]
+
+        missing = [review for review, embedding in zip(reviews, embeddings) if embedding is None]
+        if len(missing) > 0:
+            all_variants = self.get_review_variants(missing)
+            variant_embeddings = self.encode_reviews([variant for variants in all_variants for variant in variants])
+            owners = torch.tensor([i for i, variants in enumerate(all_variants) for _ in variants],
+                                  device=target_device)
+            counts = torch.tensor([len(variants) for variants in all_variants], dtype=torch.float32,
+                                  device=target_device)
+            averaged = torch.zeros(len(missing), variant_embeddings.shape[1], device=target_device).index_add_(
+                0, owners, variant_embeddings.type(dtype=torch.float32)) / counts.unsqueeze(1)
+            averaged = iter(averaged)
+            embeddings = [next(averaged) if embedding is None else embedding for embedding in embeddings]
+        return torch.stack(embeddings)
+
+    def score_matrix(self, passages, reviews):
+        """
+        Score every review against every story line in batch.
+        Each score is what compute_logit(passage, review, pairs=False, ret=True) gives for the pair, but every
+        distinct line and every review variant is encoded only once, and all scores come from one matmul.
+        :param passages: list of story lines (strings).
+        :param reviews: list of reviews.
+        :return: float32 tensor [len(reviews), len(passages)].
+        """
+        unique_passages = list(dict.fromkeys(passages))
+        unique_reviews = list(dict.fromkeys(reviews))
+
+        passage_embeddings = self.encode_passages(unique_passages).type(dtype=torch.float32)
+        review_embeddings = self.encode_softened_reviews(unique_reviews)
+        with torch.no_grad():
+            scores = review_embeddings @ passage_embeddings.T * self.model.logit_scale.exp().type(dtype=torch.float32)
+
+        passage_positions = {passage: i for i, passage in enumerate(unique_passages)}
+        review_positions = {review: i for i, review in enumerate(unique_reviews)}
+        return scores[[review_positions[review] for review in reviews]][
+                      :, [passage_positions[passage] for passage in passages]]
+
+    def stats(self):
+        """
+        :return: dict of cache statistics, for server metrics.
+        """
+        return {
+            "paraphrase_cache": self.paraphrase_cache.stats() if self.paraphrase_cache is not None else None,
+            "embedding_cache": self.embedding_cache.stats() if self.embedding_cache is not None else None,
+        }
+
+    def __call__(self, stories, reviews=None, version=1, k=3, scope="line"):
         if version == 1:
             return self.call_v1(stories, reviews)
         elif version == 2:
             return self.call_v2(stories, reviews)
+        elif version == 3:
+            return self.call_v3(stories, k=k, scope=scope)
 
     def call_v1(self, stories, reviews):
         """
@@ -301,19 +710,20 @@ class CARPWorkflow():
                 "Reviews have to be either a string or a list of cut sentences, not %s." % str(type(stories)))
 
         all_results = {}
-
-        for review in reviews:
-            best_score = -1000000
-            best_item = None
-            for item in stories:
-                score = self.compute_logit(item, review, pairs=False, ret=True)
-                # print("Sentence: %s, score=%s" % (item, score))
-                if score > best_score:
-                    best_score = score
-                    best_item = item
-
+        if len(reviews) == 0:
+            return all_results
+        if len(stories) == 0:
+            return {review: None for review in reviews}
+
+        # Items are one-sentence lists when cut from a string.
+        lines = [item[0] if type(item) is list else item for item in stories]
+        scores = self.score_matrix(lines, list(reviews))
+        # argmax returns the first of equal scores, as the strict comparison of the pairwise loop did.
+        best_indices = scores.argmax(dim=1).tolist()
+
+        for review, best_index in zip(reviews, best_indices):
             # print("By saying [%s], you want to apply it to %s. Right?" % (review, best_item))
-            all_results[review] = best_item
+            all_results[review] = stories[best_index]
         return all_results
 
     def call_v2(self, stories, reviews):
@@ -335,20 +745,72 @@ class CARPWorkflow():
             raise AttributeError("v2 api: Reviews has to be a dict, not %s." % str(type(stories)))
 
         all_results = {}
+        if len(reviews) == 0:
+            return all_results
+        if len(stories) == 0:
+            return {review: {} for review in reviews}
 
-        for review in reviews:  # key
+        review_list = list(reviews)
+        with torch.no_grad():
+            scores = self.score_matrix(stories, review_list) / self.model.logit_scale.exp()
+        # Compare in double precision, as the pairwise loop compared Python floats.
+        thresholds = torch.tensor([reviews[review] for review in review_list], dtype=torch.float64,
+                                  device=scores.device)
+        above = (scores.type(dtype=torch.float64) > thresholds.unsqueeze(1)).tolist()
+        scores = scores.tolist()
+
+        for i, review in enumerate(review_list):  # key
             this_result = {}
-            for item in stories:
-                score = self.compute_logit(item, review, pairs=False, ret=True)
-                score = (score / self.model.logit_scale.exp()).item()
-                print("Sentence: %s, score=%s" % (item, score))
-                if score > reviews[review]:  # value
-                    this_result[item] = score
+            for j, item in enumerate(stories):
+                if above[i][j]:  # value
+                    this_result[item] = scores[i][j]
 
             # print("By saying [%s], you want to apply it to %s. Right?" % (review, best_item))
             all_results[review] = this_result
         return all_results
 
+    def call_v3(self, stories, k=3, scope="line"):
+        """
+        v3 api, that finds the best matching critics in the critic index (the critics of the critic store).
+        :param stories: lines in the stories, or the story as a string.
+        :param k: number of critics to return for each line (or for the story).
+        :param scope: "line" to find critics for every line, "story" to find critics for the whole story.
+        :return: dict, key is each line (or the whole story), value is a dict with the k best critics as keys
+        (best first) and their scores (as in v2) as values.
+        """
+        if self.critic_index is None:
+            raise AttributeError("v3 api: no critic index, set `critic_store` in the config.")
+        if type(stories) is str:
+            story = stories
+            stories = [x for x in stories.split(".") if len(x.strip()) > 0]
+        elif type(stories) is list:
+            story = " ".join(stories)
+        else:
+            raise AttributeError(
+                "Stories have to be either a string or a list of cut sentences, not %s." % str(type(stories)))
+
+        if scope == "line":
+            passages = list(dict.fromkeys(stories))
+        elif scope == "story":
+            passages = [story]
+        else:
+            raise AttributeError("v3 api: scope has to be \"line\" or \"story\", not %s." % str(scope))
+        if len(passages) == 0 or len(self.critic_index.critics) == 0:
+            return {passage: {} for passage in passages}
+
+        with torch.no_grad():
+            # Critics are stored as means of normalized embeddings, so these are v2 scores (without logit scale).
+            scores, indices = self.critic_index.search(self.encode_passages(passages).type(dtype=torch.float32),
+                                                       int(k))
+        scores = scores.tolist()
+        indices = indices.tolist()
+
+        all_results = {}
+        for i, passage in enumerate(passages):
+            all_results[passage] = {self.critic_index.critics[index]: score
+                                    for index, score in zip(indices[i], scores[i]) if index >= 0}
+        return all_results
+
 
 #
 #
@@ -0,0 +1,94 @@
+"""
+critic_index.py
+
+Top-k retrieval of critics for the CARP v3 api.
+
+Critics are embedded as in critic_store.py, so the score of a critic for a story embedding is their dot product.
+Up to `exact_limit` critics, all scores come from one matmul. Larger libraries use an inverted file index:
+critics are clustered with k-means on their directions, and a query only scores the critics of the `num_probes`
+clusters whose centroids match it best, so lookup cost grows with about the square root of the library size.
+"""
+
+import math
+
+import torch
+import torch.nn.functional as F
+
+
+class CriticIndex:
+    """
+    Index of critic embeddings, searched by dot product.
+    """
+
+    def __init__(self, critics, embeddings, exact_limit=4096, num_probes=8, iterations=10, seed=0):
+        """
+        Build the index.
+        :param critics: list of critic texts.
+        :param embeddings: float32 tensor [len(critics), LATENT_DIM], on the device used for search.
+        :param exact_limit: above this many critics, search is approximate (inverted file index).
+        :param num_probes: number of clusters scored per query in approximate search.
+        :param iterations: k-means iterations.
+        :param seed: seed of the k-means initialization.
+        """
+        self.critics = list(critics)
+        self.embeddings = embeddings
+        self.num_probes = num_probes
+
+        # Inverted file: centroids [num_lists, LATENT_DIM], and critic indices of each list, padded with -1.
+        self.centroids = None
+        self.lists = None
+        if len(self.critics) > exact_limit:
+            self._build_lists(int(math.sqrt(len(self.critics))), iterations, seed)
+
+    def _build_lists(self, num_lists, iterations, seed):
+        """
+        Cluster critics (spherical k-means) into inverted lists.
+        :return: None.
+        """
+        directions = F.normalize(self.embeddings)
+        generator = torch.Generator().manual_seed(seed)
+        first = torch.randperm(len(self.critics), generator=generator)[:num_lists].to(directions.device)
+        centroids = directions[first]
+        for _ in range(iterations):
+            assignment = (directions @ centroids.T).argmax(dim=1)
+            sums = torch.zeros_like(centroids).index_add_(0, assignment, directions)
+            counts = torch.bincount(assignment, minlength=num_lists)
+            # Empty clusters keep their centroid.
+            centroids = torch.where((counts > 0).unsqueeze(1), F.normalize(sums), centroids)
+        assignment = (directions @ centroids.T).argmax(dim=1)
+
+        counts = torch.bincount(assignment, minlength=num_lists)
+        order = assignment.argsort()
+        starts = counts.cumsum(0) - counts
+        ranks = torch.arange(len(self.critics), device=order.device) - starts[assignment[order]]
+        lists = torch.full((num_lists, int(counts.max())), -1, dtype=torch.long, device=order.device)
+        lists[assignment[order], ranks] = order
+
+        self.centroids = centroids
+        self.lists = lists
+        print("Critic index: %s critics in %s lists (at most %s per list)." % (len(self.critics), num_lists,
+                                                                             lists.shape[1]))
+
+    def search(self, queries, k):
+        """
+        Find the best critics for each query.
+        :param queries: float32 tensor [n, LATENT_DIM].
+        :param k: number of critics per query.
+        :return: (scores [n, k], critic indices [n, k]); if a query has fewer than k candidates (approximate search),
+        missing entries have index -1 and score -inf.
+        """
+        k = min(k, len(self.critics))
+        if self.centroids is None:
+            return (queries @ self.embeddings.T).topk(k, dim=1)
+
+        probes = (F.normalize(queries) @ self.centroids.T).topk(min(self.num_probes, len(self.centroids)), dim=1)
+        all_scores = torch.full((len(queries), k), -math.inf, device=queries.device)
+        all_indices = torch.full((len(queries), k), -1, dtype=torch.long, device=queries.device)
+        # One query at a time, so only the candidates of one query are gathered at once.
+        for i, query in enumerate(queries):
+            candidates = self.lists[probes.indices[i]].flatten()
+            candidates = candidates[candidates >= 0]
+            scores, positions = (self.embeddings[candidates] @ query).topk(min(k, len(candidates)))
+            all_scores[i, :len(scores)] = scores
+            all_indices[i, :len(scores)] = candidates[positions]
+        return all_scores, all_indices
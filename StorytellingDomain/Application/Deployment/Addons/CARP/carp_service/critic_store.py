@@ -0,0 +1,129 @@
+"""
+critic_store.py
+
+Precomputed embeddings of a critic library, memory-mapped at startup.
+
+A review is scored through the mean of its softened variants' embeddings (paraphrases, with and without `[quote]`),
+since the score of a story line is linear in them. For known critics, the build command computes this mean once
+(Pegasus softening and the review encoder) and stores it, so that requests using them skip both.
+Fixed story-side texts (e.g. communication descriptions matched against free text) can be stored too.
+
+Embeddings are written with mmap_weights.export_weights(), so workers on the same machine share them.
+
+Build with:
+    python -m StorytellingDomain.Application.Deployment.Addons.CARP.carp_service.critic_store <CARP checkpoint> <output dir> [critics file] [lines file]
+(files have one text per line; critics default to CARPCriticList.default_critic) and set `critic_store` to
+the output dir in the CARP config.
+"""
+
+import json
+import os
+import sys
+
+import torch
+
+from StorytellingDomain.Application.Deployment.Addons.mmap_weights import export_weights, load_weights
+
+TEXTS_FILE = "texts.json"
+
+# Number of texts encoded per batch while building.
+BUILD_BATCH_SIZE = 64
+
+
+class CriticStore:
+    """
+    Read-only lookup of precomputed critic (review side) and line (story side) embeddings by text.
+    """
+
+    def __init__(self, store_dir, carp_model_path=None):
+        """
+        Map a store written by build_critic_store().
+        :param store_dir: directory of the store.
+        :param carp_model_path: (optional) CARP checkpoint the embeddings will be scored against. Embeddings from
+        another checkpoint are meaningless there, so a store built with another one is refused (ValueError).
+        """
+        with open(os.path.join(store_dir, TEXTS_FILE)) as f:
+            texts = json.load(f)
+        if carp_model_path is not None:
+            if texts.get("carp_model_path") is None:
+                print("Warning! Critic store %s does not record its CARP checkpoint, assuming %s." %
+                      (store_dir, carp_model_path))
+            elif os.path.abspath(texts["carp_model_path"]) != os.path.abspath(carp_model_path):
+                raise ValueError("Critic store %s was built with %s, not %s." %
+                                 (store_dir, texts["carp_model_path"], carp_model_path))
+        weights = load_weights(store_dir)
+
+        self.critics = weights.get("critics")
+        self.lines = weights.get("lines")
+        self.critic_positions = {text: i for i, text in enumerate(texts["critics"])}
+        self.line_positions = {text: i for i, text in enumerate(texts["lines"])}
+        print("Mapped %s critics and %s lines from %s." % (len(self.critic_positions), len(self.line_positions),
+                                                           store_dir))
+
+    def get_critic(self, text):
+        """
+        :param text: review.
+        :return: mean embedding of its softened variants (float32, on CPU), or None if unknown.
+        """
+        if text not in self.critic_positions:
+            return None
+        return self.critics[self.critic_positions[text]]
+
+    def get_line(self, text):
+        """
+        :param text: story line.
+        :return: its embedding (float32, on CPU), or None if unknown.
+        """
+        if text not in self.line_positions:
+            return None
+        return self.lines[self.line_positions[text]]
+
+
+def build_critic_store(workflow, critics, output_dir, lines=None):
+    """
+    Soften and encode a critic library (and optionally story-side lines) and write it as a store.
+    :param workflow: CARPWorkflow with models loaded.
+    :param critics: list of reviews.
+    :param output_dir: directory to write the store into.
+    :param lines: (optional) list of story-side texts.
+    :return: None.
+    """
+    critics = list(dict.fromkeys(critics))
+    lines = list(dict.fromkeys(lines)) if lines is not None else []
+
+    weights = {}
+    if len(critics) > 0:
+        weights["critics"] = torch.cat([workflow.encode_softened_reviews(critics[i:i + BUILD_BATCH_SIZE],
+                                                                         use_store=False).cpu()
+                                        for i in range(0, len(critics), BUILD_BATCH_SIZE)])
+    if len(lines) > 0:
+        weights["lines"] = torch.cat([workflow.encode_passages_uncached(lines[i:i + BUILD_BATCH_SIZE]).float().cpu()
+                                      for i in range(0, len(lines), BUILD_BATCH_SIZE)])
+
+    export_weights(weights, output_dir)
+    with open(os.path.join(output_dir, TEXTS_FILE), "w") as f:
+        json.dump({"critics": critics, "lines": lines, "carp_model_path": workflow.carp_path}, f)
+
+
+def read_texts(path):
+    """
+    :param path: text file, one text per line.
+    :return: list of non-empty lines.
+    """
+    with open(path) as f:
+        return [line.strip() for line in f if len(line.strip()) > 0]
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        print(__doc__)
+        sys.exit(1)
+
+    from StorytellingDomain.Application.Deployment.Addons.CARP.carp_service.carp import CARPWorkflow
+    from StorytellingDomain.Application.Instances.Communications.StoryContext.CARP.CARPCriticList import \
+        get_default_critics
+
+    critic_list = read_texts(sys.argv[3]) if len(sys.argv) > 3 else get_default_critics()
+    line_list = read_texts(sys.argv[4]) if len(sys.argv) > 4 else None
+    build_critic_store(CARPWorkflow({"carp_model_path": sys.argv[1]}),
+                       critic_list, sys.argv[2], lines=line_list)
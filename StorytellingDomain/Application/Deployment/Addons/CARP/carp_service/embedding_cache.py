@@ -0,0 +1,89 @@
+"""
+embedding_cache.py
+
+Cache of CARP story line embeddings.
+
+Clients send the whole story on every call, but usually only one line changed since the last one. Embeddings are
+kept by a hash of the line text, in an LRU bounded by memory, so that only new or edited lines are encoded.
+"""
+
+import hashlib
+import threading
+from collections import OrderedDict
+
+
+class EmbeddingCache:
+    """
+    LRU of embeddings by text hash, bounded by the memory they take.
+    """
+
+    def __init__(self, max_bytes=64 * 2 ** 20):
+        """
+        :param max_bytes: maximum total size of cached embeddings.
+        """
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def key(text):
+        """
+        :param text: encoded text.
+        :return: hex digest.
+        """
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def get(self, text):
+        """
+        :param text: encoded text.
+        :return: its embedding, or None if missing.
+        """
+        key = self.key(text)
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+    def put(self, text, embedding):
+        """
+        Store an embedding, evicting the least recently used ones if needed.
+        :param text: encoded text.
+        :param embedding: 1D tensor. Rows of a batch should be cloned first, or the whole batch stays in memory.
+        :return: None.
+        """
+        key = self.key(text)
+        with self.lock:
+            if key in self.entries:
+                self.size -= self._size_of(self.entries.pop(key))
+            self.entries[key] = embedding
+            self.size += self._size_of(embedding)
+            while self.size > self.max_bytes and len(self.entries) > 0:
+                self.size -= self._size_of(self.entries.popitem(last=False)[1])
+                self.evictions += 1
+
+    @staticmethod
+    def _size_of(embedding):
+        return embedding.numel() * embedding.element_size()
+
+    def stats(self):
+        """
+        :return: dict of cache statistics.
+        """
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "bytes": self.size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups > 0 else 0,
+            }
@@ -0,0 +1,84 @@
+"""
+benchmark_devices.py
+
+Compare CARP serving settings (device and precision, see CARPWorkflow) on scoring a 10-line story against the
+default critic set:
+- speed: time of the first call (which includes Pegasus softening of every critic) and of later calls
+  (paraphrases cached), as calls and scored pairs per second;
+- fidelity: largest score difference with CPU fp32, and how often both pick the same best line for a critic.
+
+The embedding cache is disabled so that every call encodes the story again.
+
+Usage: python benchmark_devices.py [CARP checkpoint location] [settings...]
+where settings are device:precision, e.g. cpu:fp32 cpu:bf16 cpu:int8 cuda:fp16 (default: the three CPU settings,
+plus cuda:fp16 if a GPU is available).
+"""
+
+import sys
+import time
+
+import torch
+
+from StorytellingDomain.Application.Deployment.Addons.CARP.carp_service.carp import CARPWorkflow, \
+    CARP_MODEL_LOCATION
+from StorytellingDomain.Application.Instances.Communications.StoryContext.CARP.CARPCriticList import \
+    get_default_critics
+
+story = ["Jon was a little boy who lived in a small village.",
+         "Every morning he walked to the river with his dog.",
+         "One day the river was gone.",
+         "He followed the dry riverbed up into the mountains.",
+         "There he found a giant sleeping across the water.",
+         "Jon woke the giant up and asked him to move.",
+         "The giant laughed and rolled over.",
+         "The river came rushing back to the village.",
+         "The villagers could fish again.",
+         "Everyone cheered when Jon came home."]
+
+
+def benchmark(carp_path, device, precision, repeats=10):
+    """
+    :return: (scores of the last call on CPU, seconds of the first call, seconds per later call).
+    """
+    workflow = CARPWorkflow({"carp_model_path": carp_path, "device": device, "precision": precision,
+                             "embedding_cache_mb": 0})
+    critics = get_default_critics()
+
+    start = time.perf_counter()
+    workflow.score_matrix(story, critics)
+    first_call = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for _ in range(repeats):
+        scores = workflow.score_matrix(story, critics)
+    if workflow.torch_device.type == "cuda":
+        torch.cuda.synchronize()
+    per_call = (time.perf_counter() - start) / repeats
+    return scores.float().cpu(), first_call, per_call
+
+
+def main():
+    carp_path = sys.argv[1] if len(sys.argv) > 1 else CARP_MODEL_LOCATION
+    settings = [setting.split(":") for setting in sys.argv[2:]]
+    if len(settings) == 0:
+        settings = [["cpu", "fp32"], ["cpu", "bf16"], ["cpu", "int8"]]
+        if torch.cuda.is_available():
+            settings.append(["cuda", "fp16"])
+
+    reference = None
+    pairs = len(story) * len(get_default_critics())
+    for device, precision in settings:
+        scores, first_call, per_call = benchmark(carp_path, device, precision)
+        if reference is None:
+            reference = scores if (device, precision) == ("cpu", "fp32") else \
+                benchmark(carp_path, "cpu", "fp32", repeats=1)[0]
+        difference = (scores - reference).abs().max().item()
+        same_best = (scores.argmax(dim=1) == reference.argmax(dim=1)).float().mean().item()
+        print("%s %s: first call %.2fs, then %.1f ms/call (%.1f calls/s, %.0f pairs/s); "
+              "max score difference %.4f, same best line %.0f%%."
+              % (device, precision, first_call, per_call * 1000, 1 / per_call, pairs / per_call, difference,
+                 same_best * 100))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,52 @@
+"""
+check_batched_scoring.py
+
+Check that the batched scoring engine (CARPWorkflow.score_matrix, used by the v1 and v2 APIs) gives the same
+scores as scoring every (review, story line) pair separately with compute_logit, and compare their speed.
+
+Usage: python check_batched_scoring.py [CARP checkpoint location]
+"""
+
+import sys
+import time
+
+import torch
+
+from StorytellingDomain.Application.Deployment.Addons.CARP.carp_service.carp import CARPWorkflow, \
+    CARP_MODEL_LOCATION
+
+story = ["Jon was a little boy who lived in a small village.",
+         "Every morning he walked to the river with his dog.",
+         "One day the river was gone.",
+         "He followed the dry riverbed up into the mountains.",
+         "There he found a giant sleeping across the water.",
+         "Jon woke the giant up and asked him to move.",
+         "The giant laughed and rolled over.",
+         "The river came rushing back to the village.",
+         "The villagers could fish again.",
+         "Everyone cheered when Jon came home."]
+reviews = ["This story is sad.", "There should be more dialogue.", "The ending is too abrupt."]
+
+
+def main():
+    workflow = CARPWorkflow({"carp_model_path": sys.argv[1] if len(sys.argv) > 1 else CARP_MODEL_LOCATION})
+
+    start = time.perf_counter()
+    pairwise = torch.tensor([[workflow.compute_logit([line], review, pairs=False, ret=True).item()
+                              for line in story] for review in reviews])
+    pairwise_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    batched = workflow.score_matrix(story, reviews).cpu()
+    batched_time = time.perf_counter() - start
+
+    difference = (pairwise - batched).abs().max().item()
+    print("Pairwise: %.2fs, batched: %.2fs." % (pairwise_time, batched_time))
+    print("Max score difference: %.5f (scores are scaled by %.2f)." % (difference,
+                                                                        workflow.model.logit_scale.exp().item()))
+    same_best = (pairwise.argmax(dim=1) == batched.argmax(dim=1)).all().item()
+    print("Same best line for every review: %s" % same_best)
+
+
+if __name__ == '__main__':
+    main()
@@ -4,17 +4,39 @@ endpoint.py
 Endpoint for Plug & Blend Tool.
 """
 from StorytellingDomain.Application.Deployment.Addons.CARP.carp_service.carp import CARPWorkflow
+from StorytellingDomain.Application.Deployment.Addons.startup import ModelLoader
+
+# Request used for warm-up if `warmup` is set and no `warmup_request` is given.
+DEFAULT_WARMUP_REQUEST = {
+    "stories": "I woke up in the morning. It was really cold outside.",
+    "reviews": {"This story should be in afternoon.": 0},
+    "version": 2,
+}
 
 
 class CARPTool:
     def __init__(self, config):
-        self.workflow = CARPWorkflow(config)
+        # See PNBTool for `background_load`, `warmup` and `warmup_request`.
+        self.loader = ModelLoader("carp", background=config.get('background_load', False))
+        self.workflow = CARPWorkflow(config, loader=self.loader)
+        warmup_function = None
+        if config.get('warmup', False):
+            warmup_request = config.get('warmup_request', DEFAULT_WARMUP_REQUEST)
+            warmup_function = lambda: self.run(dict(warmup_request))
+        self.loader.finish(warmup_function)
+        self.loader.metrics_function = self.workflow.stats
 
     def __call__(self, body):
-        if "stories" not in body or "reviews" not in body:
-            raise AttributeError("Bad request.")
+        self.loader.wait()
+        return self.run(body)
+
+    def run(self, body):
         if "version" not in body:
             version = 1
         else:
             version = int(body["version"])
-        return self.workflow(stories=body['stories'], reviews=body["reviews"], version=version)
+        # v3 (critic retrieval) takes `k` and `scope` instead of reviews.
+        if "stories" not in body or ("reviews" not in body and version != 3):
+            raise AttributeError("Bad request.")
+        return self.workflow(stories=body['stories'], reviews=body.get("reviews"), version=version,
+                             k=int(body.get("k", 3)), scope=body.get("scope", "line"))
@@ -3,12 +3,80 @@ endpoint.py
 
 Endpoint for Plug & Blend Tool.
 """
+from StorytellingDomain.Application.Deployment.Addons.PNB.pnb2.batching import PNBBatchScheduler
 from StorytellingDomain.Application.Deployment.Addons.PNB.pnb2.pnb_logits_processor import PNBWorkflow
+from StorytellingDomain.Application.Deployment.Addons.PNB.pnb2.story import generate_story
+from StorytellingDomain.Application.Deployment.Addons.PNB.stream_server import PNBStreamServer
+from StorytellingDomain.Application.Deployment.Addons.startup import ModelLoader
+
+# Request used for warm-up if `warmup` is set and no `warmup_request` is given.
+DEFAULT_WARMUP_REQUEST = {
+    "sentence": "Story for kids: Once upon a time, ",
+    "topic": {"Science": 1},
+    "prefix": "Story for kids: Once upon a time, ",
+}
 
 
 class PNBTool:
     def __init__(self, config):
-        self.workflow = PNBWorkflow(config)
+        # With `background_load`, models load in parallel threads and the server starts right away;
+        # requests wait until loading (and warm-up, if `warmup` is set) is done.
+        self.loader = ModelLoader("pnb", background=config.get('background_load', False))
+        self.workflow = PNBWorkflow(config, loader=self.loader)
+        warmup_function = None
+        if config.get('warmup', False):
+            warmup_request = config.get('warmup_request', DEFAULT_WARMUP_REQUEST)
+            warmup_function = lambda: self.workflow(warmup_request)
+        self.loader.finish(warmup_function)
+
+        # Batch concurrent requests into one `generate` call if `batch_window` (seconds) is set.
+        self.scheduler = None
+        if config.get('batch_window', 0) > 0:
+            self.scheduler = PNBBatchScheduler(self.workflow,
+                                               batch_window=config['batch_window'],
+                                               max_batch_size=config.get('max_batch_size', 8))
+
+        self.loader.metrics_function = self.metrics
+
+        # Serve streamed routes (e.g. /api/pnb_story) on a separate port if `stream_port` is set.
+        self.stream_server = None
+        if 'stream_port' in config:
+            self.stream_server = PNBStreamServer(self, port=config['stream_port'])
+            self.stream_server.start_server()
+
+    def metrics(self):
+        """
+        :return: dict of runtime metrics (caches and batching), reported by the status tool.
+        """
+        metrics = self.workflow.stats()
+        if self.scheduler is not None:
+            metrics["batches"] = self.scheduler.batch_count
+            metrics["batched_requests"] = self.scheduler.request_count
+        return metrics
 
     def __call__(self, body):
+        self.loader.wait()
+        if self.scheduler is not None:
+            return self.scheduler(body)
         return self.workflow(body)
+
+    def stream(self, body):
+        """
+        Generate one sentence, streaming the partial text while decoding. The request is still batched with
+        other sessions' requests.
+        :param body: see PNBWorkflow.
+        :return: generator of events, see PNBWorkflow.stream().
+        """
+        if not isinstance(body, dict):
+            raise AttributeError("Bad request.")
+        self.loader.wait()
+        return self.workflow.stream(body, generate_function=self.scheduler)
+
+    def story(self, body):
+        """
+        Generate a whole story server-side. Sentences still go through __call__, so they are batched with
+        other sessions' requests.
+        :param body: see generate_story().
+        :return: generator of per-sentence results.
+        """
+        return generate_story(body, self, stream_sentence=self.stream)
@@ -0,0 +1,239 @@
+"""
+batch_sampling.py
+
+Decoding loop of PNBWorkflow, where every request of a batch finishes on its own.
+
+`generate()` runs a batch until its last row is done, so a request whose first sentence is short waits for the
+longest one of its batch, and keeps paying for its rows meanwhile. Here, rows are grouped by request: as soon as
+a request is finished (its first sentence is done, its beams are done, or its token budget is spent), its output
+is handed over and its rows are sliced out of the batch, model states and logits processors included.
+
+Each step follows `generate(do_sample=True)` of transformers 4.16: beam sampling (log-softmax, logits processors,
+beam scores, top-k, sampling over all beams of a candidate, BeamSearchScorer) with several beams, and plain
+sampling with one. Until a request drops out, outputs are the same as `generate()` for the same random state.
+"""
+
+import torch
+from transformers import LogitsProcessorList, RepetitionPenaltyLogitsProcessor, NoRepeatNGramLogitsProcessor, \
+    NoBadWordsLogitsProcessor, MinLengthLogitsProcessor, TopKLogitsWarper, BeamSearchScorer
+
+
+class BatchSampler:
+    """
+    Samples candidates for every request of a (left-padded) batch with the sampling settings of PNBWorkflow.
+
+    Rows of a request are [candidate][beam], like `generate(num_return_sequences=..., num_beams=...)`.
+    """
+
+    def __init__(self, model, num_beams=2, repetition_penalty=1.2, no_repeat_ngram_size=2, bad_words_ids=None,
+                 min_new_tokens=8, top_k=50, length_penalty=0.8, pad_token_id=50256, eos_token_id=50256):
+        """
+        :param model: base model.
+        :param num_beams: beams per candidate; 1 for plain sampling.
+        :param repetition_penalty: see transformers.RepetitionPenaltyLogitsProcessor.
+        :param no_repeat_ngram_size: see transformers.NoRepeatNGramLogitsProcessor.
+        :param bad_words_ids: (optional) list of banned token id sequences.
+        :param min_new_tokens: eos is banned before this many new tokens.
+        :param top_k: only sample among the top_k tokens (0 to disable).
+        :param length_penalty: exponent of the length normalizing candidate scores.
+        :param pad_token_id: padding token, appended to rows that are done.
+        :param eos_token_id: end of text token.
+        """
+        self.model = model
+        self.num_beams = num_beams
+        self.repetition_penalty = repetition_penalty
+        self.no_repeat_ngram_size = no_repeat_ngram_size
+        self.bad_words_ids = bad_words_ids
+        self.min_new_tokens = min_new_tokens
+        self.top_k = top_k
+        self.length_penalty = length_penalty
+        self.pad_token_id = pad_token_id
+        self.eos_token_id = eos_token_id
+
+    def _processors(self, prompt_length):
+        # Same order as `generate()`; processors passed to generate() come after these.
+        processors = LogitsProcessorList()
+        if self.repetition_penalty is not None and self.repetition_penalty != 1:
+            processors.append(RepetitionPenaltyLogitsProcessor(penalty=self.repetition_penalty))
+        if self.no_repeat_ngram_size:
+            processors.append(NoRepeatNGramLogitsProcessor(self.no_repeat_ngram_size))
+        if self.bad_words_ids:
+            processors.append(NoBadWordsLogitsProcessor(self.bad_words_ids, self.eos_token_id))
+        if self.min_new_tokens:
+            processors.append(MinLengthLogitsProcessor(prompt_length + self.min_new_tokens, self.eos_token_id))
+        return processors
+
+    @staticmethod
+    def _select_rows(past, rows):
+        return tuple(tuple(item.index_select(0, rows.to(item.device)) for item in layer) for layer in past)
+
+    def generate(self, input_ids, attention_mask, num_return_sequences, max_new_tokens, logits_processor=None,
+                 past=None, sentence_end=None, step_callbacks=None, done_callback=None):
+        """
+        Sample `num_return_sequences` candidates for every request.
+        :param input_ids: prompts, [request, seq]; left-padded.
+        :param attention_mask: [request, seq].
+        :param num_return_sequences: candidates per request.
+        :param max_new_tokens: token budget of each request.
+        :param logits_processor: (optional) PlugAndBlendFusedLogitsProcessor, applied after the sampling processors.
+        Finished requests are dropped from it with keep_entries().
+        :param past: (optional) past_key_values of all but the last prompt token, already expanded to
+        [request * candidates * beams, ...].
+        :param sentence_end: (optional) SentenceBoundaryStoppingCriteria with rows_per_request set to
+        candidates * beams; a request is finished once all its rows have finished their first sentence.
+        :param step_callbacks: (optional) list with, for each request, None or a function called at every step with
+        the token ids generated so far (first row), and once more with those of the first candidate when done.
+        :param done_callback: (optional) function taking (request index, result), called as soon as a request is
+        finished, while the rest of the batch is still decoding.
+        :return: list of results, one per request: dict with "sequences" (LongTensor [candidate, seq], prompt
+        included), "scores" (list of length-normalized log-probabilities, one per candidate) and
+        "generated_tokens" (decoding steps the request took).
+        """
+        request_count, prompt_length = input_ids.shape
+        num_beams = self.num_beams
+        expansion = num_return_sequences * num_beams
+        max_length = prompt_length + max_new_tokens
+        if step_callbacks is None:
+            step_callbacks = [None] * request_count
+
+        input_ids = input_ids.repeat_interleave(expansion, dim=0)
+        attention_mask = attention_mask.repeat_interleave(expansion, dim=0)
+        processors = self._processors(prompt_length)
+        if logits_processor is not None:
+            processors.append(logits_processor)
+        warper = LogitsProcessorList()
+        if self.top_k:
+            warper.append(TopKLogitsWarper(top_k=self.top_k, min_tokens_to_keep=2 if num_beams > 1 else 1))
+
+        # Index (in the batch passed in) of every request still decoding.
+        active = list(range(request_count))
+        row_device = input_ids.device
+        scorers = None
+        if num_beams > 1:
+            scorers = [BeamSearchScorer(batch_size=num_return_sequences, num_beams=num_beams, device=row_device,
+                                        length_penalty=self.length_penalty) for _ in active]
+            beam_scores = torch.zeros(input_ids.shape[0], device=row_device)
+        else:
+            # Log-probability of the tokens sampled so far, and whether each row is still before eos.
+            beam_scores = torch.zeros(input_ids.shape[0], device=row_device)
+            unfinished = torch.ones(input_ids.shape[0], dtype=torch.long, device=row_device)
+            lengths = torch.full((input_ids.shape[0],), prompt_length, dtype=torch.long, device=row_device)
+
+        results = [None] * request_count
+        with torch.no_grad():
+            while True:
+                model_inputs = self.model.prepare_inputs_for_generation(input_ids, past=past,
+                                                                        attention_mask=attention_mask,
+                                                                        use_cache=True)
+                outputs = self.model(**model_inputs, return_dict=True)
+                next_token_logits = outputs.logits[:, -1, :]
+                past = outputs.past_key_values
+
+                if num_beams > 1:
+                    next_token_scores = torch.log_softmax(next_token_logits, dim=-1)
+                    next_token_scores = processors(input_ids, next_token_scores)
+                    next_token_scores = next_token_scores + beam_scores[:, None].expand_as(next_token_scores)
+                    next_token_scores = warper(input_ids, next_token_scores)
+
+                    # Sample among all beams of each candidate.
+                    vocab_size = next_token_scores.shape[-1]
+                    next_token_scores = next_token_scores.view(-1, num_beams * vocab_size)
+                    probs = torch.softmax(next_token_scores, dim=-1)
+                    next_tokens = torch.multinomial(probs, num_samples=2 * num_beams)
+                    next_token_scores = torch.gather(next_token_scores, -1, next_tokens)
+                    next_token_scores, order = torch.sort(next_token_scores, descending=True, dim=1)
+                    next_tokens = torch.gather(next_tokens, -1, order)
+                    next_indices = torch.div(next_tokens, vocab_size, rounding_mode="floor")
+                    next_tokens = next_tokens % vocab_size
+
+                    # Each request has its own scorer, so that it can be finalized on its own.
+                    beam_scores, beam_next_tokens, beam_rows = [], [], []
+                    for position, scorer in enumerate(scorers):
+                        rows = slice(position * expansion, (position + 1) * expansion)
+                        groups = slice(position * num_return_sequences, (position + 1) * num_return_sequences)
+                        beam_outputs = scorer.process(input_ids[rows], next_token_scores[groups],
+                                                      next_tokens[groups], next_indices[groups],
+                                                      pad_token_id=self.pad_token_id,
+                                                      eos_token_id=self.eos_token_id)
+                        beam_scores.append(beam_outputs["next_beam_scores"])
+                        beam_next_tokens.append(beam_outputs["next_beam_tokens"])
+                        beam_rows.append(beam_outputs["next_beam_indices"] + position * expansion)
+                    beam_scores = torch.cat(beam_scores)
+                    beam_rows = torch.cat(beam_rows)
+                    input_ids = torch.cat([input_ids[beam_rows, :], torch.cat(beam_next_tokens).unsqueeze(-1)], dim=-1)
+                    past = self._select_rows(past, beam_rows)
+                else:
+                    next_token_scores = processors(input_ids, next_token_logits)
+                    next_token_scores = warper(input_ids, next_token_scores)
+                    probs = torch.softmax(next_token_scores, dim=-1)
+                    next_tokens = torch.multinomial(probs, num_samples=1).squeeze(1)
+                    token_log_probs = torch.log(probs.gather(-1, next_tokens.unsqueeze(-1)).squeeze(-1))
+                    beam_scores = beam_scores + token_log_probs * unfinished
+                    lengths = lengths + unfinished
+
+                    next_tokens = next_tokens * unfinished + self.pad_token_id * (1 - unfinished)
+                    input_ids = torch.cat([input_ids, next_tokens.unsqueeze(-1)], dim=-1)
+                    unfinished = unfinished.mul((next_tokens != self.eos_token_id).long())
+
+                attention_mask = torch.cat([attention_mask, attention_mask.new_ones((attention_mask.shape[0], 1))],
+                                           dim=-1)
+
+                # Requests that are finished after this step.
+                finished = [input_ids.shape[-1] >= max_length] * len(active)
+                if sentence_end is not None:
+                    finished = [a or b for a, b in zip(finished, sentence_end.update(input_ids))]
+                for position in range(len(active)):
+                    if num_beams > 1:
+                        finished[position] = finished[position] or scorers[position].is_done
+                    else:
+                        rows = unfinished[position * expansion:(position + 1) * expansion]
+                        finished[position] = finished[position] or not bool(rows.any())
+
+                for position, request in enumerate(active):
+                    rows = slice(position * expansion, (position + 1) * expansion)
+                    if not finished[position]:
+                        if step_callbacks[request] is not None:
+                            step_callbacks[request](input_ids[rows.start, prompt_length:].tolist())
+                        continue
+                    if num_beams > 1:
+                        sequence_outputs = scorers[position].finalize(
+                            input_ids[rows], beam_scores[rows], None, None, max_length=max_length,
+                            pad_token_id=self.pad_token_id, eos_token_id=self.eos_token_id)
+                        sequences = sequence_outputs["sequences"]
+                        scores = sequence_outputs["sequence_scores"]
+                    else:
+                        # Same normalization as beam hypotheses: by sequence length, prompt included.
+                        sequences = input_ids[rows]
+                        scores = beam_scores[rows] / lengths[rows].float() ** self.length_penalty
+                    results[request] = {"sequences": sequences, "scores": scores.tolist(),
+                                        "generated_tokens": input_ids.shape[-1] - prompt_length}
+                    if step_callbacks[request] is not None:
+                        step_callbacks[request](sequences[0, prompt_length:].tolist())
+                    if done_callback is not None:
+                        done_callback(request, results[request])
+
+                kept = [position for position in range(len(active)) if not finished[position]]
+                if len(kept) == 0:
+                    break
+                if len(kept) == len(active):
+                    continue
+
+                # Slice finished requests out of the batch.
+                kept_rows = torch.cat([torch.arange(position * expansion, (position + 1) * expansion)
+                                       for position in kept]).to(row_device)
+                input_ids = input_ids.index_select(0, kept_rows)
+                attention_mask = attention_mask.index_select(0, kept_rows)
+                beam_scores = beam_scores.index_select(0, kept_rows)
+                past = self._select_rows(past, kept_rows)
+                if num_beams > 1:
+                    scorers = [scorers[position] for position in kept]
+                else:
+                    unfinished = unfinished.index_select(0, kept_rows)
+                    lengths = lengths.index_select(0, kept_rows)
+                if logits_processor is not None:
+                    logits_processor.keep_entries(kept)
+                if sentence_end is not None:
+                    sentence_end.keep_requests(kept)
+                active = [active[position] for position in kept]
+
+        return results
@@ -0,0 +1,111 @@
+"""
+batching.py
+
+Dynamic micro-batching for PNBWorkflow.
+
+Requests arriving within a small time window are collected and run as one padded `generate` call,
+so concurrent sessions share the model instead of queueing behind each other.
+"""
+
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+
+class PNBBatchScheduler:
+    """
+    Sits in front of a PNBWorkflow and batches requests that arrive close to each other.
+
+    Callers block in __call__ until their own row is generated (not the whole batch: finished requests leave the
+    batch early), so this can be used in place of the workflow.
+    """
+
+    def __init__(self, workflow, batch_window=0.05, max_batch_size=8):
+        """
+        Create a scheduler and start its worker thread.
+        :param workflow: PNBWorkflow (anything with generate_batch() and batch_key()).
+        :param batch_window: seconds to wait for more requests after the first one arrives.
+        :param max_batch_size: maximum number of requests in one `generate` call.
+        """
+        self.workflow = workflow
+        self.batch_window = batch_window
+        self.max_batch_size = max_batch_size
+
+        self.request_queue = queue.Queue()
+
+        # Statistics, for reporting.
+        self.batch_count = 0
+        self.request_count = 0
+
+        self.worker = threading.Thread(target=self._run, daemon=True)
+        self.worker.start()
+
+    def __call__(self, body, step_callback=None):
+        """
+        Queue a request and wait for its response.
+        :param body: request body, see PNBWorkflow.
+        :param step_callback: (optional) function called with the generated token ids at every decoding step,
+        see PNBWorkflow.generate_batch().
+        :return: response for this request.
+        """
+        future = Future()
+        self.request_queue.put((body, future, step_callback))
+        return future.result()
+
+    def _collect(self):
+        """
+        Block until a request arrives, then keep collecting until the window closes or the batch is full.
+        :return: list of (body, future, step_callback).
+        """
+        pending = [self.request_queue.get()]
+        deadline = time.monotonic() + self.batch_window
+        while len(pending) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                pending.append(self.request_queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return pending
+
+    def _run(self):
+        while True:
+            pending = self._collect()
+
+            # Only requests with matching decode settings can share a `generate` call.
+            groups = {}
+            for body, future, step_callback in pending:
+                try:
+                    key = self.workflow.batch_key(body)
+                except Exception as e:
+                    future.set_exception(e)
+                    continue
+                groups.setdefault(key, []).append((body, future, step_callback))
+
+            for group in groups.values():
+                self._run_group(group)
+
+    def _run_group(self, group):
+        """
+        Run one batch and hand every caller its own row as soon as it is ready.
+        :param group: list of (body, future, step_callback) sharing a batch key.
+        :return: None.
+        """
+        bodies = [body for body, _, _ in group]
+        try:
+            responses = self.workflow.generate_batch(bodies, [step_callback for _, _, step_callback in group],
+                                                     [future.set_result for _, future, _ in group])
+        except Exception as e:
+            print("Batch of %s failed: %s" % (len(bodies), str(e)))
+            for _, future, _ in group:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        self.batch_count += 1
+        self.request_count += len(bodies)
+        for (_, future, _), response in zip(group, responses):
+            if not future.done():
+                future.set_result(response)
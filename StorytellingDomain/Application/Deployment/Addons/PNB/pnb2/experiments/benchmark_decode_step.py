@@ -0,0 +1,94 @@
+"""
+benchmark_decode_step.py
+
+Micro-benchmark of one decoding step of the PnB logits processors: latency, and number / size of tensor
+allocations per step (counted with the torch profiler).
+
+Runs with tiny randomly initialized GPT-2 models, so no checkpoints are needed and the numbers are dominated by
+the processors themselves rather than by GeDi. Run it on two revisions to compare before / after a change.
+Scores of 50400 tokens exercise the GPT-J path (vocabulary larger than GeDi's).
+"""
+
+import time
+
+import torch
+from torch.profiler import profile, ProfilerActivity
+from transformers import GPT2Config, GPT2LMHeadModel
+
+from pnb_logits_processor import PlugAndBlendLogitsProcessor, PlugAndBlendFusedLogitsProcessor, device
+
+
+def tiny_gpt2(seed):
+    torch.manual_seed(seed)
+    config = GPT2Config(n_layer=2, n_head=2, n_embd=32, n_positions=256)
+    return GPT2LMHeadModel(config).eval()
+
+
+class Reference:
+    """
+    One PlugAndBlendLogitsProcessor per topic, as in the original PnB.
+    """
+
+    def __init__(self, topics):
+        self.processors = [PlugAndBlendLogitsProcessor(topic=key, weight=value) for key, value in topics.items()]
+
+    def __call__(self, input_ids, scores):
+        for item in self.processors:
+            scores = item(input_ids, scores)
+        return scores
+
+
+def run_steps(processor, input_ids, vocab_size, steps):
+    """
+    Feed `steps` decoding steps (one random token appended per step) to a processor.
+    :return: input_ids after the last step.
+    """
+    for _ in range(steps):
+        scores = torch.randn((input_ids.shape[0], vocab_size), device=device)
+        processor(input_ids, scores)
+        input_ids = torch.cat((input_ids, torch.randint(0, 50256, (input_ids.shape[0], 1), device=device)), dim=1)
+    return input_ids
+
+
+def measure(name, make_processor, input_ids, vocab_size, steps=16, warmup=4):
+    """
+    Print average latency, allocations and allocated bytes per step.
+    """
+    with torch.no_grad():
+        processor = make_processor()
+        # The first steps build the per-processor state (and the full GeDi forward), leave them out.
+        start_ids = run_steps(processor, input_ids, vocab_size, warmup)
+
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        run_steps(processor, start_ids, vocab_size, steps)
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+        latency = (time.perf_counter() - start) / steps
+
+        processor = make_processor()
+        start_ids = run_steps(processor, input_ids, vocab_size, warmup)
+        activities = [ProfilerActivity.CPU] + ([ProfilerActivity.CUDA] if device.type == "cuda" else [])
+        with profile(activities=activities, profile_memory=True) as prof:
+            run_steps(processor, start_ids, vocab_size, steps)
+
+    allocations = [event for event in prof.events() if event.name == "[memory]" and
+                   max(event.cpu_memory_usage, event.cuda_memory_usage) > 0]
+    allocated_bytes = sum(max(event.cpu_memory_usage, event.cuda_memory_usage) for event in allocations)
+    print("%-28s vocab=%s: %7.2f ms/step, %6.1f allocations/step, %8.1f KB/step" % (
+        name, vocab_size, latency * 1000, len(allocations) / steps, allocated_bytes / steps / 1024))
+
+
+if __name__ == '__main__':
+    PlugAndBlendLogitsProcessor.gedi_model = tiny_gpt2(1).to(device)
+    prompt = PlugAndBlendLogitsProcessor.get_tokenizer().encode("Story for kids: Once upon a time,")
+    # 2 requests * 2 beams.
+    input_ids = torch.tensor([prompt] * 4, device=device)
+    topics = {"Science": 0.6, "Business": 0.4}
+
+    for vocab_size in [50257, 50400]:
+        measure("reference (per topic)", lambda: Reference(topics), input_ids, vocab_size)
+        measure("fused", lambda: PlugAndBlendFusedLogitsProcessor(topics), input_ids, vocab_size)
+        measure("fused, incremental", lambda: PlugAndBlendFusedLogitsProcessor(topics, incremental=True),
+                input_ids, vocab_size)
@@ -0,0 +1,96 @@
+"""
+benchmark_int8.py
+
+Compare float32 and int8 (dynamic quantization) CPU inference for PnB:
+- speed: tokens/second of guided generation (base model and GeDi together);
+- guidance fidelity: correlation between GeDi modifiers computed by the float and the int8 GeDi on the same
+  sequences, and how often both agree on the most promoted tokens.
+
+Usage: python benchmark_int8.py [base model location] [GeDi location]
+(defaults to GPT-2 for both, which only makes sense for the speed numbers).
+"""
+
+import copy
+import sys
+import time
+
+import torch
+from transformers import GPT2LMHeadModel, LogitsProcessorList
+
+from pnb_logits_processor import PlugAndBlendLogitsProcessor, PlugAndBlendFusedLogitsProcessor
+from StorytellingDomain.Application.Deployment.Addons.quantization import quantize_int8
+
+prompts = ["Story for kids: Once upon a time, there was a little fox.",
+           "Story for kids: Once upon a time, a king lived in a castle by the sea."]
+topics = {"Science": 0.6, "Sports": 0.4}
+
+
+def tokens_per_second(base_model, gedi_model, input_ids, new_tokens=32, repeats=3):
+    """
+    :return: (generated tokens per second, generated sequences of the last run).
+    """
+    PlugAndBlendLogitsProcessor.gedi_model = gedi_model
+    elapsed = 0
+    output = None
+    for _ in range(repeats):
+        torch.manual_seed(0)
+        processor = PlugAndBlendFusedLogitsProcessor(topics, incremental=True)
+        start = time.perf_counter()
+        with torch.no_grad():
+            output = base_model.generate(input_ids,
+                                         max_length=input_ids.shape[-1] + new_tokens,
+                                         min_length=input_ids.shape[-1] + new_tokens,
+                                         logits_processor=LogitsProcessorList([processor]),
+                                         do_sample=True,
+                                         num_beams=2,
+                                         pad_token_id=50256)
+        elapsed += time.perf_counter() - start
+    return new_tokens * repeats / elapsed, output
+
+
+def modifiers(gedi_model, input_ids):
+    PlugAndBlendLogitsProcessor.gedi_model = gedi_model
+    with torch.no_grad():
+        return PlugAndBlendFusedLogitsProcessor(topics).get_gedi_modifiers(input_ids)
+
+
+def fidelity(float_gedi, int8_gedi, sequences, prompt_length, top_k=10):
+    """
+    Compare modifiers of both GeDi models at every generated position of `sequences`.
+    :return: (mean correlation, min correlation, mean top-k overlap).
+    """
+    correlations = []
+    overlaps = []
+    for length in range(prompt_length, sequences.shape[-1]):
+        reference = modifiers(float_gedi, sequences[:, :length])
+        quantized = modifiers(int8_gedi, sequences[:, :length])
+        for row_reference, row_quantized in zip(reference, quantized):
+            correlations.append(torch.corrcoef(torch.stack((row_reference, row_quantized)))[0, 1].item())
+            top_reference = set(row_reference.topk(top_k).indices.tolist())
+            top_quantized = set(row_quantized.topk(top_k).indices.tolist())
+            overlaps.append(len(top_reference & top_quantized) / top_k)
+    return sum(correlations) / len(correlations), min(correlations), sum(overlaps) / len(overlaps)
+
+
+if __name__ == '__main__':
+    base_location = sys.argv[1] if len(sys.argv) > 1 else "gpt2"
+    gedi_location = sys.argv[2] if len(sys.argv) > 2 else "gpt2"
+    tokenizer = PlugAndBlendLogitsProcessor.get_tokenizer()
+
+    float_base = GPT2LMHeadModel.from_pretrained(base_location).eval()
+    float_gedi = GPT2LMHeadModel.from_pretrained(gedi_location).eval()
+    int8_base = quantize_int8(copy.deepcopy(float_base))
+    int8_gedi = quantize_int8(copy.deepcopy(float_gedi))
+
+    # Same length prompts, so no padding is needed.
+    encoded = [tokenizer.encode(item) for item in prompts]
+    length = min(len(item) for item in encoded)
+    input_ids = torch.tensor([item[:length] for item in encoded])
+
+    float_speed, sequences = tokens_per_second(float_base, float_gedi, input_ids)
+    int8_speed, _ = tokens_per_second(int8_base, int8_gedi, input_ids)
+    print("float32: %.2f tokens/s, int8: %.2f tokens/s (x%.2f)" % (float_speed, int8_speed, int8_speed / float_speed))
+
+    mean_correlation, min_correlation, overlap = fidelity(float_gedi, int8_gedi, sequences, input_ids.shape[-1])
+    print("Modifier correlation: mean %.4f, min %.4f; top-10 promoted token overlap: %.2f" % (
+        mean_correlation, min_correlation, overlap))
@@ -42,15 +42,21 @@ def all_weights(topic1, topic2, base_omega):
     return result
 
 
-def cache_sentences(generator, filename, base_omega=1):
-    def gen(prompt, topic):
-        result = obj({"sentence": prompt, "topics": topic})['out_sentence']
-        return result
+def cache_sentences(generator, filename, base_omega=1, prompt_list=None):
+    """
+    Generate sentences for every prompt, topic pair and blending weight, and save them to `filename`.
+    :param generator: PNBWorkflow (or anything taking a request body and returning a response).
+    :param filename: output file, read by eval_blending.py.
+    :param base_omega: total topic weight.
+    :param prompt_list: prompts to use; all `prompts` if None.
+    """
+    if prompt_list is None:
+        prompt_list = prompts
 
     all_results = []
 
     idx1 = -1
-    for item in prompts:
+    for item in prompt_list:
         this_result = {
             "prompt": item,
             "sets": [],
@@ -64,7 +70,7 @@ def cache_sentences(generator, filename, base_omega=1):
                     this_set = []
                     all_weights_list = all_weights(topic1, topic2, base_omega)
                     for weight in all_weights_list:
-                        out_sentence = obj({"sentence": item, "topic": weight})['out_sentence']
+                        out_sentence = generator({"sentence": item, "topic": weight})['out_sentence']
                         this_set.append(
                             {
                                 "topics": weight,
@@ -0,0 +1,67 @@
+"""
+check_incremental_gedi.py
+
+Check that incremental GeDi guidance (cached past_key_values) gives the same modifiers as re-feeding the whole
+sequence with one PlugAndBlendLogitsProcessor per topic, including when beam search reorders rows.
+
+Runs on CPU with tiny randomly initialized GPT-2 models, so no checkpoints are needed.
+"""
+
+import torch
+from transformers import GPT2Config, GPT2LMHeadModel, LogitsProcessorList
+
+from pnb_logits_processor import PlugAndBlendLogitsProcessor, PlugAndBlendFusedLogitsProcessor, device
+
+
+class ComparingLogitsProcessor(PlugAndBlendFusedLogitsProcessor):
+    """
+    Incremental fused processor that also computes the reference modifiers at each step and records the difference.
+    """
+
+    def __init__(self, topics: dict):
+        super().__init__(topics=topics, incremental=True)
+        self.references = [PlugAndBlendLogitsProcessor(topic=key, weight=value) for key, value in topics.items()]
+        self.max_differences = []
+        self.exact_steps = 0
+
+    def get_gedi_modifiers(self, input_ids):
+        modifiers = super().get_gedi_modifiers(input_ids)
+        # Pairs are ordered by topic, then row.
+        reference = torch.cat([item.get_gedi_modifiers(input_ids.clone()) for item in self.references], dim=0)
+        self.max_differences.append((modifiers - reference).abs().max().item())
+        if torch.equal(modifiers, reference):
+            self.exact_steps += 1
+        return modifiers
+
+
+def tiny_gpt2(seed):
+    torch.manual_seed(seed)
+    config = GPT2Config(n_layer=2, n_head=2, n_embd=32, n_positions=128)
+    return GPT2LMHeadModel(config).eval()
+
+
+def check(topics, num_beams=2, new_tokens=24, tolerance=1e-4):
+    base_model = tiny_gpt2(0)
+    PlugAndBlendLogitsProcessor.gedi_model = tiny_gpt2(1).to(device)
+
+    input_ids = PlugAndBlendLogitsProcessor.get_tokenizer().encode("Story for kids: Once upon a time,", return_tensors='pt')
+    processor = ComparingLogitsProcessor(topics)
+    base_model.generate(
+        input_ids,
+        max_length=input_ids.shape[-1] + new_tokens,
+        min_length=input_ids.shape[-1] + new_tokens,
+        logits_processor=LogitsProcessorList([processor]),
+        do_sample=True,
+        num_beams=num_beams,
+        pad_token_id=50256,
+    )
+    worst = max(processor.max_differences)
+    print("topics=%s beams=%s: %s steps, %s bit-exact, max abs difference %s" % (
+        topics, num_beams, len(processor.max_differences), processor.exact_steps, worst))
+    assert worst < tolerance, "Incremental modifiers diverged from the reference."
+
+
+if __name__ == '__main__':
+    check({"Science": 1})
+    check({"Science": 0.6, "Business": 0.4})
+    check({"Science": 0.5, "Sports": 0.3, "World": 0.2}, num_beams=4)
@@ -0,0 +1,168 @@
+"""
+check_speculative_decoding.py
+
+Check that speculative decoding (speculative.py) does not change the output distribution: continuations sampled
+with a draft model must follow the distribution of guided sampling from the base model alone, i.e. the two
+decoding paths of PNBWorkflow (speculative, and BatchSampler with num_beams=1) must sample the same way.
+
+The exact distribution of the first `horizon` generated tokens is enumerated from the base model, with every
+logits processor and PnB topic modifiers, and compared (total variation distance and chi-square) with:
+- sequences sampled by SpeculativeDecoder;
+- sequences sampled by BatchSampler with one beam and the same settings;
+- sequences sampled by `generate()` with the same settings (sanity check of the reference);
+- sequences sampled from the draft model alone (shows that the check does tell distributions apart).
+
+Runs on CPU with tiny randomly initialized GPT-2 models, so no checkpoints are needed. A small top-k keeps the
+number of possible continuations small enough to enumerate.
+"""
+
+import copy
+import math
+from collections import Counter
+
+import torch
+from transformers import GPT2Config, GPT2LMHeadModel, LogitsProcessorList
+
+from pnb_logits_processor import PlugAndBlendLogitsProcessor, PlugAndBlendFusedLogitsProcessor, device
+from guidance_schedule import GuidanceSchedule
+from speculative import SpeculativeDecoder, GuidanceModifiers
+from batch_sampling import BatchSampler
+
+topics = {"Science": 0.6, "Sports": 0.4}
+bad_words_ids = [[7], [58], [62]]
+
+
+def tiny_gpt2(seed, initializer_range=0.02):
+    torch.manual_seed(seed)
+    config = GPT2Config(n_layer=2, n_head=2, n_embd=32, n_positions=128, initializer_range=initializer_range)
+    return GPT2LMHeadModel(config).eval()
+
+
+def draft_from(model, noise=0.1, seed=2):
+    """
+    A draft model close to (but different from) the base model, as a distilled draft model would be.
+    """
+    torch.manual_seed(seed)
+    draft_model = copy.deepcopy(model)
+    with torch.no_grad():
+        for parameter in draft_model.parameters():
+            parameter.add_(torch.randn_like(parameter) * noise * parameter.std().clamp(min=1e-3))
+    return draft_model
+
+
+def exact_distribution(decoder, input_ids, horizon, schedule):
+    """
+    Enumerate every continuation of `horizon` tokens with its probability under the base model.
+    :return: dict, token tuple -> probability.
+    """
+    processors = decoder._processors(input_ids.shape[1])
+    modifiers = GuidanceModifiers(PlugAndBlendFusedLogitsProcessor(topics, incremental=True), schedule,
+                                  input_ids.shape[1], decoder.vocab_size)
+    result = {}
+
+    def expand(prefix, probability):
+        if prefix.shape[1] - input_ids.shape[1] == horizon:
+            result[tuple(prefix[0, input_ids.shape[1]:].tolist())] = probability
+            return
+        with torch.no_grad():
+            logits = decoder.model(input_ids=prefix).logits[:, -1, :]
+            p = decoder._distribution(prefix, logits, processors, modifiers)
+        for token in p.nonzero().view(-1).tolist():
+            expand(torch.cat((prefix, torch.tensor([[token]])), dim=1), probability * p[token].item())
+
+    expand(input_ids, 1.0)
+    return result
+
+
+def compare(name, samples, exact):
+    """
+    :return: (total variation distance, chi-square statistic, degrees of freedom).
+    """
+    counts = Counter(samples)
+    total = len(samples)
+    outside = sum(count for key, count in counts.items() if key not in exact)
+    distance = 0.5 * (sum(abs(counts.get(key, 0) / total - value) for key, value in exact.items()) + outside / total)
+    chi_square = sum((counts.get(key, 0) - total * value) ** 2 / (total * value) for key, value in exact.items())
+    chi_square = chi_square if outside == 0 else math.inf
+    degrees = len(exact) - 1
+    print("%-12s TV distance %.4f, chi-square %.1f (%s degrees of freedom), %s samples outside the support" % (
+        name, distance, chi_square, degrees, outside))
+    return distance, chi_square, degrees
+
+
+def check(horizon=3, top_k=4, samples=1000, draft_tokens=4, schedule=None):
+    model = tiny_gpt2(0, initializer_range=0.2)
+    draft_model = draft_from(model)
+    PlugAndBlendLogitsProcessor.gedi_model = tiny_gpt2(1).to(device)
+    schedule = schedule if schedule is not None else GuidanceSchedule()
+    print("horizon=%s top_k=%s draft_tokens=%s schedule=%s" % (horizon, top_k, draft_tokens, schedule.to_config()))
+
+    # No minimum length, so that eos may be sampled within the horizon.
+    sampling = dict(bad_words_ids=bad_words_ids, min_new_tokens=0, top_k=top_k)
+    settings = dict(sampling, draft_tokens=draft_tokens)
+    decoder = SpeculativeDecoder(model, draft_model, **settings)
+    draft_only = SpeculativeDecoder(draft_model, draft_model, **dict(settings, draft_tokens=0))
+
+    input_ids = PlugAndBlendLogitsProcessor.get_tokenizer().encode("Story for kids: Once upon a time,",
+                                                                  return_tensors='pt')
+    exact = exact_distribution(decoder, input_ids, horizon, schedule)
+    print("%s possible continuations, total probability %.6f" % (len(exact), sum(exact.values())))
+
+    def sample(sampling_decoder):
+        output_ids, _ = sampling_decoder.generate(input_ids, horizon,
+                                                  guidance=PlugAndBlendFusedLogitsProcessor(topics, incremental=True),
+                                                  schedule=schedule)
+        return tuple(output_ids[0, input_ids.shape[1]:].tolist())
+
+    torch.manual_seed(0)
+    speculative_samples = [sample(decoder) for _ in range(samples)]
+    draft_samples = [sample(draft_only) for _ in range(samples)]
+    print("Speculative decoding stats: %s" % decoder.stats())
+
+    # The path PNBWorkflow takes without a draft model, with the schedule applied by the processor itself.
+    sampler = BatchSampler(model, num_beams=1, **sampling)
+    sampler_samples = []
+    for start in range(0, samples, 16):
+        count = min(16, samples - start)
+        results = sampler.generate(input_ids, torch.ones_like(input_ids), num_return_sequences=count,
+                                   max_new_tokens=horizon,
+                                   logits_processor=PlugAndBlendFusedLogitsProcessor(topics, incremental=True,
+                                                                                     schedule=schedule))
+        sampler_samples += [tuple(row[input_ids.shape[1]:].tolist()) for row in results[0]["sequences"]]
+
+    generate_samples = []
+    if schedule.to_config() == GuidanceSchedule().to_config():
+        # In chunks, since GeDi logits of a whole batch do not fit in memory.
+        for start in range(0, samples, 16):
+            output = model.generate(input_ids,
+                                    max_length=input_ids.shape[1] + horizon,
+                                    logits_processor=LogitsProcessorList(
+                                        [PlugAndBlendFusedLogitsProcessor(topics, incremental=True)]),
+                                    do_sample=True,
+                                    num_beams=1,
+                                    top_k=top_k,
+                                    no_repeat_ngram_size=2,
+                                    repetition_penalty=1.2,
+                                    bad_words_ids=bad_words_ids,
+                                    pad_token_id=50256,
+                                    num_return_sequences=min(16, samples - start))
+            generate_samples += [tuple(row[input_ids.shape[1]:].tolist()) for row in output]
+
+    # About 4 standard deviations above the expected chi-square value.
+    speculative_result = compare("speculative", speculative_samples, exact)
+    sampler_result = compare("sampler", sampler_samples, exact)
+    if len(generate_samples) > 0:
+        compare("generate()", generate_samples, exact)
+    draft_result = compare("draft only", draft_samples, exact)
+    _, chi_square, degrees = speculative_result
+    limit = degrees + 4 * math.sqrt(2 * degrees)
+    assert chi_square < limit, "Speculative decoding changed the output distribution."
+    assert sampler_result[1] < limit, "BatchSampler does not sample from the same distribution."
+    if draft_result[1] < limit:
+        print("WARNING: the draft distribution is too close to the base one for this check to be meaningful.")
+
+
+if __name__ == '__main__':
+    check()
+    check(draft_tokens=1)
+    check(horizon=4, top_k=3, schedule=GuidanceSchedule(stride=2, decay=0.9))
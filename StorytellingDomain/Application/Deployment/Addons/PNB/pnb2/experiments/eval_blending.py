@@ -126,6 +126,7 @@ def experiments(data_file):
     with open("tau_a_%s" % data_file, 'w') as f:
         json.dump(report, f)
     print(report)
+    return report
 
 
 if __name__ == '__main__':
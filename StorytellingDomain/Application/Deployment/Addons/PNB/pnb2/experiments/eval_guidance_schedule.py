@@ -0,0 +1,73 @@
+"""
+eval_guidance_schedule.py
+
+Quality / latency trade-off of GeDi guidance schedules.
+
+For every schedule, sentences are generated as in cache_sentences.py and scored with eval_blending.py's
+Kendall's Tau-a ranking score (how well the blending weights order the classifier confidence), next to the
+average time per generated sentence.
+"""
+
+import json
+import time
+
+import numpy
+
+from cache_sentences import cache_sentences, prompts
+from eval_blending import experiments
+from guidance_schedule import GuidanceSchedule
+from pnb_logits_processor import PNBWorkflow
+
+schedules = {
+    "every_step": {},
+    "stride_2": {"stride": 2},
+    "stride_4": {"stride": 4},
+    "first_8": {"first_tokens": 8},
+    "first_16_stride_2": {"first_tokens": 16, "stride": 2},
+    "decay_0.9": {"decay": 0.9},
+}
+
+
+def evaluate_schedules(workflow, schedule_list, prompt_count=5, base_omega=2):
+    """
+    Generate and score sentences with each guidance schedule.
+    :param workflow: PNBWorkflow.
+    :param schedule_list: dict, key is the name and value is the schedule config (see GuidanceSchedule).
+    :param prompt_count: number of prompts (from cache_sentences.py) to use.
+    :param base_omega: total topic weight, see cache_sentences().
+    :return: dict, key is the schedule name and value is its seconds per sentence and mean Tau-a score.
+    """
+    results = {}
+    for name, schedule in schedule_list.items():
+        workflow.guidance_schedule = GuidanceSchedule.from_config(schedule)
+        data_file = "cache_schedule_%s.txt" % name
+        calls = []
+
+        def timed_workflow(body):
+            start = time.perf_counter()
+            response = workflow(body)
+            calls.append(time.perf_counter() - start)
+            return response
+
+        cache_sentences(timed_workflow, data_file, base_omega, prompt_list=prompts[:prompt_count])
+        report = experiments(data_file)
+        results[name] = {
+            "schedule": schedule,
+            "seconds_per_sentence": float(numpy.mean(calls)),
+            "tau_a": float(numpy.mean(list(report['meta']['avg'].values()))),
+        }
+        print("%s: %s" % (name, results[name]))
+
+    with open("schedule_tradeoff.json", 'w') as f:
+        json.dump(results, f)
+    return results
+
+
+if __name__ == '__main__':
+    obj = PNBWorkflow(config={
+        "base_location": "/mnt/hdd/trained_models/skill_model/ROC-large_v201",
+        "gedi_location": "/mnt/hdd/trained_models/gedi_base/gedi_topic/",
+    }
+    )
+    for key, value in evaluate_schedules(obj, schedules).items():
+        print("%-20s %6.3f s/sentence, Tau-a %.3f" % (key, value["seconds_per_sentence"], value["tau_a"]))
@@ -0,0 +1,59 @@
+"""
+guidance_schedule.py
+
+Schedules deciding at which decoding steps GeDi guidance is computed, and how strongly it is applied.
+
+GeDi is the dominant cost of guided generation. Early tokens decide most of where a sentence goes, so guidance can
+be computed only every few steps (reusing the last modifiers in between), only for the first tokens, or with a
+weight decaying over the sentence.
+"""
+
+
+class GuidanceSchedule:
+    def __init__(self, stride=1, first_tokens=None, decay=None):
+        """
+        :param stride: compute GeDi modifiers every `stride` steps; steps in between reuse the last ones.
+        :param first_tokens: if not None, only guide the first `first_tokens` generated tokens.
+        :param decay: if not None, guidance weight is multiplied by `decay` ** (generated tokens).
+        """
+        if stride < 1:
+            raise ValueError("stride must be at least 1.")
+        self.stride = stride
+        self.first_tokens = first_tokens
+        self.decay = decay
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        :param config: None, or dict with (optional) keys `stride`, `first_tokens` and `decay`.
+        :return: GuidanceSchedule; guidance at every step if config is None.
+        """
+        if config is None:
+            return cls()
+        return cls(stride=config.get('stride', 1),
+                   first_tokens=config.get('first_tokens', None),
+                   decay=config.get('decay', None))
+
+    def weight_scale(self, step):
+        """
+        :param step: number of tokens generated so far.
+        :return: factor applied to guidance at this step, 0 if not guided.
+        """
+        if self.first_tokens is not None and step >= self.first_tokens:
+            return 0
+        if self.decay is not None:
+            return self.decay ** step
+        return 1
+
+    def should_compute(self, step):
+        """
+        :param step: number of tokens generated so far.
+        :return: True if modifiers have to be computed at this step, False if the last ones can be reused.
+        """
+        return step % self.stride == 0
+
+    def to_config(self):
+        """
+        :return: dict that from_config() turns back into this schedule.
+        """
+        return {"stride": self.stride, "first_tokens": self.first_tokens, "decay": self.decay}
@@ -1,9 +1,22 @@
 import transformers
 import torch
-from transformers import GPT2Tokenizer, GPT2LMHeadModel, LogitsProcessorList, GPTJForCausalLM, AutoTokenizer
+from transformers import GPT2Tokenizer, GPT2LMHeadModel, GPTJForCausalLM, AutoTokenizer, StoppingCriteria, \
+    StoppingCriteriaList
+import queue
 import sys
+import threading
+import time
 from nltk import sent_tokenize
 
+from StorytellingDomain.Application.Deployment.Addons.PNB.pnb2.batch_sampling import BatchSampler
+from StorytellingDomain.Application.Deployment.Addons.PNB.pnb2.guidance_schedule import GuidanceSchedule
+from StorytellingDomain.Application.Deployment.Addons.PNB.pnb2.prefix_cache import PrefixKVCache
+from StorytellingDomain.Application.Deployment.Addons.PNB.pnb2.response_cache import response_cache_key
+from StorytellingDomain.Application.Deployment.Addons.PNB.pnb2.speculative import SpeculativeDecoder
+from StorytellingDomain.Application.Deployment.Addons.mmap_weights import load_pretrained
+from StorytellingDomain.Application.Deployment.Addons.quantization import quantize_int8
+from StorytellingDomain.Application.Deployment.Addons.response_cache import ResponseCache
+
 # Set CUDA device to cuda if gpu is available
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
@@ -47,10 +60,20 @@ def cut_into_sentences(text, do_cleanup=True):
 class PlugAndBlendLogitsProcessor(transformers.LogitsProcessor):
     gedi_model = None
     """
-    Path to GeDi model files. Should be initialized externally.
+    GeDi model. Should be initialized externally, or is loaded on first use, see get_gedi_model().
     """
 
-    tokenizer = GPT2Tokenizer.from_pretrained("gpt2")
+    gedi_loader = None
+    """
+    (optional) Function setting gedi_model, called on first use if gedi_model is not initialized.
+    """
+    _gedi_lock = threading.Lock()
+
+    tokenizer = None
+    """
+    GPT-2 tokenizer used for GeDi. Loaded on first use, see get_tokenizer().
+    """
+    _tokenizer_lock = threading.Lock()
 
     # default omega from original GeDi work, higher disc_weight means more aggressive topic steering.
     # can be overridden when calling generate_one_sentence(), see that function.
@@ -61,139 +84,935 @@ class PlugAndBlendLogitsProcessor(transformers.LogitsProcessor):
     # A hyperparameter asssociated with the GeDi model.
     logit_scale = 1.312
 
+    @classmethod
+    def get_tokenizer(cls):
+        """
+        Tokenizer used for GeDi, loaded on first use instead of at import time.
+        :return: GPT2Tokenizer.
+        """
+        if cls.tokenizer is None:
+            with cls._tokenizer_lock:
+                if cls.tokenizer is None:
+                    cls.tokenizer = GPT2Tokenizer.from_pretrained("gpt2")
+        return cls.tokenizer
+
+    @classmethod
+    def get_gedi_model(cls):
+        """
+        GeDi model, loaded on first use if not initialized, so that unguided generation never loads it.
+        :return: GeDi model.
+        """
+        if cls.gedi_model is None:
+            with cls._gedi_lock:
+                if cls.gedi_model is None:
+                    if cls.gedi_loader is not None:
+                        print("Loading GeDi for the first guided request...")
+                        cls.gedi_loader()
+                    else:
+                        print("WARNING! gedi_model is not initialized externally. "
+                              "Trying to load from default location...")
+                        cls.gedi_model = GPT2LMHeadModel.from_pretrained(default_gedi_location).to(device)
+        return cls.gedi_model
+
+    # Per device and dtype constants, see get_constants().
+    _constants = {}
+
+    @classmethod
+    def get_constants(cls, target_device, dtype=torch.float):
+        """
+        Constants used at every decoding step, built once per device and dtype instead of once per step.
+        :param target_device: device the constants are used on.
+        :param dtype: dtype of GeDi logits.
+        :return: dict with "pt_id" and "nt_id" (GeDi class codes "true" and "false"),
+        and "loss_weight" (class weights for cross entropy, 0 on [50256], the padding (eot) token).
+        """
+        key = (str(target_device), dtype)
+        if key not in cls._constants:
+            loss_weight = torch.ones(50257, dtype=dtype, device=target_device)
+            loss_weight[50256] = 0  # do not calculate loss on eos token
+            cls._constants[key] = {
+                "nt_id": cls.get_tokenizer().encode("false")[0],
+                "pt_id": cls.get_tokenizer().encode("true")[0],
+                "loss_weight": loss_weight,
+            }
+        return cls._constants[key]
+
     def __init__(self, topic: str, weight: float):
         super().__init__()
 
-        if PlugAndBlendLogitsProcessor.gedi_model is None:
-            print("WARNING! gedi_model is not initialized externally. Trying to load from default location...")
-            PlugAndBlendLogitsProcessor.gedi_model = GPT2LMHeadModel.from_pretrained(default_gedi_location).to(device)
-
         self.topic = topic
         self.weight = weight
-        self.encoded_topic = PlugAndBlendLogitsProcessor.tokenizer.encode(topic)[0]
+        self.encoded_topic = PlugAndBlendLogitsProcessor.get_tokenizer().encode(topic)[0]
+
+        # [code, topic] columns of the GeDi batch, kept between steps (see _get_prefix_columns()).
+        self._prefix_columns = None
+        # Value of tokens beyond GeDi's vocabulary (GPT-J), kept between steps (see __call__()).
+        self._extra_scores = None
 
     def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
-        # print("Applying topic: %s, weight: %s" % (self.encoded_topic, self.weight))
-        # print("test %s" % scores[:, 100])
-        # scores[:, 100] += 1
-        # print("after %s" % scores[:, 100])
         modifiers = self.get_gedi_modifiers(input_ids=input_ids)
 
         # Make them appear on the same device
         modifiers = modifiers.to(scores.device)
 
-        # Dealing with GPT-J (50400 tokens instead of 50257, but all other tokens just extras)
-        if scores.shape[-1] >= modifiers.shape[-1]:
-            magic_number = -123456789 * 1 if self.weight > 0 else -1  # "-inf"
-            expanded_modifier = (torch.ones(scores.size()) * magic_number).to(scores.device)
-            # Add `modifier` to this `expanded modifiers` along final axis (where dims are different)
-            # So we get an extended modifier tensor with extra elements at last axis with 0.
-            expanded_modifier.index_copy_(-1, torch.arange(modifiers.size()[-1]).to(scores.device), modifiers)
-            modifiers = expanded_modifier
-
-        # print(scores.shape)
+        vocab_size = modifiers.shape[-1]
+        scores[..., :vocab_size].add_(modifiers, alpha=self.weight * PlugAndBlendLogitsProcessor.omega)
 
-        scores += modifiers * self.weight * PlugAndBlendLogitsProcessor.omega
+        # Dealing with GPT-J (50400 tokens instead of 50257, but all other tokens just extras)
+        if scores.shape[-1] > vocab_size:
+            if self._extra_scores is None or self._extra_scores.device != scores.device or \
+                    self._extra_scores.dtype != scores.dtype:
+                magic_number = -123456789 * 1 if self.weight > 0 else -1  # "-inf"
+                self._extra_scores = torch.tensor(magic_number * self.weight * PlugAndBlendLogitsProcessor.omega,
+                                                  dtype=scores.dtype, device=scores.device)
+            scores[..., vocab_size:] += self._extra_scores
 
         return scores
 
+    def _get_prefix_columns(self, row_count):
+        """
+        [code, topic] columns for the positive and negative GeDi rows; rebuilt only when the row count changes.
+        :param row_count: rows of the base model batch.
+        :return: LongTensor [positive/negative * row, 2] on `device`.
+        """
+        if self._prefix_columns is None or self._prefix_columns.shape[0] != 2 * row_count:
+            constants = PlugAndBlendLogitsProcessor.get_constants(device)
+            codes = torch.tensor([constants["pt_id"], constants["nt_id"]], device=device).repeat_interleave(row_count)
+            self._prefix_columns = torch.stack((codes, torch.full_like(codes, self.encoded_topic)), dim=1)
+        return self._prefix_columns
+
     def get_gedi_modifiers(self, input_ids):
 
         # Make sure that there are nothing going out of bounds
-        if input_ids[input_ids > 50256].any():
+        invalid = input_ids > 50256
+        if invalid.any():
             print("WARNING: some input_ids are invalid!")
-        input_ids[input_ids > 50256] = 50256
+            input_ids.masked_fill_(invalid, 50256)
 
-        # Setting up some constants
-        code_0 = "false"
-        code_1 = "true"
-        nt_id = PlugAndBlendLogitsProcessor.tokenizer.encode(code_0)[0]
-        pt_id = PlugAndBlendLogitsProcessor.tokenizer.encode(code_1)[0]
+        # Assemble input_ids: [positive rows, negative rows], each being [code, topic, input_ids].
+        row_count, length = input_ids.shape
+        seq_batched = torch.empty((2 * row_count, length + 2), dtype=torch.long, device=device)
+        seq_batched[:, :2] = self._get_prefix_columns(row_count)
+        seq_batched[:row_count, 2:] = input_ids
+        seq_batched[row_count:, 2:] = input_ids
 
-        # define class weights for cross entropy loss: give weight 0 to [50256], the padding (eot) token.
-        crossentropy_loss_weight = [1] * 50257
-        crossentropy_loss_weight[50256] = 0  # do not calculate loss on eos token
-        crossentropy_loss_weight = torch.tensor(crossentropy_loss_weight).float().to(device)
-
-        # Creating prefixes.
-        seq_pt = (torch.ones(input_ids.shape[0]) * pt_id).type_as(input_ids).view(-1, 1)
-        seq_nt = (torch.ones(input_ids.shape[0]) * nt_id).type_as(input_ids).view(-1, 1)
-        encoded_topic_torch = (torch.ones(input_ids.shape[0]) * self.encoded_topic).type_as(input_ids).view(-1, 1)
-
-        # Assemble input_ids.
-        seq_pt_new = torch.cat((seq_pt, encoded_topic_torch, input_ids), dim=1)[:, :]
-        seq_nt_new = torch.cat((seq_nt, encoded_topic_torch, input_ids), dim=1)[:, :]
-
-        def prepare_inputs_for_generation(input_ids, **kwargs):
-            return {"input_ids": input_ids.to(device)}
-
-        seq_batched = torch.cat([seq_pt_new, seq_nt_new], dim=0)
-
-        model_inputs = prepare_inputs_for_generation(input_ids=seq_batched)
-
-        gedi_outputs = PlugAndBlendLogitsProcessor.gedi_model(**model_inputs)
+        gedi_outputs = PlugAndBlendLogitsProcessor.get_gedi_model()(input_ids=seq_batched)
+        gedi_logits = gedi_outputs["logits"]
+        constants = PlugAndBlendLogitsProcessor.get_constants(gedi_logits.device, gedi_logits.dtype)
 
         # Let's calculate modifier on the whole sentence:
         # This is modifier on all tokens multiplied.
         # Here, we calculate the baseline (sentence without generated token) modifier, for normalization.
 
-        shift_logits = gedi_outputs["logits"][..., :-1, :].contiguous().to(device)
-        shift_labels = seq_batched[..., 1:].contiguous().to(device)
-
         # By using Cross Entropy on previous tokens,
         # This effectively picked probabilities of previous tokens in the sequence.
-        loss_fct = torch.nn.CrossEntropyLoss(reduction="none",
-                                             weight=crossentropy_loss_weight,
-                                             )
-
+        # Cross entropy takes classes on dim 1, so the logits are only transposed, not copied.
         # Cross entropy loss originally gives -p(x), so...
-        logits_r = -1 * loss_fct(
-            shift_logits.view(-1, shift_logits.size(-1)),
-            shift_labels.view(-1),
-        )
-        logits_r = logits_r.view(seq_batched.shape[0], -1)
+        logits_r = -torch.nn.functional.cross_entropy(gedi_logits[:, :-1, :].transpose(1, 2),
+                                                      seq_batched[:, 1:],
+                                                      weight=constants["loss_weight"],
+                                                      reduction="none")
 
         seq_len = logits_r.shape[1]
 
         logits_r = torch.sum(logits_r, 1)
 
         # Now, finally add the baseline into the actual final (generated token) logits.
-        gedi_logits = torch.log_softmax(gedi_outputs["logits"][:, -1, :], -1)
+        # Everything below works in place on the output of log_softmax.
+        gedi_logits = torch.log_softmax(gedi_logits[:, -1, :], -1)
         gedi_logits += logits_r.unsqueeze(1)
 
-        # Normalize modifier logits by sequence length and reshape it for output
-        gedi_logits_split = torch.split(gedi_logits / (seq_len + 1),
-                                        input_ids.shape[0])
+        # Normalize modifier logits by sequence length, [positive/negative, row, vocab].
+        logits = gedi_logits.div_(seq_len + 1).view(2, row_count, -1)
+
+        logits = logits.mul_(PlugAndBlendLogitsProcessor.logit_scale)
+
+        logp_related_softmax = torch.log_softmax(logits, dim=0)
+
+        # Once normalized, we only care about the "positive" dimension (0).
+        final_modifier = logp_related_softmax[0]
+
+        return final_modifier
+
+
+class PlugAndBlendFusedLogitsProcessor(transformers.LogitsProcessor):
+    """
+    Blends all topics of a request with a single GeDi forward per decoding step.
+
+    Equivalent to applying one PlugAndBlendLogitsProcessor per topic, but the positive and negative prefixes
+    of every (topic, row) pair with a non-zero weight are stacked into one GeDi batch instead of running one
+    GeDi forward per topic.
+    The GeDi model, tokenizer and hyperparameters are shared with PlugAndBlendLogitsProcessor.
+
+    Several requests can be blended in the same batch, each with its own topic weights; their prompts may be
+    padded (on the left, or after a shared prefix), in which case the padding is kept out of GeDi with an attention
+    mask.
+
+    With `incremental` set, GeDi `past_key_values` and the running log-likelihood of every GeDi row are kept
+    between steps, so each step only feeds the newly generated token(s) to GeDi.
+    The state belongs to one `generate()` call; create a new processor for each call. Batch entries finished early
+    can be dropped between calls with keep_entries().
+
+    A GuidanceSchedule can limit the steps GeDi runs on; steps in between reuse the last modifiers.
+    """
+
+    # Vocabulary of GeDi (GPT-2). Base models with more tokens (GPT-J) get the extra ones suppressed.
+    gedi_vocab_size = 50257
+
+    def __init__(self, topics, incremental: bool = False, prompt_attention_mask: torch.Tensor = None,
+                 prefix_cache: PrefixKVCache = None, prefix_length: int = 0, schedule: GuidanceSchedule = None):
+        """
+        Create a blending processor.
+        :param topics: dict, key is the topic and value is its weight;
+        or a list of such dicts, one per batch entry passed to `generate()`.
+        :param incremental: if True, reuse GeDi states across steps instead of re-feeding the whole sequence.
+        :param prompt_attention_mask: attention mask of padded prompts, [batch entry, prompt length].
+        None if the prompts are not padded.
+        :param prefix_cache: if not None (and incremental), GeDi states of the first `prefix_length` prompt tokens
+        are taken from / stored into this cache. Every row must start with the same prefix, without padding.
+        :param prefix_length: length of the shared prompt prefix, in tokens.
+        :param schedule: (optional) GuidanceSchedule; guidance at every step if None.
+        """
+        super().__init__()
+
+        if isinstance(topics, dict):
+            topics = [topics]
+
+        self.topics = []
+        for item in topics:
+            for key in item:
+                if key not in self.topics:
+                    self.topics.append(key)
+        # [batch entry, topic]
+        self.row_weights = [[item.get(key, 0) for key in self.topics] for item in topics]
+        self.encoded_topics = [PlugAndBlendLogitsProcessor.get_tokenizer().encode(topic)[0] for topic in self.topics]
+
+        self.incremental = incremental
+        self.prompt_attention_mask = prompt_attention_mask
+        self.prefix_cache = prefix_cache
+        self.prefix_length = prefix_length
+        self.schedule = schedule if schedule is not None else GuidanceSchedule()
+
+        # Prompt length, and the modifiers computed last (see schedule), set on calls.
+        self._prompt_length = None
+        self._last_modifiers = None
+        self._last_input_ids = None
+
+        # (topic, row) pairs with a non-zero weight. Set up on the first call, once the number of rows
+        # (batch entries * beams) is known.
+        self._row_count = None
+        self._pair_topics = None
+        self._pair_rows = None
+        self._pair_weights = None
+        self._extra_values = None
+        self._pad_lengths = None
+        # Per-step index tensors and buffers, built once in _setup_rows() / on first use.
+        self._pair_lookup = None
+        self._pair_row_index = None
+        self._gedi_rows = None
+        self._gedi_prefix_columns = None
+        self._gedi_pad_lengths = None
+        self._gedi_prompt_mask = None
+        self._modifier_buffer = None
+        self._extra_scores = None
+
+        # Incremental states, all aligned with GeDi rows ([positive, negative][pair]).
+        self._cached_input_ids = None
+        self._past_key_values = None
+        self._gedi_attention_mask = None
+        self._next_token_log_probs = None
+        self._logits_r = None
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
+        self._setup_rows(input_ids)
+        if len(self._pair_rows) == 0:
+            # Nothing to blend.
+            return scores
+
+        # Only GeDi modifiers follow the schedule: extra tokens stay suppressed at every step.
+        self.suppress_extra_tokens(input_ids, scores)
+
+        if self._prompt_length is None:
+            self._prompt_length = input_ids.shape[1]
+        step = input_ids.shape[1] - self._prompt_length
+        scale = self.schedule.weight_scale(step)
+        if scale == 0:
+            return scores
+
+        modifiers = None
+        if not self.schedule.should_compute(step) and self._last_modifiers is not None:
+            # Reuse the last modifiers; beams may have been reordered since.
+            parent_rows = self._match_rows(input_ids, self._last_input_ids)
+            if parent_rows is not None:
+                modifiers = self._last_modifiers.index_select(0, parent_rows.to(self._last_modifiers.device))
+        if modifiers is None:
+            modifiers = self._blend_modifiers(input_ids, scores.device)
+            self._last_modifiers = modifiers
+            self._last_input_ids = input_ids
+
+        vocab_size = modifiers.shape[-1]
+        scores[..., :vocab_size].add_(modifiers, alpha=PlugAndBlendLogitsProcessor.omega * scale)
+
+        return scores
+
+    def suppress_extra_tokens(self, input_ids, scores):
+        """
+        Dealing with GPT-J (50400 tokens instead of 50257, but all other tokens just extras):
+        same "-inf" treatment as PlugAndBlendLogitsProcessor, summed over all topics.
+        These do not change between steps, so they are only built once.
+        :param input_ids: input_ids from the base model, [row, seq].
+        :param scores: scores of the base model, [row, vocab]; modified in place.
+        :return: scores.
+        """
+        if scores.shape[-1] <= self.gedi_vocab_size:
+            return scores
+        self._setup_rows(input_ids)
+        if self._extra_scores is None or self._extra_scores.device != scores.device or \
+                self._extra_scores.dtype != scores.dtype:
+            self._extra_scores = (self._extra_values * PlugAndBlendLogitsProcessor.omega).to(
+                device=scores.device, dtype=scores.dtype).view(-1, 1)
+        scores[..., self.gedi_vocab_size:] += self._extra_scores
+        return scores
+
+    def _blend_modifiers(self, input_ids, target_device):
+        """
+        Compute GeDi modifiers and sum them over the topics of every row, weighted.
+        :param input_ids: input_ids from the base model, [row, seq].
+        :param target_device: device of the scores.
+        :return: [row, vocab]; a buffer reused across steps.
+        """
+        # [pair, vocab]
+        pair_modifiers = self.get_gedi_modifiers(input_ids=input_ids).to(target_device)
+        pair_modifiers.mul_(self._pair_weights.to(target_device).view(-1, 1))
+
+        # Sum weighted modifiers of every row over its topics, in a buffer reused across steps.
+        vocab_size = pair_modifiers.shape[-1]
+        modifiers = self._modifier_buffer
+        if modifiers is None or modifiers.shape[-1] != vocab_size or modifiers.device != pair_modifiers.device or \
+                modifiers.dtype != pair_modifiers.dtype:
+            modifiers = torch.empty((self._row_count, vocab_size), dtype=pair_modifiers.dtype,
+                                    device=pair_modifiers.device)
+            self._modifier_buffer = modifiers
+        modifiers.zero_()
+        modifiers.index_add_(0, self._pair_row_index.to(target_device), pair_modifiers)
+        return modifiers
+
+    def reset(self):
+        """
+        Drop incremental states so that the next call starts from a full GeDi forward.
+        :return: None.
+        """
+        self._cached_input_ids = None
+        self._past_key_values = None
+        self._gedi_attention_mask = None
+        self._next_token_log_probs = None
+        self._logits_r = None
+
+    def _setup_rows(self, input_ids):
+        """
+        Expand per-entry weights to per-row weights and find the (topic, row) pairs GeDi has to run on.
+        :param input_ids: input_ids from the base model, [batch entry * expansion (beams), seq].
+        :return: None.
+        """
+        if self._row_count != input_ids.shape[0]:
+            self._build_rows(input_ids.shape[0])
+
+    def _build_rows(self, row_count):
+        """
+        Build the (topic, row) pairs and per-step index tensors for `row_count` rows. Drops incremental states.
+        :param row_count: batch entries * expansion (beams).
+        :return: None.
+        """
+        expansion = row_count // len(self.row_weights)
+
+        # [row, topic]
+        weights = torch.tensor(self.row_weights, dtype=torch.float).repeat_interleave(expansion, dim=0)
+        # Ordered by topic, then row.
+        pairs = (weights.t() != 0).nonzero()
+        self._pair_topics = pairs[:, 0]
+        self._pair_rows = pairs[:, 1]
+        self._pair_weights = weights[self._pair_rows, self._pair_topics]
+
+        # Value of tokens beyond GeDi's vocabulary, per row.
+        self._extra_values = torch.sum(torch.where(weights > 0, weights * -123456789, weights * -1), dim=1)
+
+        self._pad_lengths = None
+        if self.prompt_attention_mask is not None:
+            pad_lengths = torch.sum(self.prompt_attention_mask.cpu() == 0, dim=1).repeat_interleave(expansion)
+            if pad_lengths.any():
+                self._pad_lengths = pad_lengths
+
+        # Index tensors used at every step.
+        pair_count = len(self._pair_rows)
+        self._pair_lookup = torch.full((len(self.topics), row_count), -1, dtype=torch.long)
+        self._pair_lookup[self._pair_topics, self._pair_rows] = torch.arange(pair_count)
+        # GeDi rows are ordered as [positive, negative][pair].
+        self._gedi_rows = self._pair_rows.repeat(2).to(device)
+        constants = PlugAndBlendLogitsProcessor.get_constants(device)
+        code_column = torch.tensor([constants["pt_id"], constants["nt_id"]]).repeat_interleave(pair_count)
+        topic_column = torch.tensor(self.encoded_topics, dtype=torch.long)[self._pair_topics].repeat(2)
+        self._gedi_prefix_columns = torch.stack((code_column, topic_column), dim=1).to(device)
+        self._gedi_pad_lengths = None
+        self._gedi_prompt_mask = None
+        if self._pad_lengths is not None:
+            self._gedi_pad_lengths = self._pad_lengths[self._pair_rows].repeat(2).to(device)
+            prompt_mask = self.prompt_attention_mask.cpu().long().repeat_interleave(expansion, dim=0)
+            self._gedi_prompt_mask = prompt_mask[self._pair_rows].repeat(2, 1).to(device)
+        self._pair_row_index = self._pair_rows.to(device)
+        self._pair_weights = self._pair_weights.to(device)
+        self._modifier_buffer = None
+        self._extra_scores = None
+
+        self._row_count = row_count
+        self.reset()
+
+    def keep_entries(self, entries):
+        """
+        Drop batch entries (e.g. requests finished early) between two calls, keeping the states of the others,
+        so that the next call still continues from their incremental GeDi states and last modifiers.
+        :param entries: indices of the batch entries to keep, in order.
+        :return: None.
+        """
+        entry_count = len(self.row_weights)
+        self.row_weights = [self.row_weights[entry] for entry in entries]
+        if self.prompt_attention_mask is not None:
+            self.prompt_attention_mask = self.prompt_attention_mask[
+                torch.tensor(entries, device=self.prompt_attention_mask.device)]
+        if self._row_count is None:
+            return
+
+        expansion = self._row_count // entry_count
+        rows = (torch.tensor(entries).view(-1, 1) * expansion + torch.arange(expansion)).view(-1)
+        # Pairs are ordered by topic, then row, so kept pairs stay in order.
+        kept_rows = torch.zeros(self._row_count, dtype=torch.bool)
+        kept_rows[rows] = True
+        kept_pairs = kept_rows[self._pair_rows].nonzero().view(-1)
+        gedi_rows = torch.cat((kept_pairs, kept_pairs + len(self._pair_rows))).to(device)
+        cached_input_ids, past_key_values, attention_mask = \
+            self._cached_input_ids, self._past_key_values, self._gedi_attention_mask
+        next_token_log_probs, logits_r = self._next_token_log_probs, self._logits_r
+        last_modifiers, last_input_ids = self._last_modifiers, self._last_input_ids
+
+        self._build_rows(len(rows))
+
+        if past_key_values is not None:
+            self._cached_input_ids = cached_input_ids[rows.to(cached_input_ids.device)]
+            self._past_key_values = tuple(tuple(item.index_select(0, gedi_rows) for item in layer)
+                                          for layer in past_key_values)
+            if attention_mask is not None:
+                self._gedi_attention_mask = attention_mask.index_select(0, gedi_rows)
+            self._next_token_log_probs = next_token_log_probs.index_select(0, gedi_rows)
+            self._logits_r = logits_r.index_select(0, gedi_rows)
+        if last_modifiers is not None:
+            self._last_modifiers = last_modifiers.index_select(0, rows.to(last_modifiers.device))
+            self._last_input_ids = last_input_ids[rows.to(last_input_ids.device)]
+
+    def get_gedi_modifiers(self, input_ids):
+        """
+        Calculate the GeDi modifiers of all (topic, row) pairs in one GeDi forward.
+        :param input_ids: input_ids from the base model, [batch, seq].
+        :return: modifiers, [pair, vocab]. Pairs are ordered by topic, then row.
+        """
+        self._setup_rows(input_ids)
+
+        # Make sure that there are nothing going out of bounds (without touching the base model's input_ids)
+        if (input_ids > 50256).any():
+            print("WARNING: some input_ids are invalid!")
+            input_ids = input_ids.clamp(max=50256)
+
+        pair_count = len(self._pair_rows)
 
-        logits = torch.stack(gedi_logits_split, 2)
+        parent_rows = self._match_cached_rows(input_ids) if self.incremental else None
+        gedi_rows = self._continued_gedi_rows(parent_rows) if parent_rows is not None else None
+        if gedi_rows is None:
+            next_token_log_probs, logits_r = self._forward_full(input_ids)
+        else:
+            next_token_log_probs, logits_r = self._forward_incremental(input_ids, gedi_rows)
+
+        # GeDi sequence is [code, topic, input_ids], so there are (input length + 1) predicted positions before
+        # the generated token. Padding does not count.
+        seq_len = input_ids.shape[1] + 1
+        if self._pad_lengths is None:
+            normalizer = seq_len + 1
+        else:
+            normalizer = (seq_len + 1 - self._gedi_pad_lengths).to(logits_r).view(-1, 1)
 
-        logits = PlugAndBlendLogitsProcessor.logit_scale * logits
+        # Now, finally add the baseline into the actual final (generated token) logits.
+        # next_token_log_probs may be kept for the next step, everything after this works in place.
+        gedi_logits = next_token_log_probs + logits_r.unsqueeze(1)
 
-        logp_related_softmax = torch.log_softmax(logits, dim=-1)
+        # [positive/negative, pair, vocab]
+        logits = gedi_logits.div_(normalizer).view(2, pair_count, -1)
+
+        logits = logits.mul_(PlugAndBlendLogitsProcessor.logit_scale)
+
+        logp_related_softmax = torch.log_softmax(logits, dim=0)
 
         # Once normalized, we only care about the "positive" dimension (0).
-        final_modifier = logp_related_softmax[..., 0]
+        return logp_related_softmax[0]
+
+    def _build_gedi_batch(self, input_ids):
+        """
+        Stack [code, topic, input_ids] for every pair and class.
+        :param input_ids: clamped input_ids, [row, seq].
+        :return: GeDi input_ids [positive/negative * pair, seq + 2], and its attention mask (None if not padded).
+        """
+        input_ids = input_ids.to(device)
+        seq_batched = torch.empty((self._gedi_rows.shape[0], input_ids.shape[1] + 2), dtype=torch.long, device=device)
+        seq_batched[:, :2] = self._gedi_prefix_columns
+        seq_batched[:, 2:] = input_ids.index_select(0, self._gedi_rows)
+
+        token_mask = self._gedi_token_mask(0, input_ids.shape[1])
+        if token_mask is None:
+            return seq_batched, None
+        return seq_batched, torch.cat((torch.ones_like(seq_batched[:, :2]), token_mask), dim=1)
+
+    def _gedi_token_mask(self, start, end):
+        """
+        Attention mask of input_ids[:, start:end] in GeDi rows: prompt padding is masked, generated tokens are not.
+        :param start: first column.
+        :param end: column after the last one.
+        :return: [GeDi row, end - start], or None if the prompts are not padded.
+        """
+        if self._gedi_prompt_mask is None:
+            return None
+        prompt_part = self._gedi_prompt_mask[:, start:end]
+        generated_part = torch.ones((prompt_part.shape[0], end - start - prompt_part.shape[1]), dtype=torch.long,
+                                    device=device)
+        return torch.cat((prompt_part, generated_part), dim=1)
+
+    @staticmethod
+    def _label_log_likelihoods(log_probs, labels, attention_mask=None):
+        """
+        Log-likelihood of each label, ignoring eos (the padding token) like the weighted cross entropy used by
+        PlugAndBlendLogitsProcessor.
+        :param log_probs: log probabilities predicted at each position, [rows, positions, vocab].
+        :param labels: token following each position, [rows, positions].
+        :param attention_mask: if not None, mask of the whole sequence, [rows, positions + 1]; its first position
+        must not be masked. Masked labels are ignored, and each label is predicted from the last unmasked position
+        before it (padding may sit in the middle of a row).
+        :return: [rows, positions].
+        """
+        ignored = labels == 50256
+        if attention_mask is None:
+            log_likelihoods = log_probs.gather(-1, labels.unsqueeze(-1)).squeeze(-1)
+        else:
+            positions = torch.arange(labels.shape[1], device=labels.device).expand_as(labels)
+            sources = torch.where(attention_mask[:, :-1] != 0, positions, torch.zeros_like(positions))
+            sources = torch.cummax(sources, dim=1).values
+            rows = torch.arange(labels.shape[0], device=labels.device).view(-1, 1)
+            log_likelihoods = log_probs[rows, sources, labels]
+            ignored = ignored | (attention_mask[:, 1:] == 0)
+        return log_likelihoods.masked_fill(ignored, 0)
+
+    def _forward_full(self, input_ids):
+        """
+        Feed the whole [code, topic, input_ids] sequence through GeDi.
+        :param input_ids: clamped input_ids, [row, seq].
+        :return: log probabilities of the next token [GeDi row, vocab], and the baseline log-likelihood [GeDi row].
+        """
+        if self.incremental and self.prefix_cache is not None and 0 < self.prefix_length < input_ids.shape[1]:
+            return self._forward_from_prefix(input_ids)
+
+        seq_batched, attention_mask = self._build_gedi_batch(input_ids)
+
+        gedi_model = PlugAndBlendLogitsProcessor.get_gedi_model()
+        if attention_mask is None:
+            gedi_outputs = gedi_model(input_ids=seq_batched, use_cache=self.incremental)
+        else:
+            position_ids = (torch.cumsum(attention_mask, dim=-1) - 1).clamp(min=0)
+            gedi_outputs = gedi_model(input_ids=seq_batched,
+                                      attention_mask=attention_mask,
+                                      position_ids=position_ids,
+                                      use_cache=self.incremental)
+
+        # By picking probabilities of previous tokens in the sequence we get the baseline
+        # (sentence without generated token) for normalization.
+        logits_r = torch.sum(self._label_log_likelihoods(torch.log_softmax(gedi_outputs["logits"][:, :-1, :], -1),
+                                                         seq_batched[:, 1:], attention_mask), 1)
+        next_token_log_probs = torch.log_softmax(gedi_outputs["logits"][:, -1, :], -1)
+
+        if self.incremental:
+            self._cached_input_ids = input_ids
+            self._past_key_values = gedi_outputs["past_key_values"]
+            self._gedi_attention_mask = attention_mask
+            self._next_token_log_probs = next_token_log_probs
+            self._logits_r = logits_r
+
+        return next_token_log_probs, logits_r
+
+    def _forward_from_prefix(self, input_ids):
+        """
+        Start GeDi from cached states of [code, topic, prefix] and only feed the rest of the prompt.
+        States missing from the cache are computed in one batch and stored.
+        :param input_ids: clamped input_ids, [row, seq]; every row starts with the same prefix.
+        :return: same as _forward_full.
+        """
+        pair_count = len(self._pair_rows)
+        prefix = input_ids[0, :self.prefix_length].tolist()
+
+        row_keys = [("gedi", code, topic_id, tuple(prefix)) for code, topic_id in self._gedi_prefix_columns.tolist()]
+
+        states = {}
+        for key in row_keys:
+            if key not in states:
+                states[key] = self.prefix_cache.get(key)
+        missing = [key for key, state in states.items() if state is None]
+        if len(missing) > 0:
+            seq_batched = torch.tensor([[key[1], key[2]] + prefix for key in missing], device=device)
+            gedi_outputs = PlugAndBlendLogitsProcessor.get_gedi_model()(input_ids=seq_batched, use_cache=True)
+            logits_r = torch.sum(self._label_log_likelihoods(
+                torch.log_softmax(gedi_outputs["logits"][:, :-1, :], -1), seq_batched[:, 1:]), 1)
+            next_token_log_probs = torch.log_softmax(gedi_outputs["logits"][:, -1, :], -1)
+            for index, key in enumerate(missing):
+                # Clone so that the cache does not keep the whole batch alive.
+                state = (tuple(tuple(item[index:index + 1].clone() for item in layer)
+                               for layer in gedi_outputs["past_key_values"]),
+                         next_token_log_probs[index:index + 1].clone(),
+                         logits_r[index:index + 1].clone())
+                self.prefix_cache.put(key, state)
+                states[key] = state
+
+        layer_count = len(states[row_keys[0]][0])
+        self._past_key_values = tuple(
+            tuple(torch.cat([states[key][0][layer][part] for key in row_keys], dim=0) for part in range(2))
+            for layer in range(layer_count))
+        self._next_token_log_probs = torch.cat([states[key][1] for key in row_keys], dim=0)
+        self._logits_r = torch.cat([states[key][2] for key in row_keys], dim=0)
+        self._gedi_attention_mask = None
+        self._cached_input_ids = input_ids[:, :self.prefix_length]
+
+        # Every GeDi row continues from its own prefix state.
+        return self._forward_incremental(input_ids, torch.arange(2 * pair_count))
+
+    def _match_cached_rows(self, input_ids):
+        """
+        Find, for every row in input_ids, the cached row it continues from.
+        Beam search reorders (and duplicates) rows between steps, so rows are matched by their prefixes.
+        :param input_ids: clamped input_ids, [row, seq].
+        :return: LongTensor [row] of cached row indices, or None if the cache can not be continued.
+        """
+        return self._match_rows(input_ids, self._cached_input_ids)
+
+    @staticmethod
+    def _match_rows(input_ids, cached):
+        """
+        Find, for every row in input_ids, the row of an earlier step (`cached`) it continues from.
+        :param input_ids: [row, seq].
+        :param cached: input_ids of an earlier step, [row, shorter seq]; or None.
+        :return: LongTensor [row] of cached row indices, or None if some row continues none of them.
+        """
+        if cached is None or cached.shape[0] != input_ids.shape[0] or cached.shape[1] >= input_ids.shape[1]:
+            return None
+
+        prefix = input_ids[:, :cached.shape[1]]
+        if torch.equal(prefix, cached):
+            # Rows kept their order (e.g. sampling, or beams not reordered at this step).
+            return torch.arange(input_ids.shape[0])
+        matches = (prefix.unsqueeze(1) == cached.unsqueeze(0)).all(-1)  # [new row, cached row]
+        if not matches.any(-1).all():
+            return None
+        return matches.int().argmax(-1).cpu()
+
+    def _continued_gedi_rows(self, parent_rows):
+        """
+        Map rows continued from the cache to the cached GeDi rows.
+        :param parent_rows: cached row each row continues from, see _match_cached_rows.
+        :return: LongTensor [GeDi row] of cached GeDi row indices, or None if some pair has no cached state.
+        """
+        pair_count = len(self._pair_rows)
+        source_pairs = self._pair_lookup[self._pair_topics, parent_rows[self._pair_rows]]
+        if (source_pairs < 0).any():
+            return None
+        return torch.cat((source_pairs, source_pairs + pair_count))
+
+    def _forward_incremental(self, input_ids, gedi_rows):
+        """
+        Reorder the cached GeDi states to follow the beams and feed only the new tokens.
+        :param input_ids: clamped input_ids, [row, seq].
+        :param gedi_rows: cached GeDi row each GeDi row continues from, see _continued_gedi_rows.
+        :return: same as _forward_full.
+        """
+        gedi_rows = gedi_rows.to(device)
+        past_key_values = tuple(tuple(item.index_select(0, gedi_rows) for item in layer)
+                                for layer in self._past_key_values)
+        previous_log_probs = self._next_token_log_probs.index_select(0, gedi_rows)
+        logits_r = self._logits_r.index_select(0, gedi_rows)
+
+        cached_length = self._cached_input_ids.shape[1]
+        new_tokens = input_ids.to(device)[:, cached_length:].index_select(0, self._gedi_rows)
+        # New tokens may still be prompt padding (e.g. right after a cached prefix).
+        new_mask = self._gedi_token_mask(cached_length, input_ids.shape[1])
+
+        gedi_model = PlugAndBlendLogitsProcessor.get_gedi_model()
+        attention_mask = self._gedi_attention_mask
+        label_mask = None
+        if attention_mask is None and new_mask is None:
+            gedi_outputs = gedi_model(input_ids=new_tokens,
+                                      past_key_values=past_key_values,
+                                      use_cache=True)
+        else:
+            if attention_mask is None:
+                attention_mask = torch.ones((new_tokens.shape[0], cached_length + 2), dtype=torch.long, device=device)
+            else:
+                attention_mask = attention_mask.index_select(0, gedi_rows)
+            if new_mask is None:
+                new_mask = torch.ones_like(new_tokens)
+            position_ids = (torch.sum(attention_mask, dim=1, keepdim=True) + torch.cumsum(new_mask, dim=1) - 1)
+            attention_mask = torch.cat((attention_mask, new_mask), dim=1)
+            # The last cached position is never padding.
+            label_mask = torch.cat((torch.ones_like(new_mask[:, :1]), new_mask), dim=1)
+            gedi_outputs = gedi_model(input_ids=new_tokens,
+                                      past_key_values=past_key_values,
+                                      attention_mask=attention_mask,
+                                      position_ids=position_ids,
+                                      use_cache=True)
+
+        # The first new token was predicted by the last step; the rest by this forward.
+        log_probs = previous_log_probs.unsqueeze(1)
+        if new_tokens.shape[1] > 1:
+            log_probs = torch.cat((log_probs, torch.log_softmax(gedi_outputs["logits"][:, :-1, :], -1)), dim=1)
+        logits_r = logits_r + torch.sum(self._label_log_likelihoods(log_probs, new_tokens, label_mask), 1)
+        next_token_log_probs = torch.log_softmax(gedi_outputs["logits"][:, -1, :], -1)
+
+        self._cached_input_ids = input_ids
+        self._past_key_values = gedi_outputs["past_key_values"]
+        self._gedi_attention_mask = attention_mask
+        self._next_token_log_probs = next_token_log_probs
+        self._logits_r = logits_r
+
+        return next_token_log_probs, logits_r
+
+
+class SentenceBoundaryStoppingCriteria(StoppingCriteria):
+    """
+    Follows, for every request of a batch, when all of its rows have finished their first sentence (see update(),
+    used by BatchSampler so that requests stop on their own), and stops `generate` once every request has.
+
+    Only the first generated sentence is kept (see cut_into_sentences), so every token after it is wasted.
+    A sentence counts as finished once the next one has started, so that abbreviations ("Mr.") do not end it early.
+    A finished row stays finished as it grows (beam search may reorder rows, they are followed by their prefixes),
+    so only rows still in their first sentence are decoded at each step.
+    The token budget (max_length) still applies as the fallback.
+    """
 
-        # print(torch.sum(final_modifier[0,:1000]))
+    def __init__(self, tokenizer, prompt_length, rows_per_request=None):
+        """
+        :param tokenizer: tokenizer of the base model.
+        :param prompt_length: length of the (padded) prompt; only tokens after it are considered.
+        :param rows_per_request: rows of each request in the batch (candidates * beams); None if all rows belong to
+        one request.
+        """
+        self.tokenizer = tokenizer
+        self.prompt_length = prompt_length
+        self.rows_per_request = rows_per_request
+
+        # Whether each row of the last call has finished its first sentence, and the rows themselves.
+        self.finished_rows = None
+        self.last_input_ids = None
+        # For each request, tokens generated when all its rows had finished their first sentence; None until then.
+        self.finished_at = None
+
+    def update(self, input_ids):
+        """
+        Check the rows that are still in their first sentence.
+        :param input_ids: [row, seq].
+        :return: list with, for each request, True if it is finished.
+        """
+        row_count = input_ids.shape[0]
+        rows_per_request = self.rows_per_request if self.rows_per_request is not None else row_count
+        if self.finished_at is None:
+            self.finished_at = [None] * (row_count // rows_per_request)
+
+        finished = torch.zeros(row_count, dtype=torch.bool)
+        if self.finished_rows is not None:
+            parent_rows = PlugAndBlendFusedLogitsProcessor._match_rows(input_ids, self.last_input_ids)
+            if parent_rows is not None:
+                finished = self.finished_rows[parent_rows]
+        for row in (~finished).nonzero().view(-1).tolist():
+            text = self.tokenizer.decode(input_ids[row, self.prompt_length:], skip_special_tokens=True)
+            if len(cut_into_sentences(text)) >= 2:
+                finished[row] = True
+        self.finished_rows = finished
+        self.last_input_ids = input_ids
+
+        step = input_ids.shape[1] - self.prompt_length
+        for request, rows in enumerate(finished.view(-1, rows_per_request)):
+            if self.finished_at[request] is None and bool(rows.all()):
+                self.finished_at[request] = step
+        return [item is not None for item in self.finished_at]
+
+    def keep_requests(self, requests):
+        """
+        Drop requests (e.g. finished ones) from the batch followed by this criterion.
+        :param requests: indices of the requests to keep, in order.
+        :return: None.
+        """
+        if self.finished_rows is None:
+            return
+        rows_per_request = self.rows_per_request if self.rows_per_request is not None else \
+            self.finished_rows.shape[0]
+        rows = (torch.tensor(requests).view(-1, 1) * rows_per_request + torch.arange(rows_per_request)).view(-1)
+        self.finished_rows = self.finished_rows[rows]
+        self.last_input_ids = self.last_input_ids[rows.to(self.last_input_ids.device)]
+        self.finished_at = [self.finished_at[request] for request in requests]
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> bool:
+        return all(self.update(input_ids))
+
+
+class StepCallbackCriteria(StoppingCriteria):
+    """
+    Never stops generating: hands the tokens generated so far to callbacks at every step,
+    e.g. to stream partial outputs while decoding.
+    Put it first in the StoppingCriteriaList, so that criteria stopping generation do not skip it. SpeculativeDecoder
+    checks criteria after every token, the last one included (`generate` would skip the last step, as its max length
+    criterion comes first).
+    """
 
-        return final_modifier
+    def __init__(self, callbacks, prompt_length):
+        """
+        :param callbacks: dict, row of the `generate` batch -> function taking the generated token ids of that row.
+        :param prompt_length: length of the (padded) prompt; only tokens after it are passed.
+        """
+        self.callbacks = callbacks
+        self.prompt_length = prompt_length
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> bool:
+        for row, callback in self.callbacks.items():
+            callback(input_ids[row, self.prompt_length:].tolist())
+        return False
 
 
 # Wrapper for the logits processor.
 class PNBWorkflow:
-    def __init__(self, config=None):
+    def __init__(self, config=None, loader=None):
+        """
+        Create the workflow and load its models.
+        :param config: dict of configurations.
+        :param loader: (optional) ModelLoader (see Addons/startup.py) that loads the models and times them;
+        if None, models are loaded right away.
+        """
         if config is None:
             config = {}
         print("Transformers version: %s (PnB Tested on 4.16.2~)" % transformers.__version__)
         print("Start loading models with config %s" % config)
         print("(Hint: If failed, check out https://colab.research.google.com/drive/1nuxJ7eGHu3WSGui3WT5cJjxR49R_Lg41?usp=sharing ")
+        self.tokenizer = None
+        self.model = None
+        # Serve the base model and GeDi with dynamic int8 quantization (CPU only).
+        self.int8_cpu = config.get('int8_cpu', False)
+        if self.int8_cpu and device.type != "cpu":
+            print("WARNING! int8_cpu is only supported on CPU. Using float models on %s." % device)
+            self.int8_cpu = False
+        if loader is None:
+            def load(component, load_function):
+                load_function()
+        else:
+            load = loader.submit
+        # Base model and GeDi are independent, so a background loader loads them in parallel.
+        load("base model", lambda: self._load_base_model(config))
+        load_gedi = None
+        if 'gedi_weights' in config:
+            load_gedi = lambda: self._load_gedi(config['gedi_weights'], memory_mapped=True, int8=self.int8_cpu)
+        elif 'gedi_location' in config:
+            load_gedi = lambda: self._load_gedi(config['gedi_location'], int8=self.int8_cpu)
+        if load_gedi is not None:
+            if config.get('lazy_gedi', False):
+                # Only guided requests need GeDi; load it on the first one (see get_gedi_model()).
+                PlugAndBlendLogitsProcessor.gedi_loader = load_gedi
+            else:
+                load("gedi", load_gedi)
+        load("gedi tokenizer", PlugAndBlendLogitsProcessor.get_tokenizer)
+        # Beams per candidate (beam sampling); 1 samples every candidate directly.
+        self.num_beams = config.get('num_beams', 2)
+        # Sampling settings, shared by the batch sampler and the speculative decoder.
+        self.sampling_settings = {"repetition_penalty": 1.2, "no_repeat_ngram_size": 2, "min_new_tokens": 8,
+                                  "top_k": 50}
+        # Candidates are ranked by their log-probability, divided by their length to this power.
+        self.length_penalty = 0.8
+        # Speculative decoding: a small model (same tokenizer) drafts `speculative_tokens` tokens per base model
+        # forward. It samples exactly like num_beams=1, one row at a time.
+        self.draft_model = None
+        self.speculative_decoder = None
+        self.speculative_tokens = config.get('speculative_tokens', 4)
+        if 'draft_location' in config:
+            if self.num_beams != 1:
+                raise ValueError("Speculative decoding (draft_location) samples without beams, but num_beams is %s. "
+                                 "Set num_beams to 1 to use it." % self.num_beams)
+            load("draft model", lambda: self._load_draft_model(config))
+        # Reuse GeDi past_key_values between decoding steps (see PlugAndBlendFusedLogitsProcessor).
+        self.incremental_gedi = config.get('incremental_gedi', True)
+        # Stop decoding once the first sentence is finished instead of always using the whole token budget.
+        self.stop_at_sentence_end = config.get('stop_at_sentence_end', True)
+        # Cache model states of shared prompt prefixes (e.g. the initial prompt of a preset), bounded in MB.
+        self.prefix_cache = None
+        if config.get('prefix_cache_mb', 256) > 0:
+            self.prefix_cache = PrefixKVCache(max_bytes=config.get('prefix_cache_mb', 256) * 1024 * 1024)
+        # Prefixes to look for, in addition to the `prefix` field of request bodies.
+        self.cached_prefixes = config.get('cached_prefixes', ["Story for kids: Once upon a time, "])
+        # Topics weighted below this (in absolute value) are dropped: they barely change the output but each one
+        # costs GeDi rows. Requests left without topics are generated without GeDi at all.
+        self.min_topic_weight = config.get('min_topic_weight', 0.005)
+        # Steps GeDi guidance runs on, e.g. {"stride": 2, "first_tokens": 16, "decay": 0.95}; every step by default.
+        self.guidance_schedule = GuidanceSchedule.from_config(config.get('guidance_schedule', None))
+        # Token budget of each generation.
+        self.max_new_tokens = 32
+        # Generation samples from torch's global RNG, so callers (batch scheduler, stream server, direct calls) take
+        # turns; otherwise a concurrent call would consume random numbers of a seeded request.
+        self.generate_lock = threading.Lock()
+        # Fixing compatibility problems for bad words
+        bad_word_ids_raw = [7, 58, 62, 834, 17569, 1427, 29343, 25947, 37405, 2602]  # ",(,[ and different length of _s
+        self.bad_word_ids = [[x] for x in bad_word_ids_raw]
+        # Responses of seeded requests are cached (in memory, and on disk if `response_cache_path` is set).
+        self.response_cache = None
+        if config.get('response_cache_size', 1024) > 0:
+            self.response_cache = ResponseCache(max_entries=config.get('response_cache_size', 1024),
+                                                disk_path=config.get('response_cache_path', None))
+        # Workflow settings that change outputs; part of response cache keys.
+        self.decode_settings = {
+            "base": config.get('base_weights',
+                               config.get('base_location', "gpt-j-6B" if 'slurm' in config else "gpt2")),
+            "gedi": config.get('gedi_weights', config.get('gedi_location')),
+            "int8_cpu": self.int8_cpu,
+            "incremental_gedi": self.incremental_gedi,
+            "stop_at_sentence_end": self.stop_at_sentence_end,
+            "max_new_tokens": self.max_new_tokens,
+            "num_beams": self.num_beams,
+            "omega": PlugAndBlendLogitsProcessor.omega,
+            "min_topic_weight": self.min_topic_weight,
+            "draft": config.get('draft_location'),
+            "speculative_tokens": self.speculative_tokens if 'draft_location' in config else None,
+        }
+        print("PNB Workflow initialized.")
+
+    def _load_base_model(self, config):
+        """
+        Load the base model and its tokenizer.
+        If `base_weights` is set, the weights are memory-mapped from that directory (see mmap_weights.py),
+        so that workers on the same machine share them.
+        :param config: see __init__.
+        :return: None.
+        """
         if 'slurm' in config:
             print("slurm parameter detected! Into deployment mode.")
             self.tokenizer = AutoTokenizer.from_pretrained("EleutherAI/gpt-j-6B")
-            self.model = GPTJForCausalLM.from_pretrained("EleutherAI/gpt-j-6B", torch_dtype=torch.float16).to(device)
+            if 'base_weights' in config:
+                print("Mapping base model weights at %s." % config['base_weights'])
+                self.model = load_pretrained(GPTJForCausalLM, config['base_weights']).to(device)
+            else:
+                # Quantization starts from float32 weights.
+                dtype = torch.float32 if self.int8_cpu else torch.float16
+                self.model = GPTJForCausalLM.from_pretrained("EleutherAI/gpt-j-6B", torch_dtype=dtype).to(device)
+        elif 'base_weights' in config:
+            print("Developer mode. Mapping base model weights at %s." % config['base_weights'])
+            self.tokenizer = PlugAndBlendLogitsProcessor.get_tokenizer()
+            self.model = load_pretrained(GPT2LMHeadModel, config['base_weights']).to(device)
+            self.model.config.pad_token_id = self.tokenizer.eos_token_id
         else:
             print("Developer mode. Loading smaller model...")
-            self.tokenizer = GPT2Tokenizer.from_pretrained("gpt2")
+            # Same tokenizer as GeDi, so it is shared.
+            self.tokenizer = PlugAndBlendLogitsProcessor.get_tokenizer()
             if 'base_location' in config:
                 base_location = config['base_location']
             else:
@@ -201,65 +1020,424 @@ class PNBWorkflow:
             print("Loading base model at %s." % base_location)
             self.model = GPT2LMHeadModel.from_pretrained(base_location, pad_token_id=self.tokenizer.eos_token_id).to(
                 device)
-        if 'gedi_location' in config:
-            PlugAndBlendLogitsProcessor.gedi_model = GPT2LMHeadModel.from_pretrained(config['gedi_location']).to(device)
-        print("PNB Workflow initialized.")
+        if self.int8_cpu:
+            print("Quantizing base model to int8.")
+            self.model = quantize_int8(self.model)
+
+    def _load_draft_model(self, config):
+        """
+        Load the draft model used for speculative decoding.
+        :param config: see __init__. `draft_location` is the path (or name) of a GPT-2 model.
+        :return: None.
+        """
+        print("Loading draft model at %s." % config['draft_location'])
+        # Same precision as the base model.
+        dtype = torch.float16 if 'slurm' in config and not self.int8_cpu else torch.float32
+        self.draft_model = GPT2LMHeadModel.from_pretrained(config['draft_location'], torch_dtype=dtype).to(device)
+        if self.int8_cpu:
+            print("Quantizing draft model to int8.")
+            self.draft_model = quantize_int8(self.draft_model)
+
+    @staticmethod
+    def _load_gedi(gedi_location, memory_mapped=False, int8=False):
+        """
+        Load the GeDi model shared by all logits processors.
+        :param gedi_location: path to GeDi model files.
+        :param memory_mapped: if True, `gedi_location` is a directory exported by mmap_weights.py.
+        :param int8: if True, quantize GeDi to int8 (CPU only).
+        :return: None.
+        """
+        if memory_mapped:
+            gedi_model = load_pretrained(GPT2LMHeadModel, gedi_location).to(device)
+        else:
+            gedi_model = GPT2LMHeadModel.from_pretrained(gedi_location).to(device)
+        if int8:
+            print("Quantizing GeDi to int8.")
+            gedi_model = quantize_int8(gedi_model)
+        PlugAndBlendLogitsProcessor.gedi_model = gedi_model
+
+    def __call__(self, body, step_callback=None):
+        return self.generate_batch([body], [step_callback])[0]
+
+    def stream(self, body, generate_function=None):
+        """
+        Generate for one request, yielding the partial output while decoding, so that callers can show text as soon
+        as the first tokens are out instead of waiting for the whole sentence.
+        :param body: request body, see __call__.
+        :param generate_function: (optional) function taking (body, step_callback) and returning the response,
+        e.g. a PNBBatchScheduler so that the request is still batched with others; this workflow by default.
+        :return: generator of dicts: {"partial": <text generated so far>} whenever the text changes, then
+        {"partial": <out_sentence of the response>, "replace": True}, then
+        {"done": True, "response": <response, as returned by __call__>,
+        "time_to_first_token": <seconds, None if nothing was generated>, "total_time": <seconds>}.
+        Partial text follows the current best beam of the first candidate, cut to its first sentence. With several
+        candidates, the one picked may be another, so the last partial (marked "replace") replaces the text shown.
+        """
+        if generate_function is None:
+            generate_function = self
+        start = time.time()
+        events = queue.Queue()
+
+        def run():
+            try:
+                events.put(("done", generate_function(body, lambda tokens: events.put(("tokens", tokens)))))
+            except Exception as e:
+                events.put(("error", e))
+
+        threading.Thread(target=run, daemon=True).start()
+
+        time_to_first_token = None
+        last_text = ""
+        pending = None
+        while True:
+            kind, item = pending if pending is not None else events.get()
+            pending = None
+            # Only decode the latest step if decoding fell behind, but still show it before the end.
+            while kind == "tokens" and not events.empty():
+                pending = events.get()
+                if pending[0] != "tokens":
+                    break
+                kind, item = pending
+                pending = None
+            if kind == "error":
+                raise item
+            if kind == "done":
+                if "out_sentence" in item:
+                    yield {"partial": item["out_sentence"], "replace": True}
+                yield {"done": True, "response": item, "time_to_first_token": time_to_first_token,
+                       "total_time": time.time() - start}
+                return
+            text = self.tokenizer.decode(item, skip_special_tokens=True).lstrip()
+            # Only the first sentence is kept in the response (see _build_response).
+            sentences = cut_into_sentences(text, do_cleanup=False)
+            if len(sentences) > 0:
+                text = sentences[0]
+            if text != last_text:
+                if time_to_first_token is None:
+                    time_to_first_token = time.time() - start
+                last_text = text
+                yield {"partial": text}
+
+    def batch_key(self, body):
+        """
+        Requests can only share one batch if their decode settings match.
+        :param body: request body.
+        :return: hashable key; requests with the same key can be batched by generate_batch().
+        """
+        return ('do_not_process' in body, int(body.get('num_candidates', 1)), body.get('seed'))
+
+    def generate_batch(self, bodies, step_callbacks=None, done_callbacks=None):
+        """
+        Generate for several requests in one padded batch.
+        Each request keeps its own prompt and topic weights, and leaves the batch as soon as it is finished.
+        Requests must share the same batch_key().
+        Requests with a `seed` (int) are deterministic: they are served from the response cache if possible,
+        and otherwise generated on their own with that seed.
+        :param bodies: list of request bodies, see __call__.
+        :param step_callbacks: (optional) list with, for each body, None or a function called at every decoding step
+        with the token ids generated so far (for the first candidate), see stream().
+        :param done_callbacks: (optional) list with, for each body, None or a function called with its response as
+        soon as it is ready, while the rest of the batch may still be decoding.
+        :return: list of responses, one for each body.
+        """
+        if step_callbacks is None:
+            step_callbacks = [None] * len(bodies)
+        if done_callbacks is None:
+            done_callbacks = [None] * len(bodies)
+        seed = bodies[0].get('seed')
+        if seed is None:
+            with self.generate_lock:
+                return self._generate_batch(bodies, step_callbacks, done_callbacks)
+
+        responses = []
+        for body, step_callback, done_callback in zip(bodies, step_callbacks, done_callbacks):
+            key = None
+            response = None
+            if self.response_cache is not None:
+                key = response_cache_key(body, dict(self.decode_settings,
+                                                    guidance_schedule=self.guidance_schedule.to_config()))
+                response = self.response_cache.get(key)
+            if response is not None:
+                response["cached"] = True
+            else:
+                # Sampling in a shared batch would depend on the other rows, so seeded requests run alone.
+                # The RNG state is restored afterwards, so the seed does not leak into later unseeded requests.
+                with self.generate_lock, torch.random.fork_rng(devices=[device] if device.type == "cuda" else []):
+                    torch.manual_seed(int(seed))
+                    response = self._generate_batch([body], [step_callback], [None])[0]
+                if key is not None:
+                    self.response_cache.put(key, response)
+            if done_callback is not None:
+                done_callback(response)
+            responses.append(response)
+        return responses
+
+    def stats(self):
+        """
+        :return: dict of cache statistics, for server metrics.
+        """
+        return {
+            "response_cache": self.response_cache.stats() if self.response_cache is not None else None,
+            "prefix_cache": self.prefix_cache.stats() if self.prefix_cache is not None else None,
+            "speculative": self.speculative_decoder.stats() if self.speculative_decoder is not None else None,
+        }
 
-    def __call__(self, body):
+    def _generate_batch(self, bodies, step_callbacks, done_callbacks):
+        """
+        Generate for several requests in one padded batch. See generate_batch().
+        """
+        sentences = []
+        topics = []
+        for body in bodies:
+            # default sentence
+            sentence = 'Here is a story. Once upon a time,'
+            if 'sentence' in body:
+                sentence = body['sentence']
+            else:
+                print("Using default prompt: %s" % sentence)
 
-        # Fixing compatibility problems for bad words
-        bad_word_ids_raw = [7, 58, 62, 834, 17569, 1427, 29343, 25947, 37405, 2602]  # ",(,[ and different length of _s
-        bad_word_ids = [[x] for x in bad_word_ids_raw]
+            if 'topic' in body:
+                topic = body['topic']
+            else:
+                print("Topic not specified! Using dummy topics with 0 weight.")
+                topic = {"dummy": 0}
+
+            sentences.append(sentence)
+            topics.append(topic)
+
+        encoded = [self.tokenizer.encode(sentence) for sentence in sentences]
+
+        # Candidates of each request are sampled in the same batch and filtered afterwards.
+        num_candidates = int(bodies[0].get('num_candidates', 1))
+        num_beams = self.num_beams
+
+        # Start from cached states of a shared prompt prefix, if there is one.
+        prefix_ids = None
+        if self.prefix_cache is not None:
+            prefix_ids = self._find_shared_prefix(bodies, encoded)
+        if self.draft_model is not None:
+            return self._generate_speculative(bodies, sentences, topics, encoded, prefix_ids, num_candidates,
+                                              step_callbacks, done_callbacks)
+
+        # Pad prompts with eos so that every row continues from the same position: on the left, or right after the
+        # shared prefix ([prefix][padding][rest]) so that every row still starts with the cached prefix.
+        pad_token_id = self.tokenizer.eos_token_id
+        pad_at = len(prefix_ids) if prefix_ids is not None else 0
+        prompt_length = max(len(item) for item in encoded)
+        input_ids = torch.tensor([item[:pad_at] + [pad_token_id] * (prompt_length - len(item)) + item[pad_at:]
+                                  for item in encoded]).to(device)
+        attention_mask = torch.tensor([[1] * pad_at + [0] * (prompt_length - len(item)) + [1] * (len(item) - pad_at)
+                                       for item in encoded]).to(device)
+        is_padded = not bool(attention_mask.all())
+
+        past = None
+        if prefix_ids is not None:
+            past = self._prompt_past(prefix_ids, input_ids, attention_mask, expansion=num_candidates * num_beams)
+
+        # One fused processor for all topics: one GeDi forward per step regardless of topic count.
+        # Without any topic left (e.g. no sketch), this is plain sampling from the base model.
+        guidance = [{key: value for key, value in topic.items() if abs(value) >= self.min_topic_weight}
+                    for topic in topics]
+        processor = None
+        if any(len(item) > 0 for item in guidance):
+            processor = PlugAndBlendFusedLogitsProcessor(
+                topics=guidance, incremental=self.incremental_gedi,
+                prompt_attention_mask=attention_mask if is_padded else None,
+                prefix_cache=self.prefix_cache if prefix_ids else None,
+                prefix_length=len(prefix_ids) if prefix_ids else 0,
+                schedule=self.guidance_schedule)
+
+        # Stop each request as soon as its first sentence is done, unless the caller wants the raw output.
+        max_new_tokens = self.max_new_tokens
+        sentence_end = None
+        if self.stop_at_sentence_end and 'do_not_process' not in bodies[0]:
+            sentence_end = SentenceBoundaryStoppingCriteria(self.tokenizer, input_ids.shape[-1],
+                                                            rows_per_request=num_candidates * num_beams)
+
+        responses = [None] * len(bodies)
+
+        def finish(index, result):
+            # Called as soon as a request is finished; the others may still be decoding.
+            candidates = [self._extract_sentence(bodies[index], sentences[index], row) for row in result["sequences"]]
+            responses[index] = self._build_response(bodies[index], sentences[index], topics[index], candidates,
+                                                    result["scores"], result["generated_tokens"], max_new_tokens)
+            if done_callbacks[index] is not None:
+                done_callbacks[index](responses[index])
+
+        sampler = BatchSampler(self.model, num_beams=num_beams, length_penalty=self.length_penalty,
+                               bad_words_ids=self.bad_word_ids, pad_token_id=pad_token_id,
+                               eos_token_id=self.tokenizer.eos_token_id, **self.sampling_settings)
+        sampler.generate(input_ids, attention_mask,
+                         num_return_sequences=num_candidates,
+                         max_new_tokens=max_new_tokens,
+                         logits_processor=processor,
+                         past=past,
+                         sentence_end=sentence_end,
+                         step_callbacks=step_callbacks,
+                         done_callback=finish)
+        return responses
+
+    def _generate_speculative(self, bodies, sentences, topics, encoded, prefix_ids, num_candidates, step_callbacks,
+                              done_callbacks):
+        """
+        Generate with speculative decoding (see speculative.py), one request and one candidate at a time.
+        Samples like _generate_batch() with num_beams=1; candidates are ranked by the same length-normalized
+        log-probability.
+        :param bodies: request bodies.
+        :param sentences: prompt of each request.
+        :param topics: topic weights of each request.
+        :param encoded: token ids of each prompt.
+        :param prefix_ids: token ids of a cached prefix shared by every prompt, or None.
+        :param num_candidates: candidates per request.
+        :param step_callbacks: see generate_batch().
+        :param done_callbacks: see generate_batch().
+        :return: list of responses, one for each body.
+        """
+        if self.speculative_decoder is None:
+            self.speculative_decoder = SpeculativeDecoder(self.model, self.draft_model,
+                                                          draft_tokens=self.speculative_tokens,
+                                                          bad_words_ids=self.bad_word_ids,
+                                                          eos_token_id=self.tokenizer.eos_token_id,
+                                                          **self.sampling_settings)
+        max_new_tokens = self.max_new_tokens
+        responses = []
+        for body, sentence, topic, prompt_ids, step_callback, done_callback in zip(bodies, sentences, topics, encoded,
+                                                                                   step_callbacks, done_callbacks):
+            input_ids = torch.tensor([prompt_ids], device=device)
+            guidance = {key: value for key, value in topic.items() if abs(value) >= self.min_topic_weight}
+            past = None
+            if prefix_ids is not None:
+                past = self._prompt_past(prefix_ids, input_ids, torch.ones_like(input_ids), expansion=1)
+
+            candidates = []
+            scores = []
+            generated_tokens = 0
+            for candidate in range(num_candidates):
+                stopping_criteria = StoppingCriteriaList()
+                # Only the first candidate is streamed.
+                if step_callback is not None and candidate == 0:
+                    stopping_criteria.append(StepCallbackCriteria({0: step_callback}, input_ids.shape[-1]))
+                if self.stop_at_sentence_end and 'do_not_process' not in body:
+                    stopping_criteria.append(SentenceBoundaryStoppingCriteria(self.tokenizer, input_ids.shape[-1]))
+                # The decoder applies the schedule itself, so that draft and verify share modifiers.
+                processor = None
+                if len(guidance) > 0:
+                    processor = PlugAndBlendFusedLogitsProcessor(topics=guidance, incremental=self.incremental_gedi,
+                                                                 prefix_cache=self.prefix_cache if prefix_ids else None,
+                                                                 prefix_length=len(prefix_ids) if prefix_ids else 0)
+                output_ids, log_prob = self.speculative_decoder.generate(input_ids, max_new_tokens,
+                                                                         guidance=processor,
+                                                                         schedule=self.guidance_schedule,
+                                                                         stopping_criteria=stopping_criteria,
+                                                                         past=past)
+                generated_tokens = max(generated_tokens, output_ids.shape[-1] - input_ids.shape[-1])
+                candidates.append(self._extract_sentence(body, sentence, output_ids[0]))
+                # Same normalization as BatchSampler.
+                scores.append(log_prob / output_ids.shape[-1] ** self.length_penalty)
+            response = self._build_response(body, sentence, topic, candidates, scores, generated_tokens,
+                                            max_new_tokens)
+            if done_callback is not None:
+                done_callback(response)
+            responses.append(response)
+        return responses
+
+    def _find_shared_prefix(self, bodies, encoded):
+        """
+        Find a known prompt prefix shared by every prompt in the batch.
+        :param bodies: request bodies; their optional `prefix` field is tried first.
+        :param encoded: token ids of every prompt.
+        :return: token ids of the prefix, or None.
+        """
+        candidates = [body['prefix'] for body in bodies if 'prefix' in body] + self.cached_prefixes
+        for text in candidates:
+            tokens = self.tokenizer.encode(text)
+            # The last token may merge with what follows (e.g. a trailing space), so it may have to go.
+            for prefix_ids in [tokens, tokens[:-1]]:
+                # Leave at least one prompt token for the sampler to feed.
+                if len(prefix_ids) > 1 and all(item[:len(prefix_ids)] == prefix_ids and len(item) > len(prefix_ids)
+                                               for item in encoded):
+                    return prefix_ids
+        return None
+
+    def _prompt_past(self, prefix_ids, input_ids, attention_mask, expansion):
+        """
+        Build past_key_values covering all but the last prompt token, starting from the cached prefix state.
+        :param prefix_ids: token ids of the shared prefix.
+        :param input_ids: prompts, [batch, seq]; all start with the prefix, padding (if any) right after it.
+        :param attention_mask: attention mask of the prompts, [batch, seq].
+        :param expansion: rows per prompt (candidates * beams).
+        :return: past_key_values for BatchSampler.generate(), [batch * expansion, ...].
+        """
+        key = ("base", tuple(prefix_ids))
+        with torch.no_grad():
+            past = self.prefix_cache.get(key)
+            if past is None:
+                past = self.model(torch.tensor([prefix_ids], device=device), use_cache=True).past_key_values
+                self.prefix_cache.put(key, past)
+
+            batch_size = input_ids.shape[0]
+            past = tuple(tuple(item.expand(batch_size, -1, -1, -1) for item in layer) for layer in past)
+
+            # The sampler feeds the last prompt token itself.
+            suffix = input_ids[:, len(prefix_ids):-1]
+            if suffix.shape[1] > 0:
+                # Padding does not count in positions, like in the sampler.
+                position_ids = attention_mask.long().cumsum(-1) - 1
+                position_ids.masked_fill_(attention_mask == 0, 1)
+                past = self.model(input_ids=suffix, past_key_values=past, attention_mask=attention_mask[:, :-1],
+                                  position_ids=position_ids[:, len(prefix_ids):-1], use_cache=True).past_key_values
+
+            return tuple(tuple(item.repeat_interleave(expansion, dim=0) for item in layer) for layer in past)
+
+    def _build_response(self, body, sentence, topic, candidates, scores, generated_tokens, max_new_tokens):
+        """
+        Pick the best candidate that contains none of the banned substrings.
+        :param body: request body. `banned_substrings` (list of str) is used for filtering if present.
+        :param sentence: prompt used.
+        :param topic: topic weights used.
+        :param candidates: generated sentences of this request.
+        :param scores: scores of the candidates (length-normalized log-probabilities).
+        :param generated_tokens: decoding steps taken.
+        :param max_new_tokens: token budget of this generation.
+        :return: response dict.
+        """
+        banned_substrings = body.get('banned_substrings', [])
+
+        ranked = []
+        for candidate, score in zip(candidates, scores):
+            is_clean = not any(item in candidate for item in banned_substrings)
+            ranked.append({"out_sentence": candidate, "score": score, "clean": is_clean})
+        # Clean candidates first, then by score.
+        ranked.sort(key=lambda x: (not x["clean"], -x["score"]))
+
+        if not ranked[0]["clean"]:
+            print("Warning! All %s candidates contain banned substrings." % len(ranked))
 
-        # default sentence
-        sentence = 'Here is a story. Once upon a time,'
-        if 'sentence' in body:
-            sentence = body['sentence']
-        else:
-            print("Using default prompt: %s" % sentence)
+        response = {
+            "in_sentence": sentence,
+            "topics": topic,
+            "out_sentence": ranked[0]["out_sentence"],
+            "clean": ranked[0]["clean"],
+            "generated_tokens": generated_tokens,
+            # Decoding steps skipped thanks to stopping at the end of the sentence.
+            "tokens_saved": max_new_tokens - generated_tokens,
+        }
+        if len(ranked) > 1:
+            response["candidates"] = ranked
 
-        if 'topic' in body:
-            topic = body['topic']
-        else:
-            print("Topic not specified! Using dummy topics with 0 weight.")
-            topic = {"dummy": 0}
-
-        lp_raw_list = []
-        for key, value in topic.items():
-            lp_raw_list.append(PlugAndBlendLogitsProcessor(topic=key, weight=value))
-
-        # print("Original: %s" % sentence)
-        #
-        input_ids = self.tokenizer.encode(sentence, return_tensors='pt').to(device)
-
-        #
-        # decode_test_sentence = PlugAndBlendLogitsProcessor.tokenizer.decode(input_ids[0], skip_special_tokens=True)
-        #
-        # print("Re-decoded: %s" % decode_test_sentence)
-
-        # input_ids = torch.cat([input_ids,input_ids,input_ids],dim=0)
-
-        # lp_list = LogitsProcessorList()
-        lp_list = LogitsProcessorList(lp_raw_list)
-
-        output = self.model.generate(
-            input_ids,
-            max_length=32 + input_ids.shape[-1],
-            min_length=8 + input_ids.shape[-1],
-            logits_processor=lp_list,
-            do_sample=True,
-            num_beams=2,
-            no_repeat_ngram_size=2,
-            repetition_penalty=1.2,
-            length_penalty=0.8,
-            bad_words_ids=bad_word_ids,
-        )
-        # print("Output:\n" + 100 * '-')
-        out_sentence = self.tokenizer.decode(output[0], skip_special_tokens=True)
+        return response
 
-        raw_out_sentence = out_sentence
+    def _extract_sentence(self, body, sentence, output_ids):
+        """
+        Cut the generated sentence out of one output row.
+        :param body: request body.
+        :param sentence: prompt used.
+        :param output_ids: generated token ids of this row, prompt (and padding) included.
+        :return: generated sentence.
+        """
+        out_sentence = self.tokenizer.decode(output_ids, skip_special_tokens=True)
 
-        # print("RAW: %s" % raw_out_sentence)
+        raw_out_sentence = out_sentence
 
         length_of_prompt = len(sentence)
 
@@ -278,23 +1456,7 @@ class PNBWorkflow:
             # Throw away processed results
             out_sentence = raw_out_sentence
 
-        response = {
-            "in_sentence": sentence,
-            "topics": topic,
-            "out_sentence": out_sentence,
-        }
-
-        # print(response)
-
-        return response
-
-        # greedy_output = model.generate(
-        #     input_ids,
-        #     max_length=50,
-        #     logits_processor=lp_list,
-        # )
-        # print("Output:\n" + 100 * '-')
-        # print(tokenizer.decode(greedy_output[0], skip_special_tokens=True))
+        return out_sentence
 
 
 # Tests
@@ -0,0 +1,92 @@
+"""
+prefix_cache.py
+
+Memory-bounded LRU cache for model states (past_key_values and friends) of frequently used prompt prefixes.
+
+Every sentence of a story is generated from a prompt starting with the same initial prompt, so the base model and
+GeDi can start from a cached state and only encode the rest of the prompt.
+"""
+
+import threading
+from collections import OrderedDict
+
+import torch
+
+
+class PrefixKVCache:
+    """
+    LRU cache keyed by hashable keys (e.g. token id tuples), holding nested tuples of tensors.
+    Least recently used entries are evicted once the total tensor size exceeds `max_bytes`.
+    Cached tensors are shared with callers and must not be modified in place.
+    """
+
+    def __init__(self, max_bytes):
+        """
+        :param max_bytes: memory bound of all cached tensors, in bytes.
+        """
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def size_of(value):
+        """
+        Total size of all tensors in a (nested) tuple or list.
+        :param value: tensor, or nested tuples/lists of tensors.
+        :return: size in bytes.
+        """
+        if isinstance(value, torch.Tensor):
+            return value.element_size() * value.nelement()
+        if isinstance(value, (tuple, list)):
+            return sum(PrefixKVCache.size_of(item) for item in value)
+        return 0
+
+    def get(self, key):
+        """
+        Look up an entry and mark it as recently used.
+        :param key: key of the entry.
+        :return: cached value, or None if missing.
+        """
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key][0]
+
+    def put(self, key, value):
+        """
+        Add an entry, evicting least recently used entries to stay within the memory bound.
+        Entries larger than the bound are not cached.
+        :param key: key of the entry.
+        :param value: tensor, or nested tuples/lists of tensors.
+        :return: None.
+        """
+        size = PrefixKVCache.size_of(value)
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.total_bytes -= self.entries.pop(key)[1]
+            self.entries[key] = (value, size)
+            self.total_bytes += size
+            while self.total_bytes > self.max_bytes:
+                _, (_, evicted_size) = self.entries.popitem(last=False)
+                self.total_bytes -= evicted_size
+
+    def stats(self):
+        """
+        :return: dict of cache statistics.
+        """
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "bytes": self.total_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
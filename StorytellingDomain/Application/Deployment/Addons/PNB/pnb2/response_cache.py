@@ -0,0 +1,33 @@
+"""
+response_cache.py
+
+Cache of PNB responses for seeded requests.
+
+A request with a `seed` is deterministic: the same prompt, topic weights, decode settings and seed give the same
+response, so it can be served from a previous run instead of a full guided decode.
+Responses are kept in a ResponseCache (see Addons/response_cache.py), by the key built here.
+"""
+
+import hashlib
+import json
+
+
+def response_cache_key(body, decode_settings):
+    """
+    Canonical hash of everything that decides the response of a seeded request.
+    :param body: request body, with `seed`.
+    :param decode_settings: dict of workflow-wide settings that change outputs (models, token budget...).
+    :return: hex digest.
+    """
+    # Topics with zero weight do not change the output.
+    topic = {key: float(value) for key, value in body.get('topic', {"dummy": 0}).items() if value != 0}
+    canonical = {
+        "sentence": body.get('sentence'),
+        "topic": topic,
+        "seed": int(body['seed']),
+        "num_candidates": int(body.get('num_candidates', 1)),
+        "banned_substrings": sorted(body.get('banned_substrings', [])),
+        "do_not_process": 'do_not_process' in body,
+        "settings": decode_settings,
+    }
+    return hashlib.sha256(json.dumps(canonical, sort_keys=True).encode("utf-8")).hexdigest()
@@ -0,0 +1,256 @@
+"""
+speculative.py
+
+Speculative decoding of the base model (GPT-J) with a small draft model (GPT-2).
+
+The draft model proposes a few tokens one by one, and the base model scores all of them in a single forward.
+Each proposed token is accepted with probability min(1, p / q), where p and q are the base and draft
+probabilities of that token; the first rejected token is replaced by a sample of the residual
+norm(max(p - q, 0)), and if every token is accepted one more token is sampled from p. The output then follows
+exactly the distribution of sampling from the base model alone, whatever the draft model is; a better draft
+model only means more accepted tokens per base model forward.
+
+Both distributions go through the same logits processors, PnB topic modifiers included. Modifiers only depend
+on the prefix, so they are computed once per prefix and shared by the draft and verify passes.
+"""
+
+import math
+import threading
+
+import torch
+from transformers import LogitsProcessorList, RepetitionPenaltyLogitsProcessor, NoRepeatNGramLogitsProcessor, \
+    NoBadWordsLogitsProcessor, MinLengthLogitsProcessor, TopKLogitsWarper
+
+
+class GuidanceModifiers:
+    """
+    Scores added by a PnB processor for every prefix of one sequence, memoised by prefix.
+    """
+
+    def __init__(self, processor, schedule, prompt_length, vocab_size):
+        """
+        :param processor: PlugAndBlendFusedLogitsProcessor for one row, guiding at every step (default schedule).
+        :param schedule: (optional) GuidanceSchedule, applied here so that draft and verify share modifiers.
+        :param prompt_length: length of the prompt, in tokens.
+        :param vocab_size: vocabulary size of the base model.
+        """
+        self.processor = processor
+        self.schedule = schedule
+        self.prompt_length = prompt_length
+        self.vocab_size = vocab_size
+        self.memo = {}
+
+    def __call__(self, input_ids, target_device):
+        """
+        :param input_ids: prefix, [1, seq].
+        :param target_device: device of the scores.
+        :return: scores to add, [1, vocab]; or None if this step is not guided.
+        """
+        step = input_ids.shape[1] - self.prompt_length
+        scale = 1
+        compute_step = step
+        if self.schedule is not None:
+            scale = self.schedule.weight_scale(step)
+            if scale == 0:
+                # Tokens beyond GeDi's vocabulary (GPT-J) stay suppressed whatever the schedule.
+                if self.vocab_size <= self.processor.gedi_vocab_size:
+                    return None
+                zeros = torch.zeros((1, self.vocab_size), device=target_device)
+                return self.processor.suppress_extra_tokens(input_ids, zeros)
+            # Steps between two computations reuse the modifiers of the last computed step.
+            compute_step = step - step % self.schedule.stride
+
+        key = tuple(input_ids[0, :self.prompt_length + compute_step].tolist())
+        if key not in self.memo:
+            zeros = torch.zeros((1, self.vocab_size), device=target_device)
+            self.memo[key] = self.processor(input_ids[:, :len(key)], zeros)
+        if scale == 1:
+            return self.memo[key]
+        # Only GeDi modifiers are scaled, not the suppression of extra tokens.
+        scores = self.memo[key].clone()
+        scores[..., :self.processor.gedi_vocab_size] *= scale
+        return scores
+
+
+class SpeculativeDecoder:
+    """
+    Samples one row at a time from `model`, drafting `draft_tokens` tokens per step with `draft_model`.
+
+    The logits processors mirror the sampling settings of PNBWorkflow (repetition penalty, no repeated bigrams,
+    bad words, minimum length, top-k), applied to raw logits in the same order as `generate(do_sample=True)`, so
+    this samples like BatchSampler with one beam (see experiments/check_speculative_decoding.py).
+    Both models must share the tokenizer; draft tokens beyond the draft vocabulary are never proposed.
+    """
+
+    def __init__(self, model, draft_model, draft_tokens=4, repetition_penalty=1.2, no_repeat_ngram_size=2,
+                 bad_words_ids=None, min_new_tokens=8, top_k=50, eos_token_id=50256):
+        """
+        :param model: base model, verifying the drafts.
+        :param draft_model: small model proposing tokens.
+        :param draft_tokens: tokens proposed per base model forward.
+        :param repetition_penalty: see transformers.RepetitionPenaltyLogitsProcessor.
+        :param no_repeat_ngram_size: see transformers.NoRepeatNGramLogitsProcessor.
+        :param bad_words_ids: (optional) list of banned token id sequences.
+        :param min_new_tokens: eos is banned before this many new tokens.
+        :param top_k: only sample among the top_k tokens (0 to disable).
+        :param eos_token_id: end of text token.
+        """
+        self.model = model
+        self.draft_model = draft_model
+        self.draft_tokens = draft_tokens
+        self.repetition_penalty = repetition_penalty
+        self.no_repeat_ngram_size = no_repeat_ngram_size
+        self.bad_words_ids = bad_words_ids
+        self.min_new_tokens = min_new_tokens
+        self.top_k = top_k
+        self.eos_token_id = eos_token_id
+        self.vocab_size = model.config.vocab_size
+
+        self.lock = threading.Lock()
+        self.drafted = 0
+        self.accepted = 0
+        self.target_forwards = 0
+        self.generated = 0
+
+    def _processors(self, prompt_length):
+        processors = LogitsProcessorList()
+        if self.repetition_penalty is not None and self.repetition_penalty != 1:
+            processors.append(RepetitionPenaltyLogitsProcessor(penalty=self.repetition_penalty))
+        if self.no_repeat_ngram_size:
+            processors.append(NoRepeatNGramLogitsProcessor(self.no_repeat_ngram_size))
+        if self.bad_words_ids:
+            processors.append(NoBadWordsLogitsProcessor(self.bad_words_ids, self.eos_token_id))
+        if self.min_new_tokens:
+            processors.append(MinLengthLogitsProcessor(prompt_length + self.min_new_tokens, self.eos_token_id))
+        return processors
+
+    def _distribution(self, input_ids, logits, processors, modifiers):
+        """
+        Next token distribution after every processor.
+        :param input_ids: prefix, [1, seq].
+        :param logits: raw logits of the next token, [1, model vocab]; may be smaller than the base vocabulary.
+        :param processors: see _processors().
+        :param modifiers: GuidanceModifiers, or None.
+        :return: probabilities, [vocab].
+        """
+        scores = torch.full((1, self.vocab_size), -float("inf"), device=logits.device)
+        scores[:, :logits.shape[-1]] = logits[:, :self.vocab_size]
+        scores = processors(input_ids, scores)
+        if modifiers is not None:
+            guidance = modifiers(input_ids, scores.device)
+            if guidance is not None:
+                scores += guidance
+        if self.top_k:
+            scores = TopKLogitsWarper(top_k=self.top_k)(input_ids, scores)
+        return torch.softmax(scores, dim=-1)[0]
+
+    @staticmethod
+    def _trim(past, length):
+        return tuple(tuple(item[:, :, :length] for item in layer) for layer in past)
+
+    def generate(self, input_ids, max_new_tokens, guidance=None, schedule=None, stopping_criteria=None, past=None):
+        """
+        Sample one continuation.
+        :param input_ids: prompt, [1, seq], not padded.
+        :param max_new_tokens: token budget.
+        :param guidance: (optional) PlugAndBlendFusedLogitsProcessor for this row, with the default schedule.
+        :param schedule: (optional) GuidanceSchedule of the guidance.
+        :param stopping_criteria: (optional) StoppingCriteriaList, checked after every new token.
+        :param past: (optional) base model past_key_values of all but the last prompt token (e.g. from a prefix
+        cache).
+        :return: prompt and generated tokens [1, seq], and the log-probability of the generated tokens (float).
+        """
+        prompt_length = input_ids.shape[1]
+        processors = self._processors(prompt_length)
+        modifiers = None
+        if guidance is not None:
+            modifiers = GuidanceModifiers(guidance, schedule, prompt_length, self.vocab_size)
+
+        ids = input_ids
+        # Model states cover the first `*_length` tokens of `ids`, always fewer than all of them.
+        target_past, target_length = None, 0
+        if past is not None:
+            target_past, target_length = past, input_ids.shape[1] - 1
+        draft_past, draft_length = None, 0
+        drafted_count = accepted_count = target_forwards = 0
+        log_prob = 0.0
+
+        with torch.no_grad():
+            finished = False
+            while not finished and ids.shape[1] - prompt_length < max_new_tokens:
+                length = ids.shape[1]
+                # Accepted drafts plus the extra token must fit in the budget.
+                gamma = min(self.draft_tokens, max_new_tokens - (length - prompt_length) - 1)
+
+                drafted = ids
+                draft_probs = []
+                for _ in range(gamma):
+                    outputs = self.draft_model(input_ids=drafted[:, draft_length:], past_key_values=draft_past,
+                                               use_cache=True)
+                    draft_past, draft_length = outputs.past_key_values, drafted.shape[1]
+                    q = self._distribution(drafted, outputs.logits[:, -1, :], processors, modifiers)
+                    token = torch.multinomial(q, 1)
+                    draft_probs.append(q)
+                    drafted = torch.cat((drafted, token.view(1, 1)), dim=1)
+
+                # One base model forward scores every drafted position.
+                outputs = self.model(input_ids=drafted[:, target_length:], past_key_values=target_past, use_cache=True)
+                target_forwards += 1
+                offset = length - 1 - target_length
+                # New tokens, with their probability under the base distribution p.
+                new_tokens = []
+                new_probs = []
+                for index in range(gamma + 1):
+                    p = self._distribution(drafted[:, :length + index], outputs.logits[:, offset + index, :],
+                                           processors, modifiers)
+                    if index == gamma:
+                        new_tokens.append(torch.multinomial(p, 1))
+                        new_probs.append(p[new_tokens[-1]].item())
+                        break
+                    token = drafted[0, length + index]
+                    q = draft_probs[index]
+                    if torch.rand(()).item() * q[token].item() < p[token].item():
+                        new_tokens.append(token.view(1))
+                        new_probs.append(p[token].item())
+                        continue
+                    residual = (p - q).clamp_(min=0)
+                    if residual.sum() <= 0:
+                        residual = p
+                    new_tokens.append(torch.multinomial(residual / residual.sum(), 1))
+                    new_probs.append(p[new_tokens[-1]].item())
+                    break
+
+                accepted = len(new_tokens) - 1
+                drafted_count += gamma
+                accepted_count += accepted
+                # Drop states of rejected drafts.
+                target_past, target_length = self._trim(outputs.past_key_values, length + accepted), length + accepted
+                if draft_past is not None and draft_length > length + accepted:
+                    draft_past, draft_length = self._trim(draft_past, length + accepted), length + accepted
+
+                for token, probability in zip(new_tokens, new_probs):
+                    ids = torch.cat((ids, token.view(1, 1).to(ids.device)), dim=1)
+                    log_prob += math.log(probability)
+                    if token.item() == self.eos_token_id or \
+                            (stopping_criteria is not None and stopping_criteria(ids, None)):
+                        finished = True
+                        break
+
+        with self.lock:
+            self.drafted += drafted_count
+            self.accepted += accepted_count
+            self.target_forwards += target_forwards
+            self.generated += ids.shape[1] - prompt_length
+        return ids, log_prob
+
+    def stats(self):
+        """
+        :return: dict of draft statistics, for server metrics.
+        """
+        with self.lock:
+            return {
+                "drafted": self.drafted,
+                "accepted": self.accepted,
+                "acceptance_rate": self.accepted / self.drafted if self.drafted > 0 else 0,
+                "tokens_per_forward": self.generated / self.target_forwards if self.target_forwards > 0 else 0,
+            }
@@ -0,0 +1,93 @@
+"""
+story.py
+
+Whole-story generation on the PNB side.
+
+Generates every sentence of a story in one request, composing prompts and topic weights the same way
+StoryCreativeContext does, and yields each sentence as soon as it is done.
+"""
+
+from StorytellingDomain.Application.Utils.StoryPrompt import get_sentence_topics, get_sentence_prompt
+
+
+def check_story_request(body):
+    """
+    Check a story request before anything is generated, so that bad requests can be refused up front.
+    :param body: request body, see generate_story().
+    :return: None. Raises AttributeError if the request is malformed.
+    """
+    if not isinstance(body, dict):
+        raise AttributeError("Bad request.")
+    if "initial_prompt" not in body or "sentence_count" not in body or "topic_weight" not in body:
+        raise AttributeError("Bad request.")
+    try:
+        sentence_count = int(body["sentence_count"])
+        int(body.get("max_horizon", 2))
+        int(body.get("num_candidates", 1))
+    except (TypeError, ValueError):
+        raise AttributeError("Bad request.")
+    if len(body.get("document", [""] * sentence_count)) != sentence_count or \
+            len(body.get("freeze_mask", [False] * sentence_count)) != sentence_count:
+        raise AttributeError("document and freeze_mask must have sentence_count items.")
+
+
+def generate_story(body, generate_sentence, stream_sentence=None):
+    """
+    Generate a story sentence by sentence.
+    The request is checked (see check_story_request()) before the generator is returned.
+    :param body: request body with:
+        initial_prompt: prompt every sentence prompt starts with.
+        sentence_count: number of sentences.
+        topic_weight: dict, key is topic and value is the list of weights for every sentence
+            (as in StorySketchManager.generate_weights()).
+        document: (optional) current sentences; frozen ones are kept and used as context.
+        freeze_mask: (optional) list of bool, True for sentences that should not be regenerated.
+        max_horizon, num_candidates, banned_substrings: (optional) see StoryCreativeContext.
+        stream_tokens: (optional) if true, also yield the partial text of each sentence while it is generated.
+    :param generate_sentence: callable taking a /api/pnb request body and returning its response.
+    :param stream_sentence: (optional) callable taking a /api/pnb request body and returning a generator of events,
+    see PNBWorkflow.stream(); needed for `stream_tokens`.
+    :return: generator of dicts {"index": <int>, "sentence": <generated sentence, or None if frozen>};
+    with `stream_tokens`, preceded for each sentence by dicts {"index": <int>, "partial": <text generated so far>}
+    (the last one, with "replace": True, holds the sentence picked, see PNBWorkflow.stream()).
+    """
+    check_story_request(body)
+    return _generate_sentences(body, generate_sentence, stream_sentence)
+
+
+def _generate_sentences(body, generate_sentence, stream_sentence):
+    initial_prompt = body["initial_prompt"]
+    sentence_count = int(body["sentence_count"])
+    topic_weight = body["topic_weight"]
+    max_horizon = int(body.get("max_horizon", 2))
+    document = list(body.get("document", [""] * sentence_count))
+    freeze_mask = list(body.get("freeze_mask", [False] * sentence_count))
+
+    for index in range(sentence_count):
+        if freeze_mask[index]:
+            yield {"index": index, "sentence": None}
+            continue
+
+        sentence_body = {
+            "sentence": get_sentence_prompt(initial_prompt, document, index, max_horizon),
+            "topic": get_sentence_topics(topic_weight, index, sentence_count),
+            "prefix": initial_prompt,
+            "num_candidates": int(body.get("num_candidates", 1)),
+        }
+        if "banned_substrings" in body:
+            sentence_body["banned_substrings"] = body["banned_substrings"]
+
+        if body.get("stream_tokens", False) and stream_sentence is not None:
+            response = None
+            for event in stream_sentence(sentence_body):
+                if "partial" in event:
+                    partial = {"index": index, "partial": event["partial"]}
+                    if event.get("replace", False):
+                        partial["replace"] = True
+                    yield partial
+                else:
+                    response = event["response"]
+        else:
+            response = generate_sentence(sentence_body)
+        document[index] = response["out_sentence"]
+        yield {"index": index, "sentence": document[index]}
@@ -0,0 +1,96 @@
+"""
+stream_server.py
+
+Companion HTTP server for the PNB tool, serving routes whose results are streamed back
+(the addon server answers every request with a single JSON body).
+
+Results are sent as newline-delimited JSON, one object per line, flushed as soon as each one is ready.
+"""
+
+import json
+import threading
+
+from flask import Flask, Response, request, stream_with_context
+from flask_cors import CORS
+
+
+class PNBStreamServer:
+    def __init__(self, tool, port=8766):
+        """
+        Create the server.
+        :param tool: PNBTool whose models are used.
+        :param port: port to listen on.
+        """
+        self.tool = tool
+        self.port = port
+
+        self.app = Flask(__name__)
+        CORS(self.app)
+        self.register_routes()
+
+    def register_routes(self):
+        """
+        Register all flask routes.
+        :return: None.
+        """
+        self.app.route("/api/pnb_story", methods=['POST'])(self.handle_story)
+        self.app.route("/api/pnb_stream", methods=['POST'])(self.handle_stream)
+
+    def start_server(self):
+        """
+        Start serving in a background thread.
+        :return: None.
+        """
+        t = threading.Thread(target=self.app.run,
+                             kwargs={"host": "0.0.0.0", "port": self.port, "threaded": True},
+                             daemon=True)
+        t.start()
+        print("PNB stream server started on port %s." % self.port)
+
+    @staticmethod
+    def stream_json_lines(results):
+        """
+        Wrap a generator of dicts into a streamed newline-delimited JSON response.
+        :param results: generator of JSON-serializable objects.
+        :return: flask Response.
+        """
+
+        def generate():
+            try:
+                for item in results:
+                    yield json.dumps(item) + "\n"
+            except Exception as e:
+                # The status line is already sent: report the failure as the last line instead.
+                print("Streamed request failed: %s" % e)
+                yield json.dumps({"error": str(e)}) + "\n"
+
+        return Response(stream_with_context(generate()), mimetype="application/x-ndjson")
+
+    @staticmethod
+    def bad_request(message):
+        """
+        Answer a request that was refused before anything was streamed.
+        :param message: error message.
+        :return: flask Response with status 400.
+        """
+        return Response(json.dumps({"error": message}), status=400, mimetype="application/json")
+
+    def handle_stream(self):
+        """
+        Generate one sentence, streaming the partial text as tokens are generated. See PNBTool.stream().
+        """
+        try:
+            results = self.tool.stream(request.get_json(silent=True))
+        except AttributeError as e:
+            return self.bad_request(str(e))
+        return self.stream_json_lines(results)
+
+    def handle_story(self):
+        """
+        Generate a whole story, streaming each sentence back. See PNBTool.story().
+        """
+        try:
+            results = self.tool.story(request.get_json(silent=True))
+        except AttributeError as e:
+            return self.bad_request(str(e))
+        return self.stream_json_lines(results)
@@ -0,0 +1,180 @@
+"""
+mmap_weights.py
+
+Memory-mapped model weights.
+
+Weights are exported once into a flat file (`weights.bin`, every tensor at an aligned offset) with an index
+(`weights.json`). Loading maps that file copy-on-write and wraps each tensor around the mapping without copying,
+so every addon worker on the same machine shares the same physical pages (the OS page cache), and starting
+another worker only costs page-in time. A worker writing to its weights gets private copies of the pages it
+writes to; the file is never modified.
+
+Models have to stay on CPU and in the exported dtype to keep sharing pages: moving them to a GPU or casting them
+copies the weights (loading is still fast, since the file is read from the page cache).
+
+Export with:
+    python -m StorytellingDomain.Application.Deployment.Addons.mmap_weights hf <model location> <output dir> [dtype]
+    python -m StorytellingDomain.Application.Deployment.Addons.mmap_weights state_dict <.pt file> <output dir> [dtype]
+"""
+
+import json
+import os
+import sys
+
+import numpy
+import torch
+
+WEIGHTS_FILE = "weights.bin"
+INDEX_FILE = "weights.json"
+
+# Offsets of tensors are aligned to this many bytes.
+ALIGNMENT = 64
+
+# dtypes numpy can map directly; bfloat16 is stored as int16 and reinterpreted.
+_numpy_dtypes = {
+    "float32": (numpy.float32, None),
+    "float16": (numpy.float16, None),
+    "bfloat16": (numpy.int16, torch.bfloat16),
+    "float64": (numpy.float64, None),
+    "int64": (numpy.int64, None),
+    "int32": (numpy.int32, None),
+    "int8": (numpy.int8, None),
+    "uint8": (numpy.uint8, None),
+    "bool": (numpy.bool_, None),
+}
+
+
+def export_weights(state_dict, output_dir, dtype=None):
+    """
+    Write a state dict in the memory-mappable format.
+    Tensors sharing storage (e.g. tied embeddings) are only written once.
+    :param state_dict: dict, key is the name and value is the tensor.
+    :param output_dir: directory to write `weights.bin` and `weights.json` into.
+    :param dtype: (optional) torch dtype that floating point tensors are converted to before writing.
+    :return: None.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    index = {}
+    written = {}
+    offset = 0
+    with open(os.path.join(output_dir, WEIGHTS_FILE), "wb") as f:
+        for name, tensor in state_dict.items():
+            key = (tensor.data_ptr(), tuple(tensor.shape), tensor.dtype)
+            if key in written:
+                index[name] = {"alias": written[key]}
+                continue
+
+            tensor = tensor.detach().cpu().contiguous()
+            if dtype is not None and tensor.is_floating_point():
+                tensor = tensor.to(dtype)
+            dtype_name = str(tensor.dtype).replace("torch.", "")
+            if dtype_name not in _numpy_dtypes:
+                raise ValueError("Unsupported dtype %s for %s." % (dtype_name, name))
+            if tensor.dtype == torch.bfloat16:
+                tensor = tensor.view(torch.int16)
+
+            padding = (-offset) % ALIGNMENT
+            f.write(b"\0" * padding)
+            offset += padding
+            data = tensor.numpy().tobytes()
+            f.write(data)
+            index[name] = {"dtype": dtype_name, "shape": list(tensor.shape), "offset": offset}
+            written[key] = name
+            offset += len(data)
+
+    with open(os.path.join(output_dir, INDEX_FILE), "w") as f:
+        json.dump(index, f)
+    print("Exported %s tensors (%.1f MB) to %s." % (len(index), offset / 1024 / 1024, output_dir))
+
+
+def load_weights(weights_dir):
+    """
+    Map exported weights copy-on-write, without copying them.
+    :param weights_dir: directory written by export_weights().
+    :return: dict, key is the name and value is the tensor. Aliased names map to the same tensor.
+    Writing to a tensor is allowed, but copies the pages written to into this process (they are no longer shared)
+    and never changes the file.
+    """
+    with open(os.path.join(weights_dir, INDEX_FILE)) as f:
+        index = json.load(f)
+    # Copy-on-write: a read-only mapping would crash the process on an in-place write instead of raising.
+    mapping = numpy.memmap(os.path.join(weights_dir, WEIGHTS_FILE), dtype=numpy.uint8, mode="c")
+
+    weights = {}
+    for name, item in index.items():
+        if "alias" in item:
+            continue
+        numpy_dtype, torch_dtype = _numpy_dtypes[item["dtype"]]
+        count = int(numpy.prod(item["shape"])) if len(item["shape"]) > 0 else 1
+        size = count * numpy.dtype(numpy_dtype).itemsize
+        array = mapping[item["offset"]:item["offset"] + size].view(numpy_dtype).reshape(item["shape"])
+        tensor = torch.from_numpy(array)
+        if torch_dtype is not None:
+            tensor = tensor.view(torch_dtype)
+        weights[name] = tensor
+    for name, item in index.items():
+        if "alias" in item:
+            weights[name] = weights[item["alias"]]
+    return weights
+
+
+def attach_weights(model, weights):
+    """
+    Make the parameters and buffers of a model point to the given tensors, without copying them.
+    Parameters that share a tensor (tied weights) get the same Parameter.
+    :param model: torch.nn.Module, whose own (e.g. uninitialized) weights are dropped.
+    :param weights: dict from load_weights().
+    :return: the model.
+    """
+    expected = set(model.state_dict().keys())
+    missing = expected - set(weights.keys())
+    if len(missing) > 0:
+        raise KeyError("Missing weights: %s" % sorted(missing))
+
+    parameters = {}
+    for name, tensor in weights.items():
+        if name not in expected:
+            continue
+        module_name, _, attribute = name.rpartition(".")
+        module = model.get_submodule(module_name) if module_name != "" else model
+        if attribute in module._parameters:
+            if id(tensor) not in parameters:
+                parameters[id(tensor)] = torch.nn.Parameter(tensor, requires_grad=False)
+            module._parameters[attribute] = parameters[id(tensor)]
+        else:
+            module._buffers[attribute] = tensor
+    return model
+
+
+def load_pretrained(model_class, weights_dir):
+    """
+    Create a transformers model from an exported directory (config.json and memory-mapped weights),
+    like `model_class.from_pretrained()` but without reading or copying the weights.
+    :param model_class: transformers model class, e.g. GPT2LMHeadModel.
+    :param weights_dir: directory written by `export hf`.
+    :return: model in eval mode.
+    """
+    from transformers import AutoConfig
+    from transformers.modeling_utils import no_init_weights
+
+    config = AutoConfig.from_pretrained(weights_dir)
+    with no_init_weights():
+        model = model_class(config)
+    attach_weights(model, load_weights(weights_dir))
+    return model.eval()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 4 or sys.argv[1] not in ["hf", "state_dict"]:
+        print(__doc__)
+        sys.exit(1)
+    source, output = sys.argv[2], sys.argv[3]
+    target_dtype = getattr(torch, sys.argv[4]) if len(sys.argv) > 4 else None
+    if sys.argv[1] == "hf":
+        from transformers import AutoModelForCausalLM
+
+        hf_model = AutoModelForCausalLM.from_pretrained(source)
+        hf_model.config.save_pretrained(output)
+        export_weights(hf_model.state_dict(), output, dtype=target_dtype)
+    else:
+        export_weights(torch.load(source, map_location="cpu"), output, dtype=target_dtype)
@@ -0,0 +1,45 @@
+"""
+quantization.py
+
+Dynamic int8 quantization of addon models for CPU inference (PNB's base model and GeDi, CARP).
+
+Weights of linear layers are stored in int8 and activations are quantized on the fly, which makes CPU matrix
+multiplications several times faster than float32. GPT-2 (and so GeDi) implements its linear layers as
+transformers' Conv1D, which torch does not quantize, so they are turned into nn.Linear first.
+"""
+
+import torch
+from torch import nn
+
+try:
+    from transformers.pytorch_utils import Conv1D
+except ImportError:
+    # transformers < 4.18
+    from transformers.modeling_utils import Conv1D
+
+
+def conv1d_to_linear(model):
+    """
+    Replace every Conv1D of the model with an equivalent nn.Linear, in place.
+    :param model: torch.nn.Module.
+    :return: the model.
+    """
+    for module in list(model.modules()):
+        for child_name, child in list(module.named_children()):
+            if isinstance(child, Conv1D):
+                # Conv1D computes x @ weight + bias, with weight [in, out].
+                linear = nn.Linear(child.weight.shape[0], child.weight.shape[1])
+                linear.weight = nn.Parameter(child.weight.data.t().contiguous(), requires_grad=False)
+                linear.bias = nn.Parameter(child.bias.data.clone(), requires_grad=False)
+                setattr(module, child_name, linear)
+    return model
+
+
+def quantize_int8(model):
+    """
+    Quantize all linear layers of a model to int8 (dynamic quantization), in place. CPU only.
+    :param model: transformers model on CPU.
+    :return: quantized model, in eval mode.
+    """
+    model = conv1d_to_linear(model.float().cpu().eval())
+    return torch.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8, inplace=True)
@@ -0,0 +1,98 @@
+"""
+response_cache.py
+
+Bounded cache of JSON-serializable results of addon tools, by key.
+
+Entries live in an in-memory LRU, optionally backed by an SQLite file that survives restarts. Used by PNB for
+seeded requests and by CARP for paraphrases; keys are built by each tool.
+"""
+
+import copy
+import json
+import sqlite3
+import threading
+from collections import OrderedDict
+
+
+class ResponseCache:
+    """
+    LRU of responses by key, with an optional on-disk layer.
+    Responses are copied in and out, so callers can modify them.
+    """
+
+    def __init__(self, max_entries=1024, disk_path=None):
+        """
+        :param max_entries: maximum number of responses kept in memory.
+        :param disk_path: (optional) SQLite file keeping every response across restarts.
+        """
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+        self.connection = None
+        if disk_path is not None:
+            self.connection = sqlite3.connect(disk_path, check_same_thread=False)
+            self.connection.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, response TEXT)")
+            self.connection.commit()
+
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """
+        Look up a response, in memory first and then on disk.
+        :param key: str.
+        :return: copy of the response, or None if missing.
+        """
+        with self.lock:
+            if key in self.entries:
+                self.memory_hits += 1
+                self.entries.move_to_end(key)
+                return copy.deepcopy(self.entries[key])
+
+            if self.connection is not None:
+                row = self.connection.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+                if row is not None:
+                    self.disk_hits += 1
+                    response = json.loads(row[0])
+                    self._remember(key, response)
+                    return copy.deepcopy(response)
+
+            self.misses += 1
+            return None
+
+    def put(self, key, response):
+        """
+        Store a response.
+        :param key: str.
+        :param response: JSON-serializable response.
+        :return: None.
+        """
+        response = copy.deepcopy(response)
+        with self.lock:
+            self._remember(key, response)
+            if self.connection is not None:
+                self.connection.execute("INSERT OR REPLACE INTO responses (key, response) VALUES (?, ?)",
+                                        (key, json.dumps(response)))
+                self.connection.commit()
+
+    def _remember(self, key, response):
+        self.entries[key] = response
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def stats(self):
+        """
+        :return: dict of cache statistics.
+        """
+        with self.lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": (self.memory_hits + self.disk_hits) / lookups if lookups > 0 else 0,
+            }
@@ -0,0 +1,169 @@
+"""
+startup.py
+
+Model loading for addon tools: components load in parallel threads while the addon server is already up,
+followed by an optional warm-up pass, with per-component load times recorded in a startup report.
+
+Tools register their loader here, so that StartupStatusTool can answer readiness requests for all of them.
+"""
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows.
+    resource = None
+
+# All loaders created in this process, by tool name.
+loaders = {}
+
+
+def peak_rss_mb():
+    """
+    :return: peak resident memory of this process so far in MB (all tools together), or None if unknown.
+    """
+    if resource is None:
+        return None
+    # ru_maxrss is in kilobytes on Linux.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class ModelLoader:
+    """
+    Loads the components (models, tokenizers...) of one addon tool and keeps a startup report.
+
+    In background mode, every component loads in its own thread and the constructor of the tool returns at once,
+    so that all tools (and the server) start together; callers use wait() before serving requests.
+    Otherwise components load one after another in the calling thread, as before.
+    """
+
+    def __init__(self, name, background=False):
+        """
+        :param name: name of the tool, used in the startup report.
+        :param background: if True, load components in parallel threads.
+        """
+        self.name = name
+        self.background = background
+
+        self.start_time = time.time()
+        self.load_times = {}
+        # Peak RSS of the process (MB) when each component finished loading.
+        self.peak_rss = {}
+        self.warmup_time = None
+        self.error = None
+
+        self.futures = []
+        self.executor = ThreadPoolExecutor(thread_name_prefix="%s-loader" % name) if background else None
+        self.ready_event = threading.Event()
+
+        # (optional) function returning runtime metrics of the tool (cache hit rates...), see report().
+        self.metrics_function = None
+
+        loaders[name] = self
+
+    def submit(self, component, load_function):
+        """
+        Load one component.
+        :param component: name of the component, used in the startup report.
+        :param load_function: function taking no parameters that loads the component.
+        :return: None.
+        """
+        if self.background:
+            self.futures.append(self.executor.submit(self._timed, component, load_function))
+        else:
+            self._timed(component, load_function)
+
+    def finish(self, warmup_function=None):
+        """
+        Mark the end of submitted components. The tool becomes ready once they are loaded and warmed up.
+        :param warmup_function: (optional) function taking no parameters, run once everything is loaded.
+        :return: None.
+        """
+        if self.background:
+            threading.Thread(target=self._finish, args=(warmup_function,), daemon=True).start()
+        else:
+            self._finish(warmup_function)
+
+    def wait(self, timeout=None):
+        """
+        Block until the tool is ready.
+        :param timeout: seconds to wait at most, None to wait forever.
+        :return: None. Raises the loading error if loading failed, or TimeoutError.
+        """
+        if not self.ready_event.wait(timeout):
+            raise TimeoutError("%s is still loading." % self.name)
+        if self.error is not None:
+            raise self.error
+
+    def is_ready(self):
+        """
+        :return: True if all components are loaded and warmed up.
+        """
+        return self.ready_event.is_set() and self.error is None
+
+    def report(self):
+        """
+        :return: dict describing the startup of this tool.
+        """
+        if self.ready_event.is_set():
+            state = "failed" if self.error is not None else "ready"
+        else:
+            state = "loading"
+        return {
+            "state": state,
+            "load_times": dict(self.load_times),
+            "peak_rss_mb": dict(self.peak_rss),
+            "warmup_time": self.warmup_time,
+            "elapsed": time.time() - self.start_time,
+            "error": None if self.error is None else str(self.error),
+            "metrics": self.metrics_function() if self.metrics_function is not None else None,
+        }
+
+    def _timed(self, component, load_function):
+        start = time.time()
+        load_function()
+        self.load_times[component] = time.time() - start
+        self.peak_rss[component] = peak_rss_mb()
+        print("[%s] Loaded %s in %.1fs (peak RSS so far: %s MB)." % (
+            self.name, component, self.load_times[component],
+            "%.0f" % self.peak_rss[component] if self.peak_rss[component] is not None else "?"))
+
+    def _finish(self, warmup_function):
+        try:
+            for future in self.futures:
+                future.result()
+            if warmup_function is not None:
+                start = time.time()
+                warmup_function()
+                self.warmup_time = time.time() - start
+                print("[%s] Warm-up done in %.1fs." % (self.name, self.warmup_time))
+        except Exception as e:
+            print("[%s] Startup failed: %s" % (self.name, str(e)))
+            self.error = e
+            if not self.background:
+                self.ready_event.set()
+                raise
+        finally:
+            if self.executor is not None:
+                self.executor.shutdown(wait=False)
+        self.ready_event.set()
+        print("[%s] Startup report: %s" % (self.name, self.report()))
+
+
+class StartupStatusTool:
+    """
+    Readiness and metrics route: reports the startup state and runtime metrics of every tool in this addon server.
+    """
+
+    def __init__(self, config):
+        pass
+
+    def __call__(self, body):
+        tools = {name: loader.report() for name, loader in loaders.items()}
+        return {
+            "ready": all(item["state"] == "ready" for item in tools.values()),
+            "tools": tools,
+        }
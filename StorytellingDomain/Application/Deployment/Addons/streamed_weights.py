@@ -0,0 +1,208 @@
+"""
+streamed_weights.py
+
+Low-memory loading of `torch.save` checkpoints.
+
+`torch.load` reads a whole checkpoint into memory before it can be copied into a model, and the model itself
+usually holds freshly initialized (or pretrained) weights at the same time, so peak memory is at least twice the
+model size. Here, the model skeleton is created without weights (on the meta device), and checkpoint tensors are
+read from the checkpoint archive tensor by tensor, converted to the target dtype and device, and attached to the
+model. Each storage record is read once and only kept until its last tensor is read, so in practice only one
+record in the checkpoint dtype is in memory at a time.
+
+Checkpoints in the legacy (non-zip, torch < 1.6) format are loaded with `torch.load` instead.
+"""
+
+import pickle
+import threading
+import zipfile
+from contextlib import contextmanager
+
+import torch
+
+from StorytellingDomain.Application.Deployment.Addons.mmap_weights import attach_weights
+
+# Depth of empty_weights() contexts in each thread; modules created in a thread within one get parameters on the
+# meta device.
+_empty_weights_state = threading.local()
+# Threads within empty_weights(), and the functions patched while there are any.
+_patch_lock = threading.Lock()
+_patch_users = 0
+_originals = {}
+
+
+def _empty_weights_active():
+    return getattr(_empty_weights_state, "depth", 0) > 0
+
+
+def _empty(*args, **kwargs):
+    # torch.nn layers allocate their parameters with torch.empty(), then initialize them in place.
+    if _empty_weights_active() and kwargs.get("device") is None:
+        kwargs["device"] = "meta"
+    return _originals["empty"](*args, **kwargs)
+
+
+def _register_parameter(module, name, param):
+    # Parameters allocated otherwise (e.g. with an explicit device) are moved to the meta device.
+    if param is not None and _empty_weights_active() and param.device.type != "meta":
+        param = torch.nn.Parameter(param.to("meta"), requires_grad=param.requires_grad)
+    _originals["register_parameter"](module, name, param)
+
+
+@contextmanager
+def empty_weights():
+    """
+    Create modules without allocating their parameters. In this thread (and only this one, as other models may
+    load in parallel threads), `torch.empty` defaults to the meta device, so parameters are created there directly,
+    and parameters created otherwise are moved there when registered. Buffers are kept, unless created with
+    `torch.empty`. The patched functions are restored once no thread is within empty_weights() anymore.
+    """
+    global _patch_users
+    with _patch_lock:
+        if _patch_users == 0:
+            _originals["empty"] = torch.empty
+            _originals["register_parameter"] = torch.nn.Module.register_parameter
+            torch.empty = _empty
+            torch.nn.Module.register_parameter = _register_parameter
+        _patch_users += 1
+    _empty_weights_state.depth = getattr(_empty_weights_state, "depth", 0) + 1
+    try:
+        yield
+    finally:
+        _empty_weights_state.depth -= 1
+        with _patch_lock:
+            _patch_users -= 1
+            if _patch_users == 0:
+                torch.empty = _originals.pop("empty")
+                torch.nn.Module.register_parameter = _originals.pop("register_parameter")
+
+
+class _LazyStorage:
+    """
+    Storage record of a checkpoint, shared by the tensors viewing it. Read from the archive once, when the first
+    of them is materialized, and dropped once the last one is.
+    """
+
+    def __init__(self, archive, record, dtype):
+        self.archive = archive
+        self.record = record
+        self.dtype = dtype
+        self.users = 0
+        self.flat = None
+
+    def acquire(self):
+        """
+        :return: the whole storage, as a flat tensor.
+        """
+        if self.flat is None:
+            data = bytearray(self.archive.read(self.record))
+            if len(data) == 0:
+                self.flat = torch.empty(0, dtype=self.dtype)
+            else:
+                self.flat = torch.frombuffer(data, dtype=self.dtype)
+        return self.flat
+
+    def release(self):
+        """
+        Called once per viewing tensor, after it is materialized.
+        :return: None.
+        """
+        self.users -= 1
+        if self.users <= 0:
+            self.flat = None
+
+
+class _LazyTensor:
+    """
+    Tensor of a checkpoint, read when materialized.
+    """
+
+    def __init__(self, storage, storage_offset, size, stride, *args):
+        self.storage = storage
+        self.storage_offset = storage_offset
+        self.size = size
+        self.stride = stride
+        storage.users += 1
+
+    def materialize(self, dtype=None, device=None):
+        """
+        :param dtype: (optional) dtype floating point tensors are converted to.
+        :param device: (optional) device to move the tensor to.
+        :return: tensor.
+        """
+        tensor = self.storage.acquire().as_strided(self.size, self.stride, self.storage_offset)
+        if dtype is None or not tensor.is_floating_point():
+            dtype = tensor.dtype
+        # Copy, so that the tensor does not keep the whole storage alive.
+        tensor = tensor.to(device=device, dtype=dtype, copy=True)
+        self.storage.release()
+        return tensor
+
+
+class _LazyUnpickler(pickle.Unpickler):
+    def __init__(self, file, archive, prefix):
+        super().__init__(file)
+        self.archive = archive
+        self.prefix = prefix
+        # One _LazyStorage per storage record, so that views of the same storage share it.
+        self.storages = {}
+
+    def find_class(self, module, name):
+        if module == "torch._utils" and name == "_rebuild_tensor_v2":
+            return _LazyTensor
+        if module == "torch._utils" and name == "_rebuild_parameter":
+            return lambda data, *args: data
+        return super().find_class(module, name)
+
+    def persistent_load(self, saved_id):
+        typename, storage_type, key, location, numel = saved_id
+        if key not in self.storages:
+            self.storages[key] = _LazyStorage(self.archive, "%sdata/%s" % (self.prefix, key), storage_type.dtype)
+        return self.storages[key]
+
+
+def stream_state_dict(checkpoint_path, dtype=None, device=None):
+    """
+    Read a state dict tensor by tensor.
+    :param checkpoint_path: file written by `torch.save(state_dict)`.
+    :param dtype: (optional) dtype floating point tensors are converted to.
+    :param device: (optional) device tensors are moved to.
+    :return: generator of (name, tensor).
+    """
+    if not zipfile.is_zipfile(checkpoint_path):
+        print("%s is not a zip checkpoint; loading it at once." % checkpoint_path)
+        for name, tensor in torch.load(checkpoint_path, map_location="cpu").items():
+            yield name, tensor.to(device=device, dtype=dtype if tensor.is_floating_point() else tensor.dtype)
+        return
+
+    with zipfile.ZipFile(checkpoint_path) as archive:
+        pickle_name = [name for name in archive.namelist() if name.endswith("data.pkl")][0]
+        prefix = pickle_name[:-len("data.pkl")]
+        with archive.open(pickle_name) as f:
+            state_dict = _LazyUnpickler(f, archive, prefix).load()
+        for name in list(state_dict.keys()):
+            yield name, state_dict.pop(name).materialize(dtype=dtype, device=device)
+
+
+def load_streamed(model, checkpoint_path, dtype=None, device=None):
+    """
+    Load a checkpoint into a model created within empty_weights(), tensor by tensor.
+    :param model: torch.nn.Module.
+    :param checkpoint_path: file written by `torch.save(model.state_dict())`.
+    :param dtype: (optional) dtype floating point weights are converted to.
+    :param device: (optional) device of the weights.
+    :return: the model. Raises KeyError if the checkpoint misses parameters of the model.
+    """
+    weights = {}
+    for name, tensor in stream_state_dict(checkpoint_path, dtype=dtype, device=device):
+        weights[name] = tensor
+    # Buffers missing from the checkpoint (e.g. position ids) keep the values they were created with.
+    for name, buffer in model.named_buffers():
+        if name not in weights:
+            weights[name] = buffer.to(device=device)
+    attach_weights(model, weights)
+
+    unexpected = set(weights.keys()) - set(model.state_dict().keys())
+    if len(unexpected) > 0:
+        print("Ignored %s checkpoint tensors not in the model: %s" % (len(unexpected), sorted(unexpected)[:5]))
+    return model
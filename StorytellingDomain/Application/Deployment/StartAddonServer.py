@@ -7,6 +7,7 @@ Start an addon server for this domain.
 from CreativeWand.Addons.WebServer.AddonServer import run_addon_server
 from StorytellingDomain.Application.Deployment.Addons.PNB.endpoint import PNBTool
 from StorytellingDomain.Application.Deployment.Addons.CARP.endpoint import CARPTool
+from StorytellingDomain.Application.Deployment.Addons.startup import StartupStatusTool
 
 if __name__ == '__main__':
     """
@@ -21,6 +22,10 @@ if __name__ == '__main__':
                 "gedi_location": "/mnt/hdd/trained_models/gedi_base/gedi_topic/",
             }
         },
+        "status": {  # Readiness and startup report of all tools in this server.
+            "class": StartupStatusTool,
+            "config": {},
+        },
         "carp": {
             "file": "CARP.endpoint",
             "class": CARPTool,
@@ -74,6 +79,15 @@ if __name__ == '__main__':
             "func": None,
             "config": {
                 "carp_model_path": "Models/carp/CARP_L.pt",
+                # To share weights between workers, export them once (see Addons/mmap_weights.py) and set:
+                # "carp_weights": "Models/carp/CARP_L_mmap",
+                # To keep paraphrases of reviews across restarts:
+                # "paraphrase_cache_path": "Models/carp/paraphrases.sqlite",
+                # To skip softening and encoding of known critics, build a critic store once (see
+                # CARP/carp_service/critic_store.py) and set:
+                # "critic_store": "Models/carp/critics",  # also serves its critics to the v3 api (top-k retrieval)
+                "background_load": True,  # load models in parallel, see /api/status for readiness
+                "warmup": True,  # run one scoring pass before reporting ready
             }
         },
         "pnb-demo-release": {
@@ -84,6 +98,15 @@ if __name__ == '__main__':
             "config": {
                 "slurm": "yep",  # anything works here, this triggers routines for gpt-j
                 "gedi_location": "Models/gedi/gedi_topic",
+                # To share weights between workers, export them once (see Addons/mmap_weights.py) and set:
+                # "base_weights": "Models/gpt-j_mmap", "gedi_weights": "Models/gedi/gedi_topic_mmap",
+                # For speculative decoding (sampling without beam search), set a GPT-2 draft model:
+                # "draft_location": "gpt2", "speculative_tokens": 4,
+                "batch_window": 0.05,  # seconds to collect concurrent requests into one batch
+                "max_batch_size": 8,
+                "stream_port": 8766,  # serves /api/pnb_story (streamed)
+                "background_load": True,  # load models in parallel, see /api/status for readiness
+                "warmup": True,  # run one generation before reporting ready
             }
         },
         "pnb-demo-release-small": {
@@ -94,6 +117,34 @@ if __name__ == '__main__':
             "config": {
                 #"slurm": "yep",  # anything works here, this triggers routines for gpt-j
                 "gedi_location": "Models/gedi/gedi_topic",
+                "batch_window": 0.05,
+                "max_batch_size": 8,
+                "stream_port": 8766,
+                "background_load": True,
+                "warmup": True,
+            }
+        },
+        "pnb-cpu-int8": {  # CPU-only staging nodes
+            "external-name": "pnb",
+            "file": "PNB.endpoint",
+            "class": PNBTool,
+            "func": None,
+            "config": {
+                "gedi_location": "Models/gedi/gedi_topic",
+                "int8_cpu": True,  # dynamic int8 quantization of the base model and GeDi
+                "batch_window": 0.05,
+                "max_batch_size": 8,
+            }
+        },
+        "carp-cpu-int8": {  # CPU-only staging nodes
+            "external-name": "carp",
+            "file": "CARP.endpoint",
+            "class": CARPTool,
+            "func": None,
+            "config": {
+                "carp_model_path": "Models/carp/CARP_L.pt",
+                "device": "cpu",
+                "precision": "int8",  # or "fp32", "bf16"; see CARP/carp_service/experiments/benchmark_devices.py
             }
         },
 
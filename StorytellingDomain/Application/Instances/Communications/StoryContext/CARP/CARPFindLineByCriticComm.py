@@ -134,6 +134,25 @@ class CARPFindLineByDefaultCriticComm(CARPFindLineByCriticComm):
 
         self.default_critic_list = get_default_critics()
 
+    def choose_critic(self) -> str:
+        """
+        Pick one of the critics CARP finds most relevant to the story (from its critic library), or a random
+        default critic if the CARP server has no critic library.
+        :return: critic.
+        """
+        exp_manager = self.get_experience_manager()
+        try:
+            carp_result = exp_manager.creative_context.execute_query(
+                StoryContextQuery(q_type="carp_top_critics", content={"k": 3, "scope": "story"}))
+            critics = [critic for story_critics in carp_result.values() for critic in story_critics]
+        except RuntimeError as e:
+            print("CARP critic retrieval failed, using default critics: %s" % str(e))
+            critics = []
+        if len(critics) == 0:
+            critics = self.default_critic_list
+        # Among the best few, so that tips still vary.
+        return random.choice(critics)
+
     def activate(self) -> bool:
         exp_manager = self.get_experience_manager()
         result = self.do_first_time_introduction()
@@ -141,7 +160,7 @@ class CARPFindLineByDefaultCriticComm(CARPFindLineByCriticComm):
             return False
         exp_manager.frontend.send_information(Req(info_sentence_for_default_critic))
 
-        critic = random.choice(self.default_critic_list)
+        critic = self.choose_critic()
         exp_manager.frontend.send_information(
             Req("Let me look into if: %s" % critic))
 
@@ -181,7 +200,7 @@ class CARPFindByDefaultCriticComm(CARPFindLineByDefaultCriticComm):
             return False
         exp_manager.frontend.send_information(Req(info_sentence_for_default_critic))
 
-        critic = random.choice(self.default_critic_list)
+        critic = self.choose_critic()
         exp_manager.frontend.send_information(
             Req("Let me look into if: %s" % critic))
 
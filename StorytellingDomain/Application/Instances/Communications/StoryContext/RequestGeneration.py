@@ -3,6 +3,8 @@ RequestGeneration.py
 
 Initiate the generation process.
 """
+import uuid
+
 from CreativeWand.Framework.Frontend.BaseFrontEnd import BaseRequest as Req
 
 from StorytellingDomain.Application.Instances.Communications.StoryBaseCommunication import StoryBaseComm
@@ -63,16 +65,32 @@ class GenerateComm(StoryBaseComm):
         return True
 
     def call_gen_step_by_step(self, exp_manager):
+        # Frontends that can update a message in place (WebFrontend) show each sentence while it is generated.
+        send_partial = getattr(exp_manager.frontend, "send_partial_information", None)
+        run_id = uuid.uuid4().hex
+        # Indices whose sentence is shown in a partial bubble; the bubble is replaced by the final sentence.
+        streamed = set()
+        partial_callback = None
+        if send_partial is not None:
+            def partial_callback(idx, text):
+                streamed.add(idx)
+                send_partial(f"{run_id}-{idx}", f"Working on #{idx}: {text}")
         done = False
         while not done:
-            result = exp_manager.creative_context.execute_query(StoryContextQuery(q_type="generate_step_by_step"))
+            result = exp_manager.creative_context.execute_query(
+                StoryContextQuery(q_type="generate_step_by_step", partial_callback=partial_callback))
             done = result["done"]
             if done:
                 break
             sentence = result["sentence"]
             idx = result["index"]
             if sentence is not None:
-                exp_manager.frontend.send_information(Req(f"Working on #{idx}: {sentence}"))
+                if idx in streamed:
+                    # The candidate picked may not be the one streamed: replace the partial sentence in place.
+                    exp_manager.frontend.replace_partial_information(Req(f"Working on #{idx}: {sentence}"),
+                                                                     f"{run_id}-{idx}")
+                else:
+                    exp_manager.frontend.send_information(Req(f"Working on #{idx}: {sentence}"))
 
 
 class GenerateCommV2(StoryBaseComm):
@@ -155,16 +173,32 @@ class GenerateCommV2(StoryBaseComm):
             return True
 
     def call_gen_step_by_step(self, exp_manager):
+        # Frontends that can update a message in place (WebFrontend) show each sentence while it is generated.
+        send_partial = getattr(exp_manager.frontend, "send_partial_information", None)
+        run_id = uuid.uuid4().hex
+        # Indices whose sentence is shown in a partial bubble; the bubble is replaced by the final sentence.
+        streamed = set()
+        partial_callback = None
+        if send_partial is not None:
+            def partial_callback(idx, text):
+                streamed.add(idx)
+                send_partial(f"{run_id}-{idx}", f"Working on #{idx}: {text}")
         done = False
         while not done:
-            result = exp_manager.creative_context.execute_query(StoryContextQuery(q_type="generate_step_by_step"))
+            result = exp_manager.creative_context.execute_query(
+                StoryContextQuery(q_type="generate_step_by_step", partial_callback=partial_callback))
             done = result["done"]
             if done:
                 break
             sentence = result["sentence"]
             idx = result["index"]
             if sentence is not None:
-                exp_manager.frontend.send_information(Req(f"Working on #{idx}: {sentence}"))
+                if idx in streamed:
+                    # The candidate picked may not be the one streamed: replace the partial sentence in place.
+                    exp_manager.frontend.replace_partial_information(Req(f"Working on #{idx}: {sentence}"),
+                                                                     f"{run_id}-{idx}")
+                else:
+                    exp_manager.frontend.send_information(Req(f"Working on #{idx}: {sentence}"))
 
 
 class GenerateWithFreezeComm(GenerateComm):
@@ -4,11 +4,21 @@ StoryCreativeContext.py
 This file contains interface to connect with the story generator.
 """
 
+import json
+
+import requests
+
 from StorytellingDomain.Application.Utils.APICalls import default_connection_profile, call_generation_interface, \
-    call_carp_interface
+    call_carp_interface, call_carp_critic_retrieval_interface, call_story_generation_interface, \
+    is_story_generation_available, get_generation_candidates
+from StorytellingDomain.Application.Utils.StoryPrompt import get_sentence_topics, get_sentence_prompt
 from StorytellingDomain.Application.Utils.StorySketch import StorySketchManager
 from CreativeWand.Framework.CreativeContext.BaseCreativeContext import BaseCreativeContext, ContextQuery
 
+# Ways the story stream can break off; the rest of the story is then generated sentence by sentence.
+story_stream_errors = (StopIteration, requests.exceptions.RequestException, json.JSONDecodeError, RuntimeError,
+                       OSError)
+
 
 class StoryContextQuery(ContextQuery):
     """
@@ -21,7 +31,8 @@ class StoryContextQuery(ContextQuery):
                  content: object = None,
                  description: str = None,
                  range_start=0,
-                 range_end=0):
+                 range_end=0,
+                 partial_callback=None):
         """
         Create a new story context query.
         :param range_start: start of range to apply this query to
@@ -29,6 +40,8 @@ class StoryContextQuery(ContextQuery):
         :param range_end: end of range to apply this query to
         :param content: Topic to be used, or exact sentence.
         :param description:
+        :param partial_callback: (optional, generation queries) function called with (index, text generated so far)
+        while a sentence is being generated.
         """
         super(StoryContextQuery, self).__init__()
 
@@ -45,6 +58,8 @@ class StoryContextQuery(ContextQuery):
         # Additional messages (human readable, for debugging)
         self.description = description
 
+        self.partial_callback = partial_callback
+
 
 class StoryCreativeContext(BaseCreativeContext):
     """
@@ -98,6 +113,14 @@ class StoryCreativeContext(BaseCreativeContext):
         Initial prompt used in the story generation routine (generate()).
         """
 
+        # Number of candidates to generate per sentence, so that one without bad_generation_keyword can be picked.
+        # Every candidate is decoded, so this is set per API profile and kept low.
+        self.generation_candidates = get_generation_candidates(self.gen_api_profile)
+
+        # Generate whole stories server-side (one request, streamed back) if the API profile supports it.
+        self.use_story_api = is_story_generation_available(self.gen_api_profile)
+        self._story_stream = None
+
         # Internal switch used to indicate whether we need to regenerate,
         # because the parameters used to generate story had changed.
         self.should_regenerate = True
@@ -171,7 +194,7 @@ class StoryCreativeContext(BaseCreativeContext):
         elif query.type == "generated_contents":
             return self.get_generated_content()
         elif query.type == "generate_step_by_step":
-            return self.generate_step_by_step()
+            return self.generate_step_by_step(partial_callback=query.partial_callback)
         elif query.type == "generate_one":
             return self.generate_single_sentence(
                 prompt=query.content["prompt"],
@@ -201,6 +224,9 @@ class StoryCreativeContext(BaseCreativeContext):
                 )
         elif query.type == "carp_highlight":
             return self.get_carp_scores(reviews=query.content, threshold=0)
+        elif query.type == "carp_top_critics":
+            content = query.content if query.content is not None else {}
+            return self.get_carp_top_critics(k=content.get("k", 3), scope=content.get("scope", "story"))
         elif query.type == "get_document_filled":
             return self.is_document_filled()
 
@@ -240,64 +266,104 @@ class StoryCreativeContext(BaseCreativeContext):
             self.should_regenerate = False
         return self.document
 
-    def generate_step_by_step(self):
+    def generate_step_by_step(self, partial_callback=None):
         """
         Generate the next sentence up for generation.
+        If the generation API supports whole-story generation, the story is generated server-side in one request
+        and each call picks up the next sentence streamed back.
+        :param partial_callback: (optional) function called with (index, text generated so far) while the sentence
+        is being generated.
         """
         next_step = self.get_state("gen_next_step")
         if next_step is None:
             # Just starting
-            result = self.generate_one_in_story(0)
+            self._story_stream = None
+            if self.use_story_api:
+                self._story_stream = self.start_story_stream(stream_tokens=partial_callback is not None)
+            result = self.next_sentence_in_story(0, partial_callback)
             self.set_state("gen_next_step",1)
             return {"done":False,"index":0,"sentence":result}
         elif next_step == self.sentence_count:
             self.set_state("gen_next_step",None)
+            self._story_stream = None
             return {"done":True,"index":next_step,"sentence":None}
         else:
-            result = self.generate_one_in_story(next_step)
+            result = self.next_sentence_in_story(next_step, partial_callback)
             self.set_state("gen_next_step",next_step + 1)
             return {"done":False,"index":next_step,"sentence":result}
 
+    def start_story_stream(self, stream_tokens=False):
+        """
+        Request the whole story from the generation API, using the current document, freeze mask and topic weights.
+        :param stream_tokens: if True, partial sentences are streamed too (see call_story_generation_interface).
+        :return: generator of per-sentence results, or None if the API can not be reached.
+        """
+        old_document_exists = (len(self.document) == self.sentence_count)
+        freeze_mask = list(self.freeze_mask) if old_document_exists else [False] * self.sentence_count
+        stream = call_story_generation_interface(
+            initial_prompt=self.initial_prompt,
+            sentence_count=self.sentence_count,
+            document=list(self.document),
+            freeze_mask=freeze_mask,
+            topic_weight=self.topic_weight,
+            num_candidates=self.generation_candidates,
+            banned_substrings=self.bad_generation_keyword,
+            connection_profile=self.gen_api_profile,
+            stream_tokens=stream_tokens,
+        )
+        try:
+            # Fail early (and fall back to sentence by sentence generation) if the stream does not start.
+            first = next(stream)
+        except story_stream_errors as e:
+            print("Whole story generation unavailable (%s), generating sentence by sentence." % str(e))
+            return None
 
-    def generate_one_in_story(self, index, max_horizon = 2):
+        def chained():
+            yield first
+            yield from stream
+
+        return chained()
+
+    def next_sentence_in_story(self, index, partial_callback=None):
+        """
+        Get the sentence at `index`, from the story stream if there is one.
+        :param index: current index.
+        :param partial_callback: see generate_step_by_step.
+        :return: generated sentence, or None if the sentence is frozen.
+        """
+        if self._story_stream is None:
+            return self.generate_one_in_story(index, partial_callback=partial_callback)
+        try:
+            result = next(self._story_stream)
+            while "partial" in result:
+                if partial_callback is not None:
+                    partial_callback(result["index"], result["partial"])
+                result = next(self._story_stream)
+            if result["index"] != index:
+                raise RuntimeError("Story stream out of order: expected #%s, got #%s." % (index, result["index"]))
+        except story_stream_errors as e:
+            # This sentence and the following ones are generated one by one instead.
+            print("Story stream interrupted at #%s (%s), generating sentence by sentence." % (index, str(e)))
+            self._story_stream = None
+            return self.generate_one_in_story(index, partial_callback=partial_callback)
+        if result["sentence"] is not None:
+            self.document[index] = result["sentence"]
+        return result["sentence"]
+
+    def generate_one_in_story(self, index, max_horizon = 2, partial_callback=None):
         """
         Generate a single sentence in a story.
         :param index: current index this helper is working on.
         :param max_horizon: maximum previous sentences to append.
+        :param partial_callback: see generate_step_by_step.
         """
         old_document = self.document
         old_document_exists = (len(old_document) == self.sentence_count)
         # Compose topic list for each index position of the story.
-        topic_this_sentence = {}
-        for key, value in self.topic_weight.items():
-            topic_this_sentence[key] = value[index]
-        total_weight_this_sentence = sum(topic_this_sentence.values())
-        for key, value in topic_this_sentence.items():
-            if total_weight_this_sentence > 0:
-                normalized_value = value / total_weight_this_sentence
-                # Filtering weights that are too small - They do not really change the sentence but incur computation.
-                if normalized_value < 0.01 / self.sentence_count:
-                    normalized_value = 0
-                topic_this_sentence[key] = normalized_value
-        # Remove all keys that has weight = 0
-        topic_this_sentence = {k: v for k, v in topic_this_sentence.items() if v > 0}
+        topic_this_sentence = get_sentence_topics(self.topic_weight, index, self.sentence_count)
         # print("DEBUG: %s"%topic_this_sentence)
         # Attach one previous sentence (if we have at least two sentences) as the context (from original P&B work)
-
-        def get_previous(idx):
-            """
-            Get a previous sentence in the document. If not exist, return "".
-            :param idx: index of *current* sentence position.
-            """
-            if idx in range(len(self.document)):
-                return self.document[idx]
-            else:
-                return ""
-
-        prompt = f"{self.initial_prompt}"
-        for delta_idx in range(max_horizon):
-            # becasue delta_idx is from 0 to max_horizon-1 we need to subtract one extra.
-            prompt = f"{prompt} {get_previous(index-delta_idx-1)}"
+        prompt = get_sentence_prompt(self.initial_prompt, self.document, index, max_horizon)
 
         # if index >= 2:
         #     prompt = "Here is a story from a story book for children. %s %s " % (
@@ -311,14 +377,14 @@ class StoryCreativeContext(BaseCreativeContext):
 
         # If sentence is frozen masked we do not get the next sentence, instead take the one we have
         if not (old_document_exists and self.freeze_mask[index]):
-            for i in range(5): #max 5 attempts
-                next_sentence = call_generation_interface(prompt, topic=topic_this_sentence,
-                                                          connection_profile=self.gen_api_profile)
-                for item in self.bad_generation_keyword:
-                    if item in next_sentence:
-                        print(f"Found a bad generation: {next_sentence}. Regenerating...")
-                        continue
-                break
+            # Candidates are sampled in one batch and filtered by the server.
+            next_sentence = call_generation_interface(prompt, topic=topic_this_sentence,
+                                                      connection_profile=self.gen_api_profile,
+                                                      num_candidates=self.generation_candidates,
+                                                      banned_substrings=self.bad_generation_keyword,
+                                                      prefix=self.initial_prompt,
+                                                      partial_callback=None if partial_callback is None else
+                                                      lambda text: partial_callback(index, text))
             self.document[index] = next_sentence
             return next_sentence
         else:
@@ -441,6 +507,22 @@ class StoryCreativeContext(BaseCreativeContext):
         )
         return result
 
+    def get_carp_top_critics(self, k=3, scope="story"):
+        """
+        Ask CARP which critics of its critic library match the current document best.
+        :param k: number of critics.
+        :param scope: "story" for critics of the whole document, "line" for critics of every line.
+        :return: dict, key is the document (or each line), value is a dict of the best critics and their scores.
+        """
+        print("Requesting CARP v3...")
+        return call_carp_critic_retrieval_interface(
+            stories=self.document,
+            k=k,
+            scope=scope,
+            connection_profile=None if 'carp' not in self.api_profile else self.api_profile[
+                'carp'],
+        )
+
     def get_all_topic_weights(self):
         """
         Get all topic weights.
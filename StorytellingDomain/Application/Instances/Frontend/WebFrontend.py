@@ -31,6 +31,28 @@ class WebFrontend(BaseFrontend):
         options = info.info['options'] if 'options' in info.info else None
         self.server_obj.send_chat_message(info.message, self.id, wait=False, options=options)
 
+    def send_partial_information(self, stream_id: str, message: str, done: bool = False):
+        """
+        Show a message that is still being written (e.g. a sentence while it is generated) in one chat bubble,
+        updated in place by every call with the same stream_id.
+        Partial messages are not logged; send the final message with replace_partial_information().
+        :param stream_id: identifies the bubble to update.
+        :param message: current text.
+        :param done: if True, `message` is the final text and the bubble stops updating.
+        :return: None.
+        """
+        self.server_obj.send_partial_message(message, self.id, stream_id, done)
+
+    @BaseFrontend.save_logs
+    def replace_partial_information(self, info: BaseRequest, stream_id: str):
+        """
+        Replace the text of a partial message (see send_partial_information()) with the final message.
+        :param info: final message.
+        :param stream_id: identifies the bubble to replace.
+        :return: None.
+        """
+        self.send_partial_information(stream_id, info.message, done=True)
+
     def set_information(self, info: object):
         raise NotImplementedError("This frontend does not support user providing information without a request.")
         pass
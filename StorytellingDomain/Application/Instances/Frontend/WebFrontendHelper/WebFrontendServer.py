@@ -119,6 +119,20 @@ class WebFrontendServer():
         else:
             return
 
+    def send_partial_message(self, message, session_id, stream_id, done=False):
+        """
+        Send (or update) a message still being written to the React frontend. Messages with the same stream_id
+        are shown in the same chat bubble; unlike send_chat_message, this does not wait, as it is sent many times
+        per second while tokens are generated.
+        :param message: Payload.
+        :param session_id: Which session to send the message to.
+        :param stream_id: Which bubble to update.
+        :param done: If True, `message` is final: the bubble shows it and stops updating.
+        :return: None.
+        """
+        self.socketio.emit('partial_message', {"message": message, "id": session_id, "stream": stream_id,
+                                               "done": done})
+
     # def send_doc(doc, sketch, session_id):
     #     send_object(event='document', obj={"document": doc, "sketch": sketch, "id": session_id})
     #     # socketio.emit('document', {"document": doc, "sketch": sketch}, json=True)
@@ -6,8 +6,11 @@ This file contains endpoints shared by multiple modules of the Application.
 """
 
 # region api calls
+import json
 from typing import Union
 
+import requests
+
 from CreativeWand.Utils.Network.RemoteAPI import RemoteAPIInterface
 from StorytellingDomain.Application.Config.CreativeContextConfig import available_configs, available_carp_configs
 
@@ -15,16 +18,32 @@ default_connection_profile = "local"
 
 default_carp_connection_profile = "local"
 
+# Candidates sampled per sentence when the profile does not set `generation_candidates`.
+default_generation_candidates = 2
+
+# (connect, read) timeouts, in seconds, of streamed calls. The read timeout bounds the wait for each line.
+stream_timeout = (5, 120)
+
 
 def call_generation_interface(
         prompt: str,
         topic: dict,
         connection_profile=None,
+        num_candidates: int = 1,
+        banned_substrings: list = None,
+        prefix: str = None,
+        partial_callback=None,
 ):
     """
     Utility function to call remote generation interface.
     :param prompt: the sentence to be continued.
     :param topic: topic weights used for generation.
+    :param num_candidates: how many candidates the server samples (in one batch) to pick from.
+    :param banned_substrings: if not None, the server skips candidates containing any of these.
+    :param prefix: if not None, start of `prompt` shared by many calls; the server caches model states for it.
+    :param partial_callback: if not None, function called with the text generated so far while the sentence is
+    generated. Only used if the profile has a streaming route (see is_token_streaming_available); if streaming
+    fails, the sentence is generated with a plain call.
     :return: sentence generated from remote API.
     """
 
@@ -34,12 +53,43 @@ def call_generation_interface(
     default_server_addr = available_configs[connection_profile]["default_server_addr"]
     generate_api_route = available_configs[connection_profile]["generate_api_route"]
 
+    data = {"skill": 0,
+            "sentence": prompt,
+            "topic": topic, "task": "generation"}
+    if num_candidates > 1:
+        data["num_candidates"] = num_candidates
+    if banned_substrings is not None:
+        data["banned_substrings"] = banned_substrings
+    if prefix is not None:
+        data["prefix"] = prefix
+
+    if partial_callback is not None and is_token_streaming_available(connection_profile):
+        stream_server_addr = available_configs[connection_profile]["stream_server_addr"]
+        stream_api_route = available_configs[connection_profile]["stream_api_route"]
+        try:
+            with requests.post("%s%s" % (stream_server_addr, stream_api_route), json=data, stream=True,
+                               timeout=stream_timeout) as response:
+                if response.status_code != 200:
+                    raise RuntimeError(response.text)
+                for line in response.iter_lines():
+                    if not line:
+                        continue
+                    event = json.loads(line)
+                    if "error" in event:
+                        raise RuntimeError(event["error"])
+                    if "partial" in event:
+                        partial_callback(event["partial"])
+                    else:
+                        return event["response"]["out_sentence"]
+            raise RuntimeError("stream ended without a result.")
+        except (requests.exceptions.RequestException, ValueError, RuntimeError) as e:
+            # Streaming is only a convenience: generate the sentence with a plain call instead.
+            print("Streamed generation failed (%s), falling back to a plain call." % str(e))
+
     call_result = RemoteAPIInterface.request(
         method="POST",
         address="%s%s" % (default_server_addr, generate_api_route),
-        data={"skill": 0,
-              "sentence": prompt,
-              "topic": topic, "task": "generation"}
+        data=data
     )
 
     if call_result.success:
@@ -50,6 +100,98 @@ def call_generation_interface(
         raise RuntimeError("Failed to call API: %s" % call_result.payload)
 
 
+def is_token_streaming_available(connection_profile=None) -> bool:
+    """
+    Whether the generation API of this profile can stream sentences while they are generated.
+    :param connection_profile: endpoint used to call remote API.
+    :return: True if a streaming route is configured.
+    """
+    if connection_profile is None:
+        connection_profile = default_connection_profile
+    return "stream_api_route" in available_configs[connection_profile]
+
+
+def get_generation_candidates(connection_profile=None) -> int:
+    """
+    Number of candidates to sample per sentence (see `num_candidates` of call_generation_interface).
+    :param connection_profile: endpoint used to call remote API.
+    :return: `generation_candidates` of the profile, or default_generation_candidates.
+    """
+    if connection_profile is None:
+        connection_profile = default_connection_profile
+    return int(available_configs[connection_profile].get("generation_candidates", default_generation_candidates))
+
+
+def is_story_generation_available(connection_profile=None) -> bool:
+    """
+    Whether the generation API of this profile can generate whole stories (see call_story_generation_interface).
+    :param connection_profile: endpoint used to call remote API.
+    :return: True if a story route is configured.
+    """
+    if connection_profile is None:
+        connection_profile = default_connection_profile
+    return "story_api_route" in available_configs[connection_profile]
+
+
+def call_story_generation_interface(
+        initial_prompt: str,
+        sentence_count: int,
+        document: list,
+        freeze_mask: list,
+        topic_weight: dict,
+        num_candidates: int = 1,
+        banned_substrings: list = None,
+        max_horizon: int = 2,
+        connection_profile=None,
+        stream_tokens: bool = False,
+):
+    """
+    Utility function to generate a whole story remotely.
+    Sentences are streamed back (one JSON object per line) as soon as each one is generated.
+    :param initial_prompt: prompt every sentence prompt starts with.
+    :param sentence_count: number of sentences in the story.
+    :param document: current sentences; frozen ones are kept and used as context.
+    :param freeze_mask: list of bool, True for sentences that should not be regenerated.
+    :param topic_weight: dict, key is topic and value is the list of weights for every sentence.
+    :param num_candidates: see call_generation_interface.
+    :param banned_substrings: see call_generation_interface.
+    :param max_horizon: maximum previous sentences to append to each prompt.
+    :param connection_profile: endpoint used to call remote API.
+    :param stream_tokens: if True, the partial text of each sentence is also streamed while it is generated.
+    :return: generator of dicts {"index": <int>, "sentence": <generated sentence, or None if frozen>};
+    with `stream_tokens`, preceded for each sentence by dicts {"index": <int>, "partial": <text generated so far>}.
+    """
+    if connection_profile is None:
+        connection_profile = default_connection_profile
+
+    story_server_addr = available_configs[connection_profile]["story_server_addr"]
+    story_api_route = available_configs[connection_profile]["story_api_route"]
+
+    data = {"initial_prompt": initial_prompt,
+            "sentence_count": sentence_count,
+            "document": document,
+            "freeze_mask": freeze_mask,
+            "topic_weight": topic_weight,
+            "num_candidates": num_candidates,
+            "max_horizon": max_horizon}
+    if banned_substrings is not None:
+        data["banned_substrings"] = banned_substrings
+    if stream_tokens:
+        data["stream_tokens"] = True
+
+    with requests.post("%s%s" % (story_server_addr, story_api_route), json=data, stream=True,
+                       timeout=stream_timeout) as response:
+        if response.status_code != 200:
+            raise RuntimeError("Failed to call API: %s" % response.text)
+        for line in response.iter_lines():
+            if not line:
+                continue
+            event = json.loads(line)
+            if "error" in event:
+                raise RuntimeError("Failed to call API: %s" % event["error"])
+            yield event
+
+
 def call_carp_interface(
         stories: list,
         reviews: Union[list, dict],
@@ -89,4 +231,37 @@ def call_carp_interface(
     else:
         raise RuntimeError("Failed to call API: %s" % call_result.payload)
 
+
+def call_carp_critic_retrieval_interface(
+        stories: list,
+        k: int = 3,
+        scope: str = "line",
+        connection_profile: str = None,
+):
+    """
+    Utility used to ask CARP which critics of its critic library match a story best (v3 interface).
+    :param stories: Lines of stories.
+    :param k: number of critics returned for each line (or for the story).
+    :param scope: "line" to find critics for every line, "story" for the whole story.
+    :param connection_profile: endpoint used to call remote API.
+    :return: dict, key is each line (or the whole story), value is a dict of the best critics (best first)
+    and their scores.
+    """
+    if connection_profile is None:
+        connection_profile = default_carp_connection_profile
+
+    default_server_addr = available_carp_configs[connection_profile]["default_server_addr"]
+    generate_api_route = available_carp_configs[connection_profile]["carp_api_route"]
+
+    call_result = RemoteAPIInterface.request(
+        method="POST",
+        address="%s%s" % (default_server_addr, generate_api_route),
+        data={"stories": stories, "version": 3, "k": k, "scope": scope}
+    )
+
+    if call_result.success:
+        return call_result.payload
+    else:
+        raise RuntimeError("Failed to call API: %s" % call_result.payload)
+
 # endregion
@@ -0,0 +1,59 @@
+"""
+StoryPrompt.py
+
+Helpers composing the prompt and topic weights used to generate one sentence of a story.
+
+Shared by StoryCreativeContext (sentence by sentence generation) and the PNB addon (whole story generation),
+so that both produce the same requests.
+"""
+
+
+def get_sentence_topics(topic_weight: dict, index: int, sentence_count: int) -> dict:
+    """
+    Compose topic weights for one index position of the story.
+    :param topic_weight: dict, key is topic and value is the list of weights for every sentence.
+    :param index: index of the sentence.
+    :param sentence_count: number of sentences in the story.
+    :return: dict, key is topic and value is its normalized weight. Topics with (near) zero weight are removed.
+    """
+    topic_this_sentence = {}
+    for key, value in topic_weight.items():
+        topic_this_sentence[key] = value[index]
+    total_weight_this_sentence = sum(topic_this_sentence.values())
+    for key, value in topic_this_sentence.items():
+        if total_weight_this_sentence > 0:
+            normalized_value = value / total_weight_this_sentence
+            # Filtering weights that are too small - They do not really change the sentence but incur computation.
+            if normalized_value < 0.01 / sentence_count:
+                normalized_value = 0
+            topic_this_sentence[key] = normalized_value
+    # Remove all keys that has weight = 0
+    return {k: v for k, v in topic_this_sentence.items() if v > 0}
+
+
+def get_sentence_prompt(initial_prompt: str, document: list, index: int, max_horizon: int = 2) -> str:
+    """
+    Compose the prompt for one index position of the story.
+    Previous sentences are attached as the context (from original P&B work).
+    :param initial_prompt: prompt every story starts with.
+    :param document: sentences of the story so far.
+    :param index: index of the sentence.
+    :param max_horizon: maximum previous sentences to append.
+    :return: prompt.
+    """
+
+    def get_previous(idx):
+        """
+        Get a previous sentence in the document. If not exist, return "".
+        :param idx: index of *current* sentence position.
+        """
+        if idx in range(len(document)):
+            return document[idx]
+        else:
+            return ""
+
+    prompt = f"{initial_prompt}"
+    for delta_idx in range(max_horizon):
+        # becasue delta_idx is from 0 to max_horizon-1 we need to subtract one extra.
+        prompt = f"{prompt} {get_previous(index - delta_idx - 1)}"
+    return prompt
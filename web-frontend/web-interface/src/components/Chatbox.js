@@ -1,4 +1,4 @@
-import React, {useEffect} from 'react';
+import React, {useEffect, useRef, useState} from 'react';
 import {
     Widget,
     addResponseMessage,
@@ -14,8 +14,46 @@ import './Chatbox.css'
 
 // Note: chatbot widget documentation at https://github.com/Wolox/react-chat-widget/issues/130
 
+// A message still being written (e.g. a sentence while it is generated), updated by 'partial_message' events
+// with the same stream id. The last event ('done') replaces the partial text with the final message, which may
+// differ from what was streamed, and the bubble stops listening.
+const StreamingMessage = (props) => {
+    const [text, setText] = useState(props.message);
+    const [done, setDone] = useState(false);
+
+    useEffect(() => {
+        if (done) {
+            return;
+        }
+        const partialListener = (message) => {
+            if (message['id'] === props.uuid && message['stream'] === props.stream) {
+                setText(message['message']);
+                if (message['done']) {
+                    setDone(true);
+                }
+            }
+        };
+
+        props.socket.on('partial_message', partialListener);
+
+        return () => {
+            props.socket.off('partial_message', partialListener);
+        };
+    }, [props.socket, props.uuid, props.stream, done]);
+
+    return (
+        <div className="rcw-response">
+            <div className="rcw-message-text">
+                <p>{text}</p>
+            </div>
+        </div>
+    );
+}
+
 const Chatbox = (props) => {
     let options;
+    // Stream ids that already have a StreamingMessage.
+    const streams = useRef(new Set());
 
     useEffect(() => {
         addResponseMessage("Hello! I'm your Creative Wand.");
@@ -44,6 +82,27 @@ const Chatbox = (props) => {
         };
     }, [props.socket]);
 
+    useEffect(() => {
+        // Only creates the bubble; it then follows its own stream.
+        const partialListener = (message) => {
+            if (message['id'] === props.uuid && !message['done'] && !streams.current.has(message['stream'])) {
+                streams.current.add(message['stream']);
+                renderCustomComponent(StreamingMessage, {
+                    socket: props.socket,
+                    uuid: props.uuid,
+                    stream: message['stream'],
+                    message: message['message'],
+                });
+            }
+        };
+
+        props.socket.on('partial_message', partialListener);
+
+        return () => {
+            props.socket.off('partial_message', partialListener);
+        };
+    }, [props.socket, props.uuid]);
+
 
     const handleNewUserMessage = async (newMessage) => {
         props.socket.emit('chat_message', {message: newMessage, code: props.code, id: props.uuid});